@@ -7,39 +7,54 @@ Copyright (c) 2023, ZJ Laczik
 Please submit suggestions, feature requests and bug reports on https://github.com/laczik
 """
 
-quiet = False
+# progress reporting levels, see mprint()
+LOG_QUIET = 0		# errors and warnings are not reported either
+LOG_INFO = 1		# per document progress, errors and warnings
+LOG_DETAIL = 2		# per page, layer and item progress
 
 ########################################
-def import_libraries() :
+def import_libraries( named_libs=None, exit_on_error=None ) :
 	"""
 	List all reuired libraries below either as "library_name" or as
 	"(library_name, short_name)" tuple. This function will try
 	to import the libraries listed and will print a summary error
-	message and exit if any of the library imports fail.
-	"""
-	named_libs = [
-		'sys',
-		'io',
-		'inspect',
-		're',
-		'struct',
-		'datetime',
-
-		'tempfile',
-		'shutil',
-		'sqlite3',
-		'gzip',
-		'zipfile',
-		'base64',
+	message and exit if any of the library imports fail, or raise
+	ImportError unless exit_on_error (by default only in conversions
+	started by convert(), which must not print or exit).
+	Heavy libraries are not listed here but imported on first use,
+	see import_lazily(); named_libs overrides the list below.
+	"""
+	if named_libs is None :
+		named_libs = [
+			'sys',
+			'io',
+			'inspect',
+			'contextlib',
+			'threading',
+			'os',
+			'glob',
+			'json',
+			'hashlib',
+			'collections',
+			'contextvars',
+			'queue',
+			'time',
+			're',
+			'struct',
+			'math',
+			'datetime',
+
+			'tempfile',
+			'shutil',
+			'zlib',
+			'base64',
+			('concurrent.futures', 'futures'),
+			'multiprocessing',
 		
-		('numpy', 'np'),
-		'cv2',
-		#'exif',
-
-		'argparse',
+			#'exif',
 
-		('squidnote_page_pb2',	'SNP')
-	]
+			'argparse',
+		]
 	try :
 		from importlib import import_module
 		for named_lib in named_libs:
@@ -50,7 +65,12 @@ def import_libraries() :
 			elif isinstance(named_lib, tuple) :
 				lib = import_module( named_lib[0] )
 				globals()[named_lib[1]] = lib
-	except :
+	except Exception as e :
+		if exit_on_error is None :
+			exit_on_error = 'conversion_context' not in globals( ) or not context( ).embedded
+		if not exit_on_error :
+			raise ImportError( f'Could not import one of the required libraries ({e}), use pip or the package manager'
+				' of your operating system to install the missing library' ) from e
 		# N.B. we may not yet be able to use mprint...
 		try :
 			print( '\n', CRED, sys.exc_info(), CEND )
@@ -60,7 +80,28 @@ def import_libraries() :
 		print( CRED, '\n\tCould not import one of the required libraries as indicated above', CEND )
 		print( CRED, '\tUse pip or the package manager of your operating system to install the missing library\n', CEND )
 		exit()
-		
+
+	# created once, even if conversions in several threads import the libraries at the same time
+	if 'contextvars' in globals( ) and 'conversion_context' not in globals( ) :
+		globals( ).setdefault( 'conversion_context', contextvars.ContextVar( 'conversion_context', default=ConversionContext( ) ) )
+
+# libraries imported by import_lazily() once needed: those for reading squidnote
+# documents at the start of a conversion (not needed for e.g. -h), numpy for
+# the first strokes and OpenCV for the first image (cv2 alone takes well over 100 ms
+# to import, so notebooks without images are converted noticeably faster)
+CONVERSION_LIBS = [ 'sqlite3', 'zipfile', 'mmap', ( 'squidnote_page_pb2', 'SNP' ) ]
+NUMPY_LIBS = [ ( 'numpy', 'np' ) ]
+IMAGE_LIBS = [ ( 'numpy', 'np' ), 'cv2' ]
+DAEMON_LIBS = [ 'signal', 'socket', 'socketserver', 'stat' ]
+
+def import_lazily( named_libs, exit_on_error=None ) :
+	"""
+	import those of the libraries (listed as for import_libraries()) that have not been imported yet
+	"""
+	missing = [ lib for lib in named_libs if ( lib if isinstance( lib, str ) else lib[1] ) not in globals( ) ]
+	if missing :
+		import_libraries( missing, exit_on_error )
+
 ########################################
 
 CEND      = '\33[0m'
@@ -89,56 +130,889 @@ CVIOLET2 = '\33[95m'
 CBEIGE2  = '\33[96m'
 CWHITE2  = '\33[97m'
 
-def mprint( *args, **kwargs) :
+def mprint( *args, colour=CWHITE, level=LOG_INFO, sep=' ' ) :
+	"""
+	print messages to stderr with optional colour specified, if the
+	progress reporting level (log_level) is at least the level of the message;
+	messages on hot paths should be guarded by "if ctx.log_level >= LOG_DETAIL :"
+	so that they are not even formatted when they are not going to be printed;
+	with a progress callback (see convert()) messages are passed to it instead
+	"""
+	ctx = context( )
+	if level <= ctx.log_level :
+		if ctx.progress is not None :
+			ctx.progress( { 'event': 'message', 'level': level, 'message': sep.join( map( str, args ) ) } )
+		else :
+			print( f'{datetime.datetime.now()}   {colour}{sep.join( map( str, args ) )}{CEND}', file=sys.stderr )
+
+########################################
+class ConversionContext :
+	"""
+	the state of a conversion: options set up front, caches, image threads and
+	metrics; each convert() call works in a context of its own, the command line
+	tool (and each worker process) in the default context; the current context
+	is that of the calling thread, see context(), and is handed on to the
+	threads a conversion starts
 	"""
-	print messages to stderr with optional colour specified
-	wrapper for print( *args, **kwargs)
+	def __init__( self ) :
+		# progress reporting level, and callback receiving progress events and
+		# messages (see report_progress()), None to print messages to stderr
+		self.log_level = LOG_INFO
+		self.progress = None
+
+		# conversion metrics, None unless enabled by init_metrics()
+		self.metrics = None
+
+		# decode the delta points of strokes straight from the protobuf wire format of
+		# a page, see decode_page_deltas(); set to False (-F) to use the SN_DP messages
+		self.fast_deltas = True
+
+		# tolerance (in Xournal++ units, i.e. points of 1/72 inch) to simplify strokes
+		# with (-T), see simplify_polylines(); 0 to keep all points
+		self.simplify_tolerance = 0.0
+
+		# number of points of the strokes serialised, and of points / XML bytes
+		# dropped by stroke simplification (reset by generate_xournal_xml_doc())
+		self.simplify_counts = { 'points': 0, 'points_dropped': 0, 'bytes_dropped': 0 }
+
+		# XML colours keyed by protobuf colour, and <stroke> start tags (up to the width
+		# attribute) keyed by (tool,colour), see colour_hex() and render_strokes(); cleared
+		# by generate_xournal_xml_doc(), so they only hold the colours of one document
+		self.colour_hex = {}
+		self.stroke_headers = {}
+
+		# decoded images keyed by (image_hash,reduction), and base64 PNG strings keyed by
+		# image_hash and transformation, created by init_image_caches()
+		self.decoded_image_cache = None
+		self.encoded_image_cache = None
+		self.image_caches = ()
+
+		# image_hash -> False for images that cannot be decoded at reduced size (not JPEG)
+		self.image_reducible = {}
+
+		# thread pool rendering images in the background, see start_image_threads()
+		self.image_pool = None
+		self.image_slots = None
+		self.image_thread_options = ( 0, 0 )
+
+		# multiprocessing context page conversion workers (-j) are started with, None for the default
+		self.process_context = None
+
+		# missing libraries raise ImportError rather than end the process (set by convert())
+		self.embedded = False
+
+		# page fragment cache and background PDF store, see init_disk_caches()
+		self.fragment_cache = None
+		self.pdf_store = None
+
+	def close( self ) :
+		"""
+		stop the image threads
+		"""
+		if self.image_pool is not None :
+			self.image_pool.shutdown( )
+			self.image_pool = None
+
+def context( ) :
 	"""
-	try	:
-		colour = kwargs['colour']
-		del kwargs['colour']
-	except KeyError :
-		colour = CWHITE
+	ConversionContext		ctx		context of the conversion running in the calling thread
+	"""
+	return conversion_context.get( )
 
-	if not quiet :
-		print( datetime.datetime.now(), ' ', colour, file=sys.stderr, end='' )
-		print( *args, **kwargs, file=sys.stderr, end='' )
-		print( CEND, file=sys.stderr )
+def report_progress( event, **fields ) :
+	"""
+	pass a progress event to the progress callback of the conversion, if any:
+		start	pages				conversion of the pages is starting
+		page	page, pages			page (its position in the document, from 0) has been written,
+									pages is the number of pages converted
+		done	summary				conversion has completed (see convert())
+		message	level, message		message that would have been printed (see mprint())
+	the callback may be called from any thread of the conversion, but not concurrently
+
+	string		event		name of the event
+	"""
+	ctx = context( )
+	if ctx.progress is not None :
+		ctx.progress( dict( event=event, **fields ) )
 
 ########################################
-def split_colour_channels( i ) :
+class MetricsTimer :
 	"""
-	get RGBA colour components from protobuf colour representation (uint32)
-	
-	uint32					i				protobuf colour
-	(byte,byte,byte,byte)	( r,g,b,a )		RGBA tuple
+	context manager adding the time spent in its body to a Metrics timer
+	"""
+	def __init__( self, metrics, name ) :
+		self.metrics = metrics
+		self.name = name
+
+	def __enter__( self ) :
+		self.start = time.perf_counter( )
+
+	def __exit__( self, *exc ) :
+		self.metrics.add_time( self.name, time.perf_counter( ) - self.start )
+
+class Metrics :
+	"""
+	counters and timers of the conversion stages and, optionally, per-page
+	records; thread safe, as images are rendered on background threads (so
+	image timers add up the time spent by all threads)
+
+	bool		pages		keep per-page records
+	"""
+	def __init__( self, pages=False ) :
+		self.counters = {}
+		self.timers = {}		# name -> [calls, seconds]
+		self.pages = [] if pages else None
+		self.lock = threading.Lock( )
+
+	def count( self, name, n=1 ) :
+		with self.lock :
+			self.counters[name] = self.counters.get( name, 0 ) + n
+
+	def add_time( self, name, seconds, calls=1 ) :
+		with self.lock :
+			timer = self.timers.setdefault( name, [ 0, 0.0 ] )
+			timer[0] += calls
+			timer[1] += seconds
+
+	def timer( self, name ) :
+		return MetricsTimer( self, name )
+
+	def add_page( self, record ) :
+		if self.pages is not None :
+			with self.lock :
+				self.pages.append( record )
+
+	def report( self ) :
+		"""
+		dict		report		counters, timers and per-page records, as plain (JSON serialisable) data
+		"""
+		with self.lock :
+			report = {
+				'counters':	dict( sorted( self.counters.items( ) ) ),
+				'timers':	{ name : { 'calls': calls, 'seconds': seconds } for name, ( calls, seconds ) in sorted( self.timers.items( ) ) },
+			}
+			if self.pages is not None :
+				report['pages'] = sorted( self.pages, key=lambda r : r['page'] )
+		return report
+
+	def merge( self, report ) :
+		"""
+		add the counters, timers and page records of a report (e.g. of a worker process)
+		"""
+		for name, n in report['counters'].items( ) :
+			self.count( name, n )
+		for name, timer in report['timers'].items( ) :
+			self.add_time( name, timer['seconds'], timer['calls'] )
+		for record in report.get( 'pages', () ) :
+			self.add_page( record )
+
+def init_metrics( settings ) :
+	"""
+	enable (or disable) metrics collection
+
+	bool		settings	None to disable metrics, else whether to keep per-page records
+	"""
+	context( ).metrics = None if settings is None else Metrics( settings )
+
+def timed( name ) :
+	"""
+	time the body of a with statement if metrics are enabled
+	"""
+	ctx = context( )
+
+	return contextlib.nullcontext( ) if ctx.metrics is None else ctx.metrics.timer( name )
+
+########################################
+def colour_hex( i ) :
+	"""
+	get the XML colour of a protobuf colour representation (uint32, ARGB);
+	colours are memoised, a document only uses a handful of them
+
+	uint32		i			protobuf colour
+	bytes		text		'#rrggbbaa' (ASCII)
+	"""
+	ctx = context( )
+
+	text = ctx.colour_hex.get( i )
+	if text is None :
+		# ARGB -> RGBA
+		text = ctx.colour_hex[i] = b'#%08x' % ( ( i << 8 | i >> 24 ) & 0xffffffff )
+	return text
+
+########################################
+def format_decimals( values ) :
+	"""
+	vectorised equivalent of formatting each value with f' {v:.3f}'
+	the digits are assembled in a numpy character matrix, so the result is
+	byte-identical to Python's (correctly rounded) float formatting; values
+	too close to a rounding tie to decide in float64 are formatted by Python
+
+	ndarray		values		float64 values to be formatted
+
+	bytes		text		concatenated ' x.xxx' fields (ASCII), one per value
+	ndarray		ends		end offset of each field in text
+	"""
+	q = values * 1000.0
+	if values.size == 0 or not np.all( np.abs( q ) < 1e15 ) :
+		# empty, non-finite or very large values, let Python do the formatting
+		fields = [ b' %.3f' % v for v in values.tolist() ]
+		return b''.join( fields ), np.cumsum( [ len( f ) for f in fields ], dtype=np.intp )
+
+	ints = np.rint( q ).astype( np.int64 )
+	# the product above is rounded, so near-ties may round the wrong way
+	tie = np.abs( q - np.floor( q ) - 0.5 ) <= 1e-12 * ( np.abs( q ) + 1.0 )
+	for i in np.flatnonzero( tie ) :
+		ints[i] = int( f'{values[i]:.3f}'.replace( '.', '' ) )
+
+	neg = np.signbit( values )
+	ints = np.abs( ints )
+	ip, fp = np.divmod( ints, 1000 )
+	n_digits = len( str( int( ip.max( ) ) ) )
+
+	# one row per value: ' ', '-', integer digits, '.', three fraction digits
+	chars = np.empty( ( values.size, n_digits + 6 ), dtype=np.uint8 )
+	keep = np.ones( chars.shape, dtype=bool )
+	chars[:,0] = ord( ' ' )
+	chars[:,1] = ord( '-' )
+	keep[:,1] = neg
+	for k in range( n_digits ) :
+		p = 10 ** ( n_digits - 1 - k )
+		chars[:,2+k] = ord( '0' ) + ( ip // p ) % 10
+		if k < n_digits - 1 :
+			keep[:,2+k] = ip >= p
+	chars[:,-4] = ord( '.' )
+	chars[:,-3] = ord( '0' ) + fp // 100
+	chars[:,-2] = ord( '0' ) + ( fp // 10 ) % 10
+	chars[:,-1] = ord( '0' ) + fp % 10
+
+	ends = np.cumsum( keep.sum( axis=1 ), dtype=np.intp )
+	return chars[keep].tobytes( ), ends
+
+########################################
+def add_simplify_counts( counts, reset=False ) :
+	"""
+	add counts (e.g. of a page converted by a worker process) to simplify_counts, or reset them first
+	"""
+	ctx = context( )
+
+	for name in ctx.simplify_counts :
+		ctx.simplify_counts[name] = ( 0 if reset else ctx.simplify_counts[name] ) + counts.get( name, 0 )
+
+def simplify_polylines( xy, first, rows, tolerance ) :
+	"""
+	Ramer-Douglas-Peucker simplification of a batch of polylines, vectorised over
+	all of them: each pass examines the spans (between two kept points) left by
+	the previous one at once, and splits each span at its point farthest from the
+	line segment between its ends if that is farther than the tolerance, else
+	drops its inner points; every dropped point is thus within the tolerance of
+	the simplified polyline (points with non-finite coordinates are kept)
+
+	ndarray		xy			(n,2) points of all polylines
+	ndarray		first		index of the first point of each polyline
+	ndarray		rows		number of points of each polyline
+	float		tolerance	maximum distance of a dropped point to the simplified polyline
+
+	ndarray		keep		boolean mask of the points to keep
+	"""
+	last = first + rows - 1
+	keep = np.zeros( len( xy ), dtype=bool )
+	keep[first] = True
+	keep[last] = True
+	( starts, ends ) = ( first[rows > 2], last[rows > 2] )
+	while len( starts ) :
+		inner = ends - starts - 1
+		offsets = np.cumsum( inner ) - inner
+		span = np.repeat( np.arange( len( starts ) ), inner )
+		index = np.arange( inner.sum( ) ) + np.repeat( starts + 1 - offsets, inner )
+		# distance of each inner point to the segment between the ends of its span
+		a = xy[starts][span]
+		ab = ( xy[ends] - xy[starts] )[span]
+		ap = xy[index] - a
+		ab2 = np.einsum( 'ij,ij->i', ab, ab )
+		t = np.clip( np.einsum( 'ij,ij->i', ap, ab ) / np.where( ab2 > 0, ab2, 1.0 ), 0.0, 1.0 )
+		d = np.hypot( *( ap - t[:,None] * ab ).T )
+		d[~np.isfinite( d )] = np.inf
+		d_max = np.maximum.reduceat( d, offsets )
+		# first point at the maximum distance of each span
+		at_max = np.flatnonzero( d == d_max[span] )
+		farthest = index[at_max[np.unique( span[at_max], return_index=True )[1]]]
+		split = d_max > tolerance
+		keep[farthest[split]] = True
+		( starts, ends ) = ( np.concatenate( ( starts[split], farthest[split] ) ), np.concatenate( ( farthest[split], ends[split] ) ) )
+		( starts, ends ) = ( starts[ends - starts > 1], ends[ends - starts > 1] )
+	return keep
+
+def formatted_lengths( values ) :
+	"""
+	lengths of the fields format_decimals() makes of values (but for rare rounding ties)
+	"""
+	neg = np.signbit( values )
+	finite = np.isfinite( values )
+	ip = np.rint( np.abs( np.where( finite, values, 0.0 ) ) * 1000.0 ) // 1000
+	digits = 1 + np.searchsorted( 10.0 ** np.arange( 1, 20 ), ip, side='right' )
+	# ' ', '-', integer digits, '.', three fraction digits (or ' nan', ' inf', ' -inf')
+	return np.where( finite, 5 + neg + digits, 4 + neg )
+
+def render_strokes( strokes, stroke_scale, highlight_scale, decoded=None ) :
+	"""
+	serialise a batch of pen / highlighter strokes (e.g. all strokes of a layer)
+	into XML <stroke> elements; the delta points of all strokes are pulled
+	into numpy arrays, scaled and formatted in a single vectorised pass
+
+	[SN_Stroke]	strokes			SN_ST_NORMAL or SN_ST_HIGHLIGHT strokes
+	float		stroke_scale	stroke width scale factor
+	float		highlight_scale	highlight width scale factor
+	tuple		decoded			delta points of the strokes as returned by layer_deltas(), optional
+
+	[memoryview]	elements	one XML <stroke> element (ASCII) per stroke, all in one buffer
+	"""
+	ctx = context( )
+
+	if not strokes :
+		return []
+	import_lazily( NUMPY_LIBS )
+
+	counts = np.fromiter( ( len( s.delta ) for s in strokes ), dtype=np.intp, count=len( strokes ) )
+	if decoded is not None and np.array_equal( decoded[0], counts ) :
+		deltas = decoded[1]
+	else :
+		deltas = np.fromiter( ( v for s in strokes for pt in s.delta for v in ( pt.dx, pt.dy, pt.weight ) ), dtype=np.float64 )
+		deltas = deltas.reshape( -1, 3 )
+
+	# each stroke contributes its start point followed by its delta points
+	rows = counts + 1
+	first = np.cumsum( rows ) - rows
+	is_delta = np.ones( rows.sum( ), dtype=bool )
+	is_delta[first] = False
+
+	# start tag of each stroke up to its width, the same for all strokes of a tool and colour
+	headers = []
+	scales = np.empty( len( strokes ), dtype=np.float64 )
+	weights = np.empty( len( strokes ), dtype=np.float64 )
+	start = np.empty( ( len( strokes ), 2 ), dtype=np.float64 )
+	highlight = SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT
+	for i, s in enumerate( strokes ) :
+		if s.type == highlight :
+			tool = b'highlighter'
+			scales[i] = highlight_scale * 28.34645669
+		else :
+			tool = b'pen'
+			scales[i] = stroke_scale * 2.834645669
+		header = ctx.stroke_headers.get( ( tool, s.colour ) )
+		if header is None :
+			header = ctx.stroke_headers[( tool, s.colour )] = b'<stroke tool="%s" ts="0" fn="" color="%s" width="' % ( tool, colour_hex( s.colour ) )
+		headers.append( header )
+		weights[i] = s.weight
+		start[i] = ( s.start.x, s.start.y )
+
+	w = np.empty( rows.sum( ), dtype=np.float64 )
+	w[first] = weights
+	w[is_delta] = deltas[:,2]
+	w *= np.repeat( scales, rows )
+
+	ref = 28.34645669 * start
+	xy = np.empty( ( rows.sum( ), 2 ), dtype=np.float64 )
+	xy[first] = ref
+	xy[is_delta] = np.repeat( ref, counts, axis=0 ) + 28.34645669 * deltas[:,:2]
+
+	ctx.simplify_counts['points'] += len( xy )
+	if ctx.simplify_tolerance > 0 :
+		keep = simplify_polylines( xy, first, rows, ctx.simplify_tolerance )
+		dropped = ~keep
+		n_dropped = int( dropped.sum( ) )
+		bytes_dropped = int( formatted_lengths( w[dropped] ).sum( ) + formatted_lengths( xy[dropped].ravel( ) ).sum( ) )
+		ctx.simplify_counts['points_dropped'] += n_dropped
+		ctx.simplify_counts['bytes_dropped'] += bytes_dropped
+		if ctx.metrics is not None :
+			ctx.metrics.count( 'points_dropped', n_dropped )
+			ctx.metrics.count( 'xml_bytes_dropped', bytes_dropped )
+		# each width stays with its point
+		( xy, w ) = ( xy[keep], w[keep] )
+		rows = np.add.reduceat( keep, first ).astype( np.intp )
+		counts = rows - 1
+		first = np.cumsum( rows ) - rows
+
+	w_text, w_ends = format_decimals( w )
+	xy_text, xy_ends = format_decimals( xy.ravel( ) )
+
+	# field ranges of each stroke, skipping the leading blank of its first field
+	last = first + counts
+	w_from = np.concatenate( ( [0], w_ends ) )[first] + 1
+	xy_from = np.concatenate( ( [0], xy_ends ) )[2*first] + 1
+	w_to = w_ends[last]
+	xy_to = xy_ends[2*last+1]
+
+	# the elements are assembled back to back in one buffer, straight from the formatted fields
+	text = bytearray( )
+	ends = []
+	( w_view, xy_view ) = ( memoryview( w_text ), memoryview( xy_text ) )
+	for header, wf, wt, xf, xt in zip( headers, w_from.tolist( ), w_to.tolist( ), xy_from.tolist( ), xy_to.tolist( ) ) :
+		text += header
+		text += w_view[wf:wt]
+		text += b'">'
+		text += xy_view[xf:xt]
+		text += b'</stroke>\n'
+		ends.append( len( text ) )
+	view = memoryview( text )
+	return [ view[s:e] for s, e in zip( [0] + ends, ends ) ]
+
+########################################
+class XoppStream :
+	"""
+	document buffer: collects the XML bits of the current page (ASCII bytes,
+	or futures of images rendered in the background) in a growing buffer and,
+	on flush(), writes them to every output file (sink), so memory is bounded
+	by the largest page rather than by the whole document; without sinks (dry
+	run) flushed fragments are simply discarded
+
+	[file]		sinks		binary files (e.g. GzipMemberWriter) to stream to
+	"""
+	def __init__( self, *sinks ) :
+		self.sinks = sinks
+		self.buffer = bytearray( )
+		# ( offset in buffer, Future ) of each image still being rendered
+		self.futures = []
+		self.size = 0
+
+	def write( self, data ) :
+		if isinstance( data, futures.Future ) :
+			self.futures.append( ( len( self.buffer ), data ) )
+		else :
+			self.buffer += data
+
+	def take( self ) :
+		"""
+		return the collected XML bits (a bytearray, handed over rather than copied)
+		and start collecting afresh; pending image futures are waited for here
+		"""
+		data = self.buffer
+		if self.futures :
+			# splice the images in at their places
+			view = memoryview( data )
+			parts = []
+			done = 0
+			for offset, future in self.futures :
+				parts += [ view[done:offset], future.result( ) ]
+				done = offset
+			parts.append( view[done:] )
+			data = bytearray( ).join( parts )
+		self.buffer = bytearray( )
+		self.futures = []
+		return data
+
+	def flush( self ) :
+		self.write_fragment( self.take( ) )
+
+	def write_fragment( self, fragment ) :
+		"""
+		write a completed, already encoded fragment (bytes), or a DeflatedFragment
+		if all sinks accept those (see deflate_level)
+		"""
+		with timed( 'output_write' ) :
+			if isinstance( fragment, DeflatedFragment ) :
+				for sink in self.sinks :
+					sink.write_deflated( fragment )
+				self.size += fragment.size
+			else :
+				for sink in self.sinks :
+					sink.write( fragment )
+				self.size += len( fragment )
+
+	@property
+	def deflate_level( self ) :
+		"""
+		compression level for fragments to be deflated at, None unless all sinks accept DeflatedFragments
+		"""
+		if len( self.sinks ) > 0 and all( isinstance( sink, GzipMemberWriter ) for sink in self.sinks ) :
+			return min( sink.level for sink in self.sinks )
+		return None
+
+########################################
+def crc32_combine( crc1, crc2, len2 ) :
+	"""
+	CRC-32 of the concatenation of two byte strings given their CRCs and the
+	length of the second one (port of zlib's crc32_combine)
+	"""
+	def gf2_times( mat, vec ) :
+		s = 0
+		i = 0
+		while vec :
+			if vec & 1 :
+				s ^= mat[i]
+			vec >>= 1
+			i += 1
+		return s
+
+	def gf2_square( mat ) :
+		return [ gf2_times( mat, mat[n] ) for n in range( 32 ) ]
+
+	if len2 <= 0 :
+		return crc1
+	odd = [ 0xedb88320 ] + [ 1 << n for n in range( 31 ) ]
+	even = gf2_square( odd )
+	odd = gf2_square( even )
+	while True :
+		even = gf2_square( odd )
+		if len2 & 1 :
+			crc1 = gf2_times( even, crc1 )
+		len2 >>= 1
+		if not len2 :
+			break
+		odd = gf2_square( even )
+		if len2 & 1 :
+			crc1 = gf2_times( odd, crc1 )
+		len2 >>= 1
+		if not len2 :
+			break
+	return crc1 ^ crc2
+
+class DeflatedFragment :
+	"""
+	raw deflate data of a fragment with CRC-32 and size of the uncompressed data
+	"""
+	def __init__( self, data, crc, size ) :
+		self.data = data
+		self.crc = crc
+		self.size = size
+
+def deflate_fragment( data, level=9, dictionary=b'' ) :
+	"""
+	compress a fragment into raw deflate blocks that can be concatenated with
+	others (sync flushed, no final block) into a single gzip member
+
+	bytes				data		uncompressed fragment
+	int					level		zlib compression level
+	bytes				dictionary	data preceding the fragment in the stream (up to 32 KiB), for
+									back references as if the stream were compressed in one go
+
+	DeflatedFragment	fragment	compressed data, CRC-32 and size of data
+	"""
+	if dictionary :
+		c = zlib.compressobj( level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary )
+	else :
+		c = zlib.compressobj( level, zlib.DEFLATED, -zlib.MAX_WBITS )
+	return DeflatedFragment( c.compress( data ) + c.flush( zlib.Z_SYNC_FLUSH ), zlib.crc32( data ), len( data ) )
+
+########################################
+# plain writes to a GzipMemberWriter are compressed in blocks of this size (as
+# pigz does), each primed with the preceding 32 KiB (the deflate window)
+GZIP_BLOCK_SIZE = 128 * 1024
+GZIP_WINDOW_SIZE = 32 * 1024
+
+class GzipMemberWriter :
+	"""
+	writes a single standard gzip member (RFC 1952) assembled from independently
+	deflated fragments, e.g. pages compressed by worker processes; plain writes
+	are cut into blocks that are deflated in parallel by a pool of threads (zlib
+	releases the GIL) and written in order, so the output is the same whatever
+	the number of threads
+
+	string		filename	name of the gzip file to create, or binary file object to write to (left open)
+	int			level		zlib compression level
+	int			threads		number of compression threads, 1 to compress in the calling thread
+	"""
+	def __init__( self, filename, level=9, threads=1 ) :
+		self.owned = isinstance( filename, ( str, os.PathLike ) )
+		self.fd = open( filename, 'wb' ) if self.owned else filename
+		self.level = level
+		self.crc = 0
+		self.size = 0
+		self.buffer = []
+		self.buffered = 0
+		self.window = b''
+		self.pending = collections.deque( )
+		self.threads = threads
+		self.pool = futures.ThreadPoolExecutor( max_workers=threads, thread_name_prefix='gzip' ) if threads > 1 else None
+		xfl = b'\x02' if level == 9 else b'\x04' if level == 1 else b'\x00'
+		self.fd.write( b'\x1f\x8b\x08\x00' + struct.pack( '<I', int( time.time( ) ) ) + xfl + b'\xff' )
+
+	def write( self, data ) :
+		self.buffer.append( data )
+		self.buffered += len( data )
+		if self.buffered >= GZIP_BLOCK_SIZE :
+			self.deflate_blocks( False )
+
+	def deflate_blocks( self, all_data ) :
+		"""
+		deflate the buffered data in blocks, keeping back the last incomplete block unless all_data
+		"""
+		data = b''.join( self.buffer )
+		end = len( data ) if all_data else len( data ) - len( data ) % GZIP_BLOCK_SIZE
+		for start in range( 0, end, GZIP_BLOCK_SIZE ) :
+			block = data[start : min( start + GZIP_BLOCK_SIZE, end )]
+			if start >= GZIP_WINDOW_SIZE :
+				dictionary = data[start - GZIP_WINDOW_SIZE : start]
+			else :
+				dictionary = ( self.window + data[:start] )[-GZIP_WINDOW_SIZE:]
+			# the CRC-32 of the member is kept up to date here, rather than combined from those of the blocks
+			self.crc = zlib.crc32( block, self.crc )
+			self.size += len( block )
+			if self.pool is None :
+				with timed( 'deflate' ) :
+					self.fd.write( deflate_fragment( block, self.level, dictionary ).data )
+			else :
+				self.pending.append( self.pool.submit( deflate_fragment, block, self.level, dictionary ) )
+				# bound the memory held by blocks in flight
+				while len( self.pending ) > 2 * self.threads :
+					self.write_pending( )
+		if end :
+			self.window = ( self.window + data[max( 0, end - GZIP_WINDOW_SIZE ) : end] )[-GZIP_WINDOW_SIZE:]
+		self.buffer = [ data[end:] ] if end < len( data ) else []
+		self.buffered = len( data ) - end
+
+	def write_pending( self ) :
+		"""
+		write the oldest block in flight, once it has been deflated
+		"""
+		with timed( 'deflate' ) :
+			fragment = self.pending.popleft( ).result( )
+		self.fd.write( fragment.data )
+
+	def flush( self ) :
+		"""
+		deflate and write all data written so far
+		"""
+		if self.buffered :
+			self.deflate_blocks( True )
+		while self.pending :
+			self.write_pending( )
+
+	def write_deflated( self, fragment ) :
+		self.flush( )
+		self.fd.write( fragment.data )
+		self.crc = crc32_combine( self.crc, fragment.crc, fragment.size )
+		self.size += fragment.size
+		# the uncompressed data of the fragment is not at hand to prime the next block with
+		self.window = b''
+
+	def close( self, complete=True ) :
+		"""
+		finish the gzip member and close the file; unless complete (e.g. on an
+		error) the member is left without its trailer, so it fails gzip -t
+		"""
+		try :
+			if complete :
+				self.flush( )
+				# empty final block, then CRC-32 and size of the uncompressed data
+				self.fd.write( b'\x03\x00' + struct.pack( '<II', self.crc, self.size & 0xffffffff ) )
+		finally :
+			if self.pool is not None :
+				self.pool.shutdown( cancel_futures=True )
+			if self.owned :
+				self.fd.close( )
+
+	def __enter__( self ) :
+		return self
+
+	def __exit__( self, *exc_info ) :
+		self.close( complete=exc_info[0] is None )
+
+class ReplacedOnSuccess :
+	"""
+	context manager for writing an output file under a temporary name next to
+	it, which replaces the output file once the block completes and is deleted
+	if it fails, so a failed conversion leaves any earlier output alone
+
+	string		path		name of the output file
+	"""
+	def __init__( self, path ) :
+		self.path = path
+		self.tmp_path = os.path.join( os.path.dirname( path ), f'.{os.path.basename( path )}.{os.getpid( )}.{threading.get_ident( )}.tmp' )
+
+	def __enter__( self ) :
+		return self.tmp_path
+
+	def __exit__( self, exc_type, *exc ) :
+		if exc_type is None :
+			os.replace( self.tmp_path, self.path )
+		else :
+			with contextlib.suppress( OSError ) :
+				os.unlink( self.tmp_path )
+		return False
+
+########################################
+def open_archive( source ) :
+	"""
+	open a squidnote document and, where possible, map it into memory so that
+	read_member() can hand out members stored uncompressed without copying them;
+	the mapping lives as long as the archive handle or any member handed out
+	(the archive must not be truncated in the meantime)
+
+	str | bytes | file	source		squidnote document: file name, content or seekable binary file object
+
+	ZipFile				sn			squidnote ZIp archive handle, its mapping attribute a memoryview
+									of the whole archive (None if it could not be mapped)
+	"""
+	mapping = None
+	if isinstance( source, ( bytes, bytearray, memoryview ) ) :
+		mapping = memoryview( source )
+		source = io.BytesIO( source )
+	sn = zipfile.ZipFile( source, 'r' )
+	if mapping is None :
+		try :
+			mapping = memoryview( mmap.mmap( sn.fp.fileno( ), 0, access=mmap.ACCESS_READ ) )
+		except ( AttributeError, OSError, ValueError, io.UnsupportedOperation ) :
+			# e.g. a pipe, or a file object without a file descriptor: members are read as usual
+			pass
+	sn.mapping = mapping
+	return sn
+
+def member_view( sn, info ) :
+	"""
+	memoryview of the content of a member stored uncompressed in a mapped archive
+
+	ZipFile		sn			squidnote ZIp archive handle, see open_archive()
+	ZipInfo		info		archive member
+
+	memoryview	view		content of the member, None if compressed, encrypted or not mapped
+	"""
+	mapping = getattr( sn, 'mapping', None )
+	if mapping is None or info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1 :
+		return None
+	# the data follows the local file header, whose name and extra field may differ from the central directory's
+	header = mapping[info.header_offset : info.header_offset + 30]
+	if len( header ) < 30 or header[:4] != b'PK\x03\x04' :
+		return None
+	( name_length, extra_length ) = struct.unpack( '<HH', header[26:30] )
+	start = info.header_offset + 30 + name_length + extra_length
+	if start + info.file_size > len( mapping ) :
+		return None
+	return mapping[start : start + info.file_size]
+
+def read_member( sn, name ) :
 	"""
-	( a,r,g,b ) = struct.pack( ">I", i )
-#	return struct.unpack( "<I", struct.pack( ">I", i ) )[0]
-	return ( r,g,b,a )
+	content of an archive member: for members stored uncompressed (such as
+	images) a memoryview into the mapped archive, without a copy, else the
+	inflated bytes, copied once; unlike ZipFile.read() the CRC of mapped members
+	is not checked, a damaged page or image fails to parse or decode anyway
+
+	ZipFile		sn			squidnote ZIp archive handle, see open_archive()
+	string		name		name of the member
+
+	memoryview | bytes	data	content of the member
+	"""
+	ctx = context( )
+
+	info = sn.getinfo( name )
+	data = member_view( sn, info )
+	if data is not None :
+		if ctx.metrics is not None :
+			ctx.metrics.count( 'archive_bytes_mapped', len( data ) )
+		return data
+	data = sn.read( info )
+	if ctx.metrics is not None :
+		ctx.metrics.count( 'archive_bytes_copied', len( data ) )
+	return data
+
+########################################
+def connect_note_db( data ) :
+	"""
+	open the squidnote sqlite3 database from its content, in memory where the
+	sqlite3 module supports deserialize (Python 3.11+), else via a temporary file
+
+	bytes		data		content of note.db
+
+	Connection	conn		database connection
+	function	cleanup		to be called after the connection has been closed
+	"""
+	if hasattr( sqlite3.Connection, 'deserialize' ) :
+		try :
+			# databases in WAL mode cannot be deserialized, their (absent) WAL
+			# file is of no interest here anyway: switch the header to rollback mode
+			if data[18:20] == b'\x02\x02' :
+				data = data[:18] + b'\x01\x01' + data[20:]
+			conn = sqlite3.connect( ':memory:' )
+			conn.deserialize( data )
+			mprint( f'Opened sqlite3 database note.db in memory', colour=CGREEN )
+			return ( conn, lambda : None )
+		except sqlite3.Error as e :
+			mprint( f'Could not open sqlite3 database in memory ({e}), using a temporary file', colour=CYELLOW )
+
+	dirpath = tempfile.mkdtemp( )
+	db_path = dirpath + '/note.db'
+	with open( db_path, 'wb' ) as f :
+		f.write( data )
+	conn = sqlite3.connect( db_path )
+	mprint( f'Connected to sqlite3 database {db_path}', colour=CGREEN )
+	return ( conn, lambda : shutil.rmtree( dirpath, ignore_errors=True ) )
+
+########################################
+def parse_page_ranges( text ) :
+	"""
+	parse a page selection (--pages) such as "10-25,40" or "100-"; pages are
+	counted from 1 in page order, an open range extends to the last page
+
+	string		text		comma separated page numbers and first-last ranges
+
+	[(int,int)]	ranges		(first,last) tuples, last None for open ranges
+	"""
+	ranges = []
+	for part in text.split( ',' ) :
+		first, dash, last = part.strip( ).partition( '-' )
+		first = int( first )
+		last = ( int( last ) if last.strip( ) else None ) if dash else first
+		if first < 1 or ( last is not None and last < first ) :
+			raise ValueError( f'invalid page range "{part}"' )
+		ranges.append( ( first, last ) )
+	return ranges
+
+def read_note_metadata( sn, ranges=None ) :
+	"""
+	read everything the converter needs from the squidnote sqlite3 database in
+	one pass: page order, page IDs and document (background PDF) IDs; with a page
+	selection, only the rows of the selected pages are returned
+
+	ZipFile		sn				squidnote ZIp archive handle
+	[(int,int)]	ranges			pages to select, see parse_page_ranges(), None for all
+
+	[tuple(str,str,int,int)]	pages	(page_id,pdf_id,page_num,page_number) tuples in page order,
+									page_number being the position in the document (from 0)
+	"""
+	with timed( 'db' ) :
+		( conn, cleanup ) = connect_note_db( sn.read( 'note.db' ) )
+		try :
+			cur = conn.cursor()
+			query = "SELECT id, documentId, pageNum, ROW_NUMBER() OVER (ORDER BY pageNum ASC) - 1 AS position FROM page"
+			params = []
+			if ranges is not None :
+				conditions = []
+				for first, last in ranges :
+					conditions.append( 'position >= ?' if last is None else 'position BETWEEN ? AND ?' )
+					params += [ first - 1 ] if last is None else [ first - 1, last - 1 ]
+				query = f"SELECT * FROM ({query}) WHERE {' OR '.join( conditions )}"
+			cur.execute( query + " ORDER BY position ASC", params )
+			pages = cur.fetchall()
+			mprint( f'Page metadata query completed, found {len(pages)} {"selected " if ranges is not None else ""}pages' )
+		finally :
+			conn.close()
+			cleanup()
+			mprint( f'Closed database connection' )
+	return pages
 
 ########################################
 def get_page_and_pdf_ids( sn ) :
 	"""
-	deserialise (parse) protobuf page description into an SN_Page object
+	get page and background PDF IDs from the squidnote sqlite3 database
 	
 	ZipFile				sn				squidnote ZIp archive handle
 
 	[tuple(str,str)]	query_result	array of (page_id,pdf_id) tuples
 	"""
+	return select_pages( sn, None )[1]
+
+def select_pages( sn, ranges ) :
+	"""
+	get the positions, page IDs and background PDF IDs of the selected pages
+	from the squidnote sqlite3 database
 
-	with tempfile.TemporaryDirectory() as dirpath :
-		sn.extract( 'note.db', dirpath )
-		db_path = dirpath + '/note.db'
-		conn = sqlite3.connect(db_path)
-		mprint( f'Connected to sqlite3 database {db_path}', colour=CGREEN )
-		cur = conn.cursor()
-		cur.execute( "SELECT id, documentId FROM page ORDER BY pageNum ASC" )
-		query_result = cur.fetchall()
-		mprint( f'Page / PDF ID query completed, found {len(query_result)} pages' )
-		conn.close()
-		mprint( f'Closed database connection' )
-	return query_result
+	ZipFile				sn					squidnote ZIp archive handle
+	[(int,int)]			ranges				pages to select, see parse_page_ranges(), None for all
+
+	[int]				page_numbers		positions of the selected pages in the document (from 0)
+	[tuple(str,str)]	page_and_pdf_ids	(page_id,pdf_id) tuples of the selected pages in page order
+	"""
+	pages = read_note_metadata( sn, ranges )
+	return [ p[3] for p in pages ], [ ( page_id, pdf_id ) for ( page_id, pdf_id, page_num, page_number ) in pages ]
 
 
 #
@@ -166,12 +1040,13 @@ def get_page_and_pdf_ids( sn ) :
 #	print( page.ListFields( ) )
 
 ########################################
-def parse_page_file( sn, page_id ) :
+def parse_page_file( sn, page_id, data=None ) :
 	"""
 	deserialise (parse) protobuf page description into an SN_Page object
 	
 	ZipFile		sn			squidnote ZIp archive handle
 	string		page_id		name of the protobuf page file stored in the squidnote ZIP archive
+	bytes		data		content of the page file if already read (optional)
 	
 	int			ret_val		number of items parsed
 	SN_Page		SN_Page		object containing all page components
@@ -180,16 +1055,198 @@ def parse_page_file( sn, page_id ) :
 	name = 'data/pages/' + page_id + '.page'
 
 	page = SNP.SN_Page( )
-	mprint( 'Created page protocol buffer' )
+	mprint( 'Created page protocol buffer', level=LOG_DETAIL )
 	
-	with sn.open( name, "r" ) as fd :
-		mprint( f'Opened page file {name}', colour=CGREEN )
-		ret_val = page.ParseFromString( fd.read( ) )
-		fd.close()
-		mprint( f'Closed page file' )
+	if data is None :
+		data = read_member( sn, name )
+		if context( ).log_level >= LOG_DETAIL :
+			mprint( f'Read page file {name}', colour=CGREEN )
+	with timed( 'page_parse' ) :
+		ret_val = page.ParseFromString( data )
 		
 	return (ret_val, page)
 
+########################################
+# wire format tags (field number << 3 | wire type) of the messages on the way to SN_DP,
+# and of the image_hash field of SN_Image (see referenced_images())
+TAG_PAGE_LAYER		= 3 << 3 | 2
+TAG_LAYER_ITEM		= 1 << 3 | 2
+TAG_ITEM_STROKE		= 1000 << 3 | 2
+TAG_STROKE_DELTA	= 4 << 3 | 2
+TAG_IMAGE_HASH		= 2 << 3 | 2
+
+# a delta point is encoded as tag 22, length and up to three float32 fields (zero
+# fields are omitted) tagged 0d (dx), 15 (dy) and 1d (weight); typically all three
+# are present, making a 17 byte record 22 0f 0d <dx> 15 <dy> 1d <weight>
+DP_RECORD_SIZE = 17
+DP_RECORD_BYTES = ( ( 0, b'\x22' ), ( 1, b'\x0f' ), ( 2, b'\x0d' ), ( 7, b'\x15' ), ( 12, b'\x1d' ) )
+
+def read_varint( data, pos ) :
+	"""
+	bytes		data		protobuf wire format
+	int			pos			position of a varint
+
+	int			value		value of the varint
+	int			pos			position after the varint
+	"""
+	value = 0
+	shift = 0
+	while True :
+		b = data[pos]
+		pos += 1
+		value |= ( b & 0x7f ) << shift
+		if b < 0x80 :
+			return value, pos
+		shift += 7
+
+def skip_field( data, pos, tag ) :
+	"""
+	return the position after the value of a field with the given tag
+	"""
+	match tag & 7 :
+		case 0 :
+			return read_varint( data, pos )[1]
+		case 1 :
+			return pos + 8
+		case 2 :
+			length, pos = read_varint( data, pos )
+			return pos + length
+		case 5 :
+			return pos + 4
+		case _ :
+			raise ValueError( f'unsupported wire type {tag & 7}' )
+
+def decode_page_deltas( data ) :
+	"""
+	walk the protobuf wire format of an SN_Page (see squidnote_page.proto) and
+	decode the delta points of all strokes into a single array, without creating
+	an SN_DP message (let alone Python floats) for each point: the delta points
+	of a stroke are located either in C, as a run of 17 byte records (by comparing
+	every 17th byte of the stroke), or else by following the record lengths; their
+	fields are then checked and read with numpy in one go, through a float32 view
+	of the page at every byte offset
+
+	bytes		data		protobuf wire format of a page
+
+	[dict]		strokes		for each layer, item index -> (first,count) delta points of stroke items
+	ndarray		deltas		(dx,dy,weight) of all delta points, float64 (None if there are none)
+	"""
+	runs = []		# (position,first,count) of runs of 17 byte records
+	sequences = []	# (first,count) of other sequences of records
+	starts = []		# positions of the records of these sequences
+	total = 0
+	layers = []
+
+	end = len( data )
+	pos = 0
+	while pos < end :
+		tag, pos = read_varint( data, pos )
+		if tag != TAG_PAGE_LAYER :
+			pos = skip_field( data, pos, tag )
+			continue
+		length, pos = read_varint( data, pos )
+		layer_end = pos + length
+		strokes = {}
+		item = 0
+		while pos < layer_end :
+			tag, pos = read_varint( data, pos )
+			if tag != TAG_LAYER_ITEM :
+				pos = skip_field( data, pos, tag )
+				continue
+			length, pos = read_varint( data, pos )
+			item_end = pos + length
+			while pos < item_end :
+				tag, pos = read_varint( data, pos )
+				if tag != TAG_ITEM_STROKE :
+					pos = skip_field( data, pos, tag )
+					continue
+				length, pos = read_varint( data, pos )
+				stroke_end = pos + length
+				if item in strokes :
+					# a stroke field merged into an earlier one, leave that to protobuf
+					raise ValueError( 'repeated stroke field' )
+				first = total
+				while pos < stroke_end :
+					if data[pos] != TAG_STROKE_DELTA :
+						tag, pos = read_varint( data, pos )
+						pos = skip_field( data, pos, tag )
+						continue
+					# number of complete 17 byte records in a row
+					n = ( stroke_end - pos ) // DP_RECORD_SIZE
+					for offset, value in DP_RECORD_BYTES :
+						if n :
+							# (a copy if data is a memoryview, which has no lstrip)
+							column = bytes( data[pos + offset : stroke_end : DP_RECORD_SIZE] )
+							n = min( n, len( column ) - len( column.lstrip( value ) ) )
+					run_end = pos + n * DP_RECORD_SIZE
+					if n and ( run_end == stroke_end or data[run_end] != TAG_STROKE_DELTA ) :
+						runs.append( ( pos, total, n ) )
+						total += n
+						pos = run_end
+						continue
+					# follow the lengths of the records, they are checked below
+					count = len( starts )
+					while pos < stroke_end and data[pos] == TAG_STROKE_DELTA :
+						starts.append( pos )
+						pos += 2 + data[pos + 1]
+					sequences.append( ( total, len( starts ) - count ) )
+					total += len( starts ) - count
+				if pos != stroke_end :
+					raise ValueError( 'truncated stroke' )
+				strokes[item] = ( first, total - first )
+			item += 1
+		layers.append( strokes )
+
+	if not total :
+		return layers, None
+	import_lazily( NUMPY_LIBS )
+	a = np.frombuffer( data, dtype=np.uint8 )
+	# (unaligned) float32 starting at each byte of the page
+	f = np.ndarray( shape=( len( data ) - 3, ), dtype='<f4', buffer=data, strides=( 1, ) )
+	deltas = np.zeros( ( total, 3 ), dtype=np.float64 )
+	if runs :
+		( positions, run_firsts, counts ) = ( np.array( c, dtype=np.intp ) for c in zip( *runs ) )
+		within = np.arange( counts.sum( ) ) - np.repeat( np.cumsum( counts ) - counts, counts )
+		records = np.repeat( positions, counts ) + DP_RECORD_SIZE * within
+		index = np.repeat( run_firsts, counts ) + within
+		for column, offset in enumerate( ( 3, 8, 13 ) ) :
+			deltas[index, column] = f[records + offset]
+	if sequences :
+		starts = np.array( starts, dtype=np.intp )
+		lengths = a[starts + 1].astype( np.intp )
+		( firsts, counts ) = ( np.array( c, dtype=np.intp ) for c in zip( *sequences ) )
+		index = np.repeat( firsts, counts ) + np.arange( len( starts ) ) - np.repeat( np.cumsum( counts ) - counts, counts )
+		# field tag -> column: 0d -> 0 (dx), 15 -> 1 (dy), 1d -> 2 (weight)
+		columns = np.full( 256, -1, dtype=np.intp )
+		columns[ [ 0x0d, 0x15, 0x1d ] ] = [ 0, 1, 2 ]
+		if np.any( ( lengths % 5 != 0 ) | ( lengths > 15 ) ) :
+			# e.g. unknown fields in the delta point, leave that to protobuf
+			raise ValueError( 'unexpected delta point encoding' )
+		# a repeated field overrides earlier ones, as it does in protobuf
+		for k in range( 3 ) :
+			present = lengths > 5 * k
+			fields = starts[present] + 2 + 5 * k
+			field_columns = columns[ a[fields] ]
+			if np.any( field_columns < 0 ) :
+				raise ValueError( 'unexpected delta point encoding' )
+			deltas[ index[present], field_columns ] = f[fields + 1]
+	return layers, deltas
+
+def layer_deltas( strokes, items, deltas ) :
+	"""
+	gather the delta points of some of the stroke items of a layer
+
+	dict		strokes		item index -> (first,count), see decode_page_deltas()
+	[int]		items		indices of the stroke items
+	ndarray		deltas		delta points of the page
+
+	(ndarray,ndarray)	layer_deltas	number of delta points of each stroke, their delta points
+	"""
+	spans = np.array( [ strokes[i] for i in items ], dtype=np.intp ).reshape( -1, 2 )
+	( firsts, counts ) = ( spans[:, 0], spans[:, 1] )
+	index = np.arange( counts.sum( ) ) + np.repeat( firsts - ( np.cumsum( counts ) - counts ), counts )
+	return counts, deltas[index]
+
 ########################################
 def check_for_unknown_fields( msg, indt='>>' ) :
 	"""
@@ -224,7 +1281,1152 @@ def check_for_unknown_fields( msg, indt='>>' ) :
 			pass
 
 ########################################
-def generate_xournal_xml_doc( sn, xopp_doc, xopp_file, dry_run, stroke_scale, highlight_scale, image_dpi ) :
+class LRUCache :
+	"""
+	least recently used cache with a memory budget; entries are evicted,
+	least recently used first, once their total size exceeds the budget
+
+	string		name		name used when reporting hit / miss counts
+	int			budget		memory budget in bytes
+	"""
+	def __init__( self, name, budget ) :
+		self.name = name
+		self.budget = budget
+		self.entries = {}		# dict preserves insertion order: oldest entry first
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock( )
+
+	def get( self, key ) :
+		with self.lock :
+			entry = self.entries.pop( key, None )
+			if entry is None :
+				self.misses += 1
+				return None
+			# re-insert to mark as most recently used
+			self.entries[key] = entry
+			self.hits += 1
+			return entry[0]
+
+	def put( self, key, value, nbytes ) :
+		if nbytes > self.budget :
+			return
+		with self.lock :
+			old = self.entries.pop( key, None )
+			if old is not None :
+				self.nbytes -= old[1]
+			self.entries[key] = ( value, nbytes )
+			self.nbytes += nbytes
+			while self.nbytes > self.budget :
+				( _, n ) = self.entries.pop( next( iter( self.entries ) ) )
+				self.nbytes -= n
+
+	def report( self, since=( 0, 0 ) ) :
+		mprint( f'{self.name} cache: {self.hits - since[0]} hits, {self.misses - since[1]} misses' )
+
+def init_image_caches( megabytes ) :
+	"""
+	create the image caches, each with a memory budget of the given size
+
+	int		megabytes		memory budget of each cache in MB
+	"""
+	ctx = context( )
+
+	ctx.decoded_image_cache = LRUCache( 'Decoded image', megabytes * 2**20 )
+	ctx.encoded_image_cache = LRUCache( 'Encoded image', megabytes * 2**20 )
+	ctx.image_caches = ( ctx.decoded_image_cache, ctx.encoded_image_cache )
+
+########################################
+def image_header( data ) :
+	"""
+	get the format and size of a PNG or JPEG image from its header, without decoding it
+
+	bytes				data		encoded image
+
+	(str,int,int,int)	header		( format, width, height, channels ), None if not recognised
+	"""
+	if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR' :
+		( width, height, depth, colour_type ) = struct.unpack( '>IIBB', data[16:26] )
+		channels = { 0:1, 2:3, 3:3, 4:2, 6:4 }.get( colour_type, 0 )
+		return ( 'png', width, height, channels )
+	if data[:2] == b'\xff\xd8' :
+		# walk the JPEG markers up to the start of frame (SOFn) segment
+		pos = 2
+		while pos + 4 <= len( data ) :
+			if data[pos] != 0xff :
+				return None
+			marker = data[pos+1]
+			if marker == 0xff :
+				pos += 1
+			elif marker == 0x01 or 0xd0 <= marker <= 0xd8 :
+				pos += 2
+			elif 0xc0 <= marker <= 0xcf and marker not in ( 0xc4, 0xc8, 0xcc ) :
+				( height, width, channels ) = struct.unpack( '>HHB', data[pos+5:pos+10] )
+				return ( 'jpeg', width, height, channels )
+			else :
+				pos += 2 + struct.unpack( '>H', data[pos+2:pos+4] )[0]
+	return None
+
+########################################
+def decode_image( sn, image_hash, reduction=1 ) :
+	"""
+	read and decode an embedded image, optionally at reduced size; only JPEG
+	images are decoded at reduced size, others are always decoded at full size
+
+	ZipFile		sn			squidnote ZIp archive handle
+	string		image_hash	name of the image file in data/imgs
+	int			reduction	requested size reduction, 1, 2, 4 or 8
+
+	ndarray		cvimg		decoded image
+	int			reduction	size reduction actually applied
+	"""
+	ctx = context( )
+
+	cvimg = ctx.decoded_image_cache.get( ( image_hash, reduction ) )
+	if cvimg is not None :
+		return cvimg, reduction
+
+	name = 'data/imgs/' + image_hash
+	with timed( 'image_read' ) :
+		img = read_member( sn, name )
+
+	header = image_header( img )
+	if reduction > 1 and ( header is None or header[0] != 'jpeg' ) :
+		ctx.image_reducible[image_hash] = False
+		reduction = 1
+		cvimg = ctx.decoded_image_cache.get( ( image_hash, reduction ) )
+		if cvimg is not None :
+			return cvimg, reduction
+
+	decode_start = time.perf_counter( )
+	npimg = np.frombuffer( img, dtype=np.uint8 )
+	if reduction > 1 :
+		# IMREAD_REDUCED_* modes apply EXIF orientation unless explicitly told not to
+		if header[3] == 1 :
+			flags = { 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8 }[reduction]
+		else :
+			flags = { 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8 }[reduction]
+		cvimg = cv2.imdecode(npimg, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+	else :
+		# use IMREAD_UNCHANGED instead of IMREAD_COLOR to ignore EXIF orientation (as does squidnote)
+		cvimg = cv2.imdecode(npimg, cv2.IMREAD_UNCHANGED)
+	if ctx.metrics is not None :
+		ctx.metrics.add_time( 'image_decode', time.perf_counter( ) - decode_start )
+		ctx.metrics.count( 'image_decoded_pixels', cvimg.shape[0] * cvimg.shape[1] )
+	ctx.decoded_image_cache.put( ( image_hash, reduction ), cvimg, cvimg.nbytes )
+	return cvimg, reduction
+
+########################################
+def transform_image( cvimg, reduction, crop_bounds, flip_x, flip_y, rotation, x_scale, y_scale ) :
+	"""
+	crop, flip, rotate (by any angle, clockwise) and scale an image in a single
+	cv2.warpAffine resampling pass, i.e. with one output allocation instead of
+	one per step; the crop is a numpy view of the decoded image, so edge pixels
+	are replicated exactly as the former crop / flip / rotate / resize chain did
+
+	unscaled right angle transforms are pure pixel permutations and are done
+	with (at most two) cv2 flip / rotate / transpose calls instead
+
+	the result has the same size as that of the former chain; pixel values
+	match it exactly for unscaled right angle transforms and otherwise differ
+	by the rounding of warpAffine's 1/32 pixel interpolation grid (at most one
+	grey level on smooth images, see tests/test_transform_image.py)
+
+	ndarray			cvimg		decoded image
+	int				reduction	size reduction the image was decoded at
+	(int,int,int,int)	crop_bounds	(left,right,top,bottom) crop at full resolution
+	bool			flip_x		flip upside down
+	bool			flip_y		flip left to right
+	int				rotation	clockwise rotation in degrees
+	float			x_scale		horizontal scale applied after rotation
+	float			y_scale		vertical scale applied after rotation
+
+	ndarray			cvimg		transformed image
+	"""
+	( cl, cr, ct, cb ) = crop_bounds
+	f = reduction
+	( x0, y0 ) = ( cl // f, ct // f )
+	src = cvimg[y0:-(-cb//f), x0:-(-cr//f)]
+	( w, h ) = ( cr-cl, cb-ct )
+
+	# build the mapping in continuous coordinates (pixel i covers [i,i+1))
+	# from decoded pixels to full resolution crop coordinates
+	m = np.array( [ [ f, 0, f*x0 - cl ], [ 0, f, f*y0 - ct ], [ 0, 0, 1 ] ], dtype=np.float64 )
+	if flip_x :
+		m = np.array( [ [ 1, 0, 0 ], [ 0, -1, h ], [ 0, 0, 1 ] ] ) @ m
+	if flip_y :
+		m = np.array( [ [ -1, 0, w ], [ 0, 1, 0 ], [ 0, 0, 1 ] ] ) @ m
+
+	# clockwise rotation about the crop centre into the rotated bounding box
+	angle = rotation % 360
+	match angle :
+		case 0 :
+			( c, s ) = ( 1, 0 )
+		case 90 :
+			( c, s ) = ( 0, 1 )
+		case 180 :
+			( c, s ) = ( -1, 0 )
+		case 270 :
+			( c, s ) = ( 0, -1 )
+		case _ :
+			( c, s ) = ( math.cos( math.radians( angle ) ), math.sin( math.radians( angle ) ) )
+	rw = abs( w*c ) + abs( h*s )
+	rh = abs( w*s ) + abs( h*c )
+	m = np.array( [ [ c, -s, ( rw - c*w + s*h ) / 2 ], [ s, c, ( rh - s*w - c*h ) / 2 ], [ 0, 0, 1 ] ] ) @ m
+
+	dsize = ( max( 1, round( rw * x_scale ) ), max( 1, round( rh * y_scale ) ) )
+	if f > 1 :
+		# like the former resize of a reduced decode, stretch the image to exactly fill the
+		# rounded output size rather than leave part of a pixel at its far edges
+		( x_scale, y_scale ) = ( dsize[0] / rw, dsize[1] / rh )
+	m = np.array( [ [ x_scale, 0, 0 ], [ 0, y_scale, 0 ], [ 0, 0, 1 ] ] ) @ m
+	# warpAffine places pixel centres at integer coordinates
+	m = np.array( [ [ 1, 0, -0.5 ], [ 0, 1, -0.5 ], [ 0, 0, 1 ] ] ) @ m @ np.array( [ [ 1, 0, 0.5 ], [ 0, 1, 0.5 ], [ 0, 0, 1 ] ] )
+
+	if angle % 90 == 0 and f == 1 and ( x_scale, y_scale ) == ( 1.0, 1.0 ) :
+		# pure pixel permutation, reduce it to flips followed by an optional transpose
+		# (90 deg = transpose after upside down flip, 270 deg = after left to right flip)
+		fv = flip_x != ( angle in ( 90, 180 ) )
+		fh = flip_y != ( angle in ( 180, 270 ) )
+		if angle in ( 0, 180 ) :
+			if fv or fh :
+				return cv2.flip( src, -1 if fv and fh else 0 if fv else 1 )
+			return src.copy( )
+		if fv and fh :
+			return cv2.flip( cv2.transpose( src ), -1 )
+		if fv :
+			return cv2.rotate( src, cv2.ROTATE_90_CLOCKWISE )
+		if fh :
+			return cv2.rotate( src, cv2.ROTATE_90_COUNTERCLOCKWISE )
+		return cv2.transpose( src )
+	if angle % 90 == 0 :
+		return cv2.warpAffine( src, m[:2], dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE )
+
+	# corners uncovered by the rotated image are made transparent
+	if src.ndim == 2 or src.shape[2] == 1 :
+		src = cv2.cvtColor( src, cv2.COLOR_GRAY2BGRA )
+	elif src.shape[2] == 3 :
+		src = cv2.cvtColor( src, cv2.COLOR_BGR2BGRA )
+	return cv2.warpAffine( src, m[:2], dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0 )
+
+########################################
+def image_scales( image, image_dpi ) :
+	"""
+	crop bounds of an image item and the scale factors bringing it down to image_dpi
+
+	SN_Image	image		image item
+	int			image_dpi	target resolution
+
+	tuple		crop		(left,right,top,bottom) crop bounds in image pixels
+	float		x_scale		horizontal scale factor, at most 1
+	float		y_scale		vertical scale factor, at most 1
+	"""
+	cl = image.crop_bounds.left
+	cr = image.crop_bounds.right
+	ct = image.crop_bounds.top
+	cb = image.crop_bounds.bottom
+
+	l = 28.34645669 * image.bounds.left
+	r = 28.34645669 * image.bounds.right
+	t = 28.34645669 * image.bounds.top
+	b = 28.34645669 * image.bounds.bottom
+
+	# image_dpi
+	current_x_dpi = 72.0 * (cr-cl) / (r-l)
+	current_y_dpi = 72.0 * (cb-ct)/(b-t)
+	x_scale = min( 1.0, image_dpi / current_x_dpi )
+	y_scale = min( 1.0, image_dpi / current_y_dpi )
+	return ( cl, cr, ct, cb ), x_scale, y_scale
+
+def jpeg_reduction( x_scale, y_scale ) :
+	"""
+	decode JPEG images at 1/2, 1/4 or 1/8 size (DCT scaling) when the target
+	resolution allows it, leaving only a small residual resize
+
+	int			reduction	1, 2, 4 or 8
+	"""
+	for f in ( 8, 4, 2 ) :
+		if f * max( x_scale, y_scale ) <= 1.0 :
+			return f
+	return 1
+
+def render_image( sn, image, image_dpi ) :
+	"""
+	read and decode an embedded image, crop, flip, rotate and scale it down
+	to image_dpi in one pass and encode it as base64 PNG; decoded images and the final
+	base64 strings are cached, so repeated placements of the same image are cheap
+
+	ZipFile		sn			squidnote ZIp archive handle
+	SN_Image	image		image item
+	int			image_dpi	target resolution
+
+	bytes		b64_string	base64 encoded PNG image
+	"""
+	ctx = context( )
+
+	import_lazily( IMAGE_LIBS )
+	( ( cl, cr, ct, cb ), x_scale, y_scale ) = image_scales( image, image_dpi )
+
+	key = ( image.image_hash, ( cl, cr, ct, cb ), image.flip_x, image.flip_y, image.rotation, x_scale, y_scale )
+	b64_string = ctx.encoded_image_cache.get( key )
+	if b64_string is not None :
+		return b64_string
+
+	reduction = 1
+	if ctx.image_reducible.get( image.image_hash, True ) :
+		reduction = jpeg_reduction( x_scale, y_scale )
+	cvimg, reduction = decode_image( sn, image.image_hash, reduction )
+
+	with timed( 'image_transform' ) :
+		cvimg = transform_image( cvimg, reduction, ( cl, cr, ct, cb ), image.flip_x, image.flip_y, image.rotation, x_scale, y_scale )
+	with timed( 'image_encode' ) :
+		enc_img = cv2.imencode('.png', cvimg)
+	with timed( 'image_base64' ) :
+		b64_string = base64.encodebytes( enc_img[1] )
+	if ctx.metrics is not None :
+		ctx.metrics.count( 'images_rendered' )
+		ctx.metrics.count( 'image_png_bytes', len( enc_img[1] ) )
+		ctx.metrics.count( 'image_base64_bytes', len( b64_string ) )
+
+	ctx.encoded_image_cache.put( key, b64_string, len( b64_string ) )
+	return b64_string
+
+########################################
+def start_image_threads( threads, max_in_flight ) :
+	"""
+	render images on a pool of threads (cv2 releases the GIL while decoding,
+	transforming and encoding) while the main thread carries on serialising
+	strokes; at most max_in_flight images are queued or being rendered
+
+	int		threads			number of image threads, 0 to render images synchronously
+	int		max_in_flight	maximum number of images queued or being rendered
+	"""
+	ctx = context( )
+
+	ctx.image_thread_options = ( threads, max_in_flight )
+	if threads > 0 :
+		ctx.image_pool = futures.ThreadPoolExecutor( max_workers=threads, thread_name_prefix='image', initializer=conversion_context.set, initargs=( ctx, ) )
+		ctx.image_slots = threading.BoundedSemaphore( max( threads, max_in_flight ) )
+
+def submit_image( sn, image, image_dpi ) :
+	"""
+	render an image in the background if image threads are enabled
+
+	bytes | Future	b64_string	base64 encoded PNG image, or its future
+	"""
+	ctx = context( )
+
+	if ctx.image_pool is None :
+		return render_image( sn, image, image_dpi )
+
+	# the page (and with it the image item) may be gone by the time the image is rendered
+	image_copy = SNP.SN_Image( )
+	image_copy.CopyFrom( image )
+	ctx.image_slots.acquire( )
+	future = ctx.image_pool.submit( render_image, sn, image_copy, image_dpi )
+	future.add_done_callback( lambda f : ctx.image_slots.release( ) )
+	return future
+
+########################################
+def parse_page( sn, page_number, page_id, data=None ) :
+	"""
+	parse the protobuf page file of a single page and, unless disabled (-F), decode
+	the delta points of all its strokes in one go
+
+	ZipFile		sn				squidnote ZIp archive handle
+	int			page_number		position of the page in the document
+	string		page_id			name of the protobuf page file
+	bytes		data			content of the page file if already read (optional)
+
+	int			ret_val			number of items parsed
+	SN_Page		page			object containing all page components
+	tuple		decoded			decode_page_deltas() result (None if not decoded)
+	"""
+	ctx = context( )
+
+	# extract from ZIP archive and parse page file
+	if data is None :
+		data = read_member( sn, 'data/pages/' + page_id + '.page' )
+	ret_val, page = parse_page_file( sn, page_id, data )
+
+	decoded = None
+	if ctx.fast_deltas :
+		with timed( 'delta_decode' ) :
+			try :
+				decoded = decode_page_deltas( data )
+			except ( ValueError, IndexError, struct.error ) as e :
+				mprint( f'Could not decode delta points of page {page_number} ({e}), using protobuf messages', colour=CYELLOW )
+	if ctx.log_level >= LOG_DETAIL :
+		mprint( f'Parsed {ret_val} objects for page {page_number}', colour=CGREEN )
+	return ret_val, page, decoded
+
+########################################
+# how page background types are converted: to a plain background of the page
+# colour ('solid'), the same but reported as such ('replaced', Xournal++ has no
+# equivalent), or to a page of the background PDF ('pdf'); unknown types give
+# a white A4 page
+BACKGROUND_KINDS = {
+	'SN_BT_BLANK':		'solid',
+	'SN_BT_UNDEFINED':	'replaced',
+	'SN_BT_RULEDPAPER':	'replaced',
+	'SN_BT_QUADPAPER':	'replaced',
+	'SN_BT_PDF':		'pdf',
+	'SN_BT_PAPYR':		'replaced',
+}
+
+def page_header( background, pdf_id ) :
+	"""
+	generate the opening <page> tag and the <background> element of a page
+
+	SN_Background	background	page background
+	string			pdf_id		name of the background PDF (or None)
+
+	bytes			header		XML (ASCII)
+	"""
+	names = { v : k for k, v in SNP.SN_Background_Type.items( ) }
+	kind = BACKGROUND_KINDS.get( names.get( background.type ) )
+	if kind is None :
+		mprint( f'Unhandled unknown page background type {background.type} replaced by A4 background' , colour=CYELLOW)
+		( width, height, colour ) = ( 21.0, 29.7, 0xffffffff )
+	else :
+		if kind == 'replaced' :
+			mprint( f'Page background type {background.type} ({names[background.type]}) replaced by blank background', colour=CYELLOW )
+		( width, height, colour ) = ( background.width, background.height, background.colour )
+
+	header = b'<page width="%.3f" height="%.3f">' % ( 28.34645669 * width, 28.34645669 * height )
+	if kind == 'pdf' :
+# it seems xournal wants the filename specified in each <page> entry...
+		return header + b'<background type="pdf" domain="attach" filename="%s.pdf" pageno="%d"/>' % ( str( pdf_id ).encode( ), background.pdf.page_number + 1 )
+	return header + b'<background type="solid" color="%s" style="plain"/>' % colour_hex( colour )
+
+def generate_page_xml( sn, xopp_doc, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi, data=None, parsed=None ) :
+	"""
+	parse the protobuf page file of a single page and generate its <page> section
+
+	ZipFile		sn				squidnote ZIp archive handle
+	XoppStream	xopp_doc		stream (or any object with write()) for collecting XML bits
+	int			page_number		position of the page in the document
+	string		page_id			name of the protobuf page file
+	string		pdf_id			name of the background PDF (or None)
+	bytes		data			content of the page file if already read (optional)
+	tuple		parsed			parse_page() result if already parsed (optional)
+	"""
+	ctx = context( )
+
+	# generate <page> section of the XML file
+	if ctx.log_level >= LOG_DETAIL :
+		mprint( f'Generating XML page description for page {page_number:d}' )
+
+	if parsed is None :
+		parsed = parse_page( sn, page_number, page_id, data )
+	ret_val, page, decoded_page = parsed
+	decoded_layers, decoded_deltas = ( None, None ) if decoded_page is None else decoded_page
+
+	# check that our protocol buffer specification is correct and we are not missing any fields
+#		check_for_unknown_fields( page )
+
+	# generate page background section of XML file
+	xopp_doc.write( page_header( page.background, pdf_id ) )
+
+	# generate <layer> section(s) of the XMl file
+	# unhandled items are reported once per page (by kind), not one by one
+	unhandled = collections.Counter( )
+	for il, lr in enumerate( page.layer ) :
+		xopp_doc.write( b'<layer>' )
+		# serialise all pen / highlighter strokes of the layer in one batch
+		layer_items = [ ii for ii, im in enumerate( lr.item ) if im.type == SNP.SN_Item_Type.SN_IT_STROKE
+			and im.stroke.type in ( SNP.SN_Stroke_Type.SN_ST_NORMAL, SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT ) ]
+		layer_strokes = [ lr.item[ii].stroke for ii in layer_items ]
+		decoded = None
+		if layer_strokes and decoded_layers is not None and il < len( decoded_layers ) and all( ii in decoded_layers[il] for ii in layer_items ) :
+			decoded = layer_deltas( decoded_layers[il], layer_items, decoded_deltas )
+		with timed( 'strokes' ) :
+			strokes = iter( render_strokes( layer_strokes, stroke_scale, highlight_scale, decoded ) )
+		if ctx.metrics is not None :
+			ctx.metrics.count( 'strokes', len( layer_strokes ) )
+			ctx.metrics.count( 'points', sum( len( s.delta ) + 1 for s in layer_strokes ) )
+			names = { v : k[6:].lower( ) for k, v in SNP.SN_Item_Type.items( ) }
+			for item_type, n in collections.Counter( im.type for im in lr.item ).items( ) :
+				ctx.metrics.count( 'items_' + names.get( item_type, 'unknown' ), n )
+		for ii, im in enumerate( lr.item ) :
+			match im.type :
+				case SNP.SN_Item_Type.SN_IT_STROKE :
+					match im.stroke.type :
+						case SNP.SN_Stroke_Type.SN_ST_NORMAL :
+							xopp_doc.write( next( strokes ) )
+						case SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT :
+							xopp_doc.write( next( strokes ) )
+						case SNP.SN_Stroke_Type.SN_ST_UNDEFINED :
+							unhandled[ f'Unhandled stroke type {im.stroke.type} (SN_ST_UNDEFINED)' ] += 1
+							if ctx.log_level >= LOG_DETAIL :
+								mprint( f'Unhandled stroke type {im.stroke.type} (SN_ST_UNDEFINED)', colour=CYELLOW )
+						case SNP.SN_Stroke_Type.SN_ST_LINE :
+							unhandled[ f'Unhandled stroke type {im.stroke.type} (SN_ST_LINE)' ] += 1
+							if ctx.log_level >= LOG_DETAIL :
+								mprint( f'Unhandled stroke type {im.stroke.type} (SN_ST_LINE)', colour=CYELLOW )
+						case SNP.SN_Stroke_Type.SN_ST_SMOOTH :
+							unhandled[ f'Unhandled stroke type {im.stroke.type} (SN_ST_SMOOTH)' ] += 1
+							if ctx.log_level >= LOG_DETAIL :
+								mprint( f'Unhandled stroke type {im.stroke.type} (SN_ST_SMOOTH)', colour=CYELLOW )
+						case _  :
+							unhandled[ f'Unhandled unknown stroke type {im.stroke.type}' ] += 1
+							if ctx.log_level >= LOG_DETAIL :
+								mprint( f'Unhandled unknown stroke type {im.stroke.type}' )
+				case SNP.SN_Item_Type.SN_IT_UNDEFINED :
+					unhandled[ f'Unhandled item type {im.type} (SN_IT_UNDEFINED)' ] += 1
+					if ctx.log_level >= LOG_DETAIL :
+						mprint( f'Unhandled item type {im.type} (SN_IT_UNDEFINED) at position {il}', colour=CYELLOW )
+				case SNP.SN_Item_Type.SN_IT_SHAPE :
+					unhandled[ f'Unhandled item type {im.type} (SN_IT_SHAPE)' ] += 1
+					if ctx.log_level >= LOG_DETAIL :
+						mprint( f'Unhandled item type {im.type} (SN_IT_SHAPE) at position {il}', colour=CYELLOW )
+				case SNP.SN_Item_Type.SN_IT_TEXT :
+					unhandled[ f'Unhandled item type {im.type} (SN_IT_TEXT)' ] += 1
+					if ctx.log_level >= LOG_DETAIL :
+						mprint( f'Unhandled item type {im.type} (SN_IT_TEXT) at position {il}', colour=CYELLOW )
+				case SNP.SN_Item_Type.SN_IT_IMAGE :
+					l = 28.34645669 * im.image.bounds.left
+					r = 28.34645669 * im.image.bounds.right
+					t = 28.34645669 * im.image.bounds.top
+					b = 28.34645669 * im.image.bounds.bottom
+
+					xopp_doc.write( b'<image left="%.3f" top="%.3f" right="%.3f" bottom="%.3f">\n' % ( l, t, r, b ) )
+
+					xopp_doc.write( submit_image( sn, im.image, image_dpi ) )
+					xopp_doc.write( b'</image>\n' )
+					if ctx.log_level >= LOG_DETAIL :
+						mprint( f'Inserted image from file data/imgs/{im.image.image_hash}' )
+
+				case _ :
+					unhandled[ f'Unhandled unknown item type {im.type}' ] += 1
+					if ctx.log_level >= LOG_DETAIL :
+						mprint( f'Unhandled unknown item type {im.type} at position {il}', colour=CYELLOW )
+
+		xopp_doc.write( b'</layer>\n' )
+		if ctx.log_level >= LOG_DETAIL :
+			mprint( f'Completed page {page_number} / layer {il}', colour=CGREEN )
+
+	for kind, n in unhandled.items( ) :
+		mprint( f'{kind}: {n} item(s) skipped on page {page_number}', colour=CYELLOW )
+
+	xopp_doc.write( b'</page>\n' )
+	if ctx.log_level >= LOG_DETAIL :
+		mprint( f'Completed XML generation for page {page_number}', colour=CGREEN )
+
+########################################
+def referenced_images( sn, data ) :
+	"""
+	find the images a page file refers to without parsing it: images are referenced
+	by name from the image_hash field of SN_Image, so the page is scanned once for
+	the tag and length of this field for each distinct name length, and the string
+	following each match is looked up among the image names (collected once per
+	archive)
+
+	ZipFile		sn			squidnote ZIp archive handle
+	bytes		data		content of the page file (or a memoryview of it)
+
+	[ZipInfo]	images		members of the images referred to, by name
+	"""
+	names = getattr( sn, 'image_names', None )
+	if names is None :
+		# tag and varint length -> { name : member } of the images with names of that length
+		names = {}
+		for info in sn.infolist( ) :
+			if info.filename.startswith( 'data/imgs/' ) :
+				name = info.filename[10:].encode( )
+				( prefix, n ) = ( bytearray( [ TAG_IMAGE_HASH ] ), len( name ) )
+				while n > 0x7f :
+					prefix.append( n & 0x7f | 0x80 )
+					n >>= 7
+				prefix.append( n )
+				names.setdefault( bytes( prefix ), {} )[name] = info
+		sn.image_names = names
+
+	found = {}
+	for prefix, members in names.items( ) :
+		length = len( next( iter( members ) ) )
+		for m in re.finditer( re.escape( prefix ), data ) :
+			info = members.get( bytes( data[m.end( ) : m.end( ) + length] ) )
+			if info is not None :
+				found[info.filename] = info
+	return [ found[name] for name in sorted( found ) ]
+
+# bump whenever the XML generated for a page changes, to invalidate cached fragments
+FRAGMENT_CACHE_VERSION = 2
+
+class FragmentCache :
+	"""
+	on-disk cache of the XML fragments of converted pages, keyed by a hash of
+	everything the fragment depends on: the page file, the images it refers to,
+	the background PDF name and the conversion options; files are written
+	atomically, so the cache can be shared by concurrent conversions, and the
+	least recently used fragments are evicted once the cache exceeds its budget
+
+	string		directory	cache directory
+	int			budget		maximum total size of cached fragments in bytes
+	"""
+	def __init__( self, directory, budget ) :
+		self.directory = directory
+		self.budget = budget
+		self.hits = 0
+		self.misses = 0
+		self.name = 'Page fragment'
+		os.makedirs( directory, exist_ok=True )
+
+	def key( self, sn, data, pdf_id, stroke_scale, highlight_scale, image_dpi ) :
+		"""
+		ZipFile		sn			squidnote ZIp archive handle
+		bytes		data		content of the page file
+
+		string		key			hex digest identifying the page fragment
+		"""
+		h = hashlib.sha256( )
+		h.update( repr( ( FRAGMENT_CACHE_VERSION, pdf_id, stroke_scale, highlight_scale, image_dpi, context( ).simplify_tolerance ) ).encode( ) )
+		h.update( data )
+		for info in referenced_images( sn, data ) :
+			h.update( f'{info.filename}:{info.CRC:08x}:{info.file_size}'.encode( ) )
+		return h.hexdigest( )
+
+	def path( self, key ) :
+		return os.path.join( self.directory, key[:2], key )
+
+	def get( self, key ) :
+		try :
+			with open( self.path( key ), 'rb' ) as f :
+				fragment = f.read( )
+			# mark as recently used
+			os.utime( self.path( key ) )
+			self.hits += 1
+			return fragment
+		except OSError :
+			self.misses += 1
+			return None
+
+	def put( self, key, fragment ) :
+		path = self.path( key )
+		os.makedirs( os.path.dirname( path ), exist_ok=True )
+		( fd, tmp_path ) = tempfile.mkstemp( dir=os.path.dirname( path ), prefix='.tmp' )
+		with os.fdopen( fd, 'wb' ) as f :
+			f.write( fragment )
+		os.replace( tmp_path, path )
+
+	def evict( self ) :
+		"""
+		delete the least recently used fragments until the cache fits its budget
+		"""
+		evict_lru_files( glob.glob( os.path.join( self.directory, '??', '*' ) ), self.budget )
+
+	def report( self, since=( 0, 0 ) ) :
+		mprint( f'{self.name} cache: {self.hits - since[0]} hits, {self.misses - since[1]} misses' )
+
+def evict_lru_files( paths, budget ) :
+	"""
+	delete the least recently used (modified or touched) files until their total size fits the budget
+
+	[str]		paths		candidate files
+	int			budget		maximum total size in bytes
+	"""
+	entries = []
+	for path in paths :
+		try :
+			st = os.stat( path )
+			entries.append( ( st.st_mtime, st.st_size, path ) )
+		except OSError :
+			pass
+	total = sum( e[1] for e in entries )
+	for ( mtime, size, path ) in sorted( entries ) :
+		if total <= budget :
+			break
+		try :
+			os.remove( path )
+		except OSError :
+			pass
+		total -= size
+
+########################################
+def stream_member( sn, info, dest ) :
+	"""
+	extract a ZIP archive member in fixed-size chunks via a temporary file
+	that atomically replaces dest (zipfile verifies the CRC on the way)
+
+	ZipFile		sn			squidnote ZIp archive handle
+	ZipInfo		info		archive member
+	string		dest		destination filename
+	"""
+	# not mkstemp(), which would ignore the umask
+	tmp_path = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+	with open( tmp_path, 'xb' ) as f :
+		# only clean up the temporary file this call created
+		try :
+			with sn.open( info ) as src :
+				shutil.copyfileobj( src, f, 1 << 20 )
+			f.close( )
+			os.replace( tmp_path, dest )
+		except BaseException :
+			with contextlib.suppress( FileNotFoundError ) :
+				os.remove( tmp_path )
+			raise
+
+def file_crc( path ) :
+	"""
+	CRC-32 of a file, read in fixed-size chunks
+	"""
+	crc = 0
+	with open( path, 'rb' ) as f :
+		while chunk := f.read( 1 << 20 ) :
+			crc = zlib.crc32( chunk, crc )
+	return crc
+
+def same_content( path, info ) :
+	"""
+	check (by size and CRC-32) whether a file has the content of a ZIP archive member
+	"""
+	try :
+		return os.path.getsize( path ) == info.file_size and file_crc( path ) == info.CRC
+	except OSError :
+		return False
+
+class PdfStore :
+	"""
+	content-addressed store of background PDFs shared by all notebooks and runs:
+	each PDF is extracted once into the store, named after the CRC-32 and size
+	recorded in the ZIP archive (so no data needs to be read to look it up), and
+	hardlinked to its destination; destinations that already link to the stored
+	file are left alone, so reruns and notebooks sharing a handout do (almost) no
+	extraction I/O; stored files are read-only, as they may be linked from many places
+
+	string		directory	store directory
+	int			budget		maximum total size of stored PDFs in bytes
+	"""
+	def __init__( self, directory, budget ) :
+		self.directory = directory
+		self.budget = budget
+		self.hits = 0
+		self.misses = 0
+		self.name = 'Background PDF store'
+		self.lock = threading.Lock( )
+		os.makedirs( directory, exist_ok=True )
+
+	def extract( self, sn, info, dest ) :
+		"""
+		ZipFile		sn			squidnote ZIp archive handle
+		ZipInfo		info		archive member of the PDF
+		string		dest		destination filename
+
+		string		action		what was done: 'unchanged', 'linked' or 'copied'
+		"""
+		stored = os.path.join( self.directory, f'{info.CRC:08x}-{info.file_size}.pdf' )
+		# a stored file of the wrong size (truncated, or edited through one of its links) is extracted again
+		if os.path.exists( stored ) and os.path.getsize( stored ) == info.file_size :
+			with self.lock :
+				self.hits += 1
+			# mark as recently used
+			os.utime( stored )
+		else :
+			with self.lock :
+				self.misses += 1
+			stream_member( sn, info, stored )
+			os.chmod( stored, 0o444 )
+
+		if os.path.exists( dest ) and os.path.samefile( stored, dest ) :
+			return 'unchanged'
+		tmp_path = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+		try :
+			os.link( stored, tmp_path )
+			os.replace( tmp_path, dest )
+			return 'linked'
+		except OSError :
+			# e.g. destination on another file system
+			if os.path.exists( tmp_path ) :
+				os.remove( tmp_path )
+		if same_content( dest, info ) :
+			return 'unchanged'
+		stream_member( sn, info, dest )
+		return 'copied'
+
+	def evict( self ) :
+		evict_lru_files( glob.glob( os.path.join( self.directory, '*.pdf' ) ), self.budget )
+
+	def report( self, since=( 0, 0 ) ) :
+		mprint( f'{self.name}: {self.hits - since[0]} hits, {self.misses - since[1]} misses' )
+
+def init_disk_caches( settings ) :
+	"""
+	enable the page fragment cache and the background PDF store
+
+	(str,int)	settings	cache directory and budget (of each) in MB, None to disable the caches
+	"""
+	ctx = context( )
+
+	if settings is None :
+		ctx.fragment_cache = ctx.pdf_store = None
+	else :
+		ctx.fragment_cache = FragmentCache( settings[0], settings[1] * 2**20 )
+		ctx.pdf_store = PdfStore( os.path.join( settings[0], 'pdfs' ), settings[1] * 2**20 )
+
+########################################
+def extract_background_pdf( sn, pdf_id, xopp_file ) :
+	"""
+	extract a background PDF next to the Xournal++ document, via the PDF store
+	if enabled, else directly unless the destination is already up to date
+
+	ZipFile		sn			squidnote ZIp archive handle
+	string		pdf_id		name of the PDF in data/docs
+	string		xopp_file	xopp document filename (used for naming background PDFs)
+	"""
+	ctx = context( )
+
+	src = "data/docs/" + pdf_id
+	dest = xopp_file + '.' + pdf_id + '.pdf'
+	try :
+		info = sn.getinfo( src )
+		if ctx.pdf_store is not None :
+			action = ctx.pdf_store.extract( sn, info, dest )
+		elif same_content( dest, info ) :
+			action = 'unchanged'
+		else :
+			stream_member( sn, info, dest )
+			action = 'copied'
+		mprint( f'Extracted background PDF from "data/docs" to "{dest}" ({action})', colour=CGREEN )
+	except Exception as e :
+		mprint( f'Failed to extract background PDF from "data/docs" to "{dest}": {e}', colour=CRED )
+
+def extract_background_pdfs( sn, pdf_ids, xopp_file ) :
+	"""
+	extract background PDFs concurrently
+	"""
+	ctx = context( )
+
+	pdf_ids = [ pdf_id for pdf_id in pdf_ids if pdf_id ]
+	if pdf_ids :
+		with timed( 'pdf_extract' ), futures.ThreadPoolExecutor( max_workers=min( 4, len( pdf_ids ) ), initializer=conversion_context.set, initargs=( ctx, ) ) as pool :
+			list( pool.map( lambda pdf_id : extract_background_pdf( sn, pdf_id, xopp_file ), pdf_ids ) )
+	if ctx.pdf_store is not None :
+		ctx.pdf_store.evict( )
+
+def default_cache_dir( ) :
+	return os.path.join( os.environ.get( 'XDG_CACHE_HOME', os.path.expanduser( '~/.cache' ) ), 'squidnote2xopp' )
+
+def all_caches( ) :
+	"""
+	all enabled caches, for reporting hit / miss counts
+	"""
+	ctx = context( )
+
+	return ctx.image_caches + tuple( c for c in ( ctx.fragment_cache, ctx.pdf_store ) if c is not None )
+
+########################################
+def prepare_page( sn, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi, data ) :
+	"""
+	look a page up in the page fragment cache and, if it is not there, parse it
+
+	ZipFile		sn				squidnote ZIp archive handle
+	int			page_number		position of the page in the document
+	string		page_id			name of the protobuf page file
+	string		pdf_id			name of the background PDF (or None)
+	bytes		data			content of the page file
+
+	tuple		prepared		(cache key, cached fragment or None, parse_page() result or None, seconds spent)
+	"""
+	ctx = context( )
+
+	start = time.perf_counter( )
+	key = None
+	fragment = None
+	if ctx.fragment_cache is not None :
+		key = ctx.fragment_cache.key( sn, data, pdf_id, stroke_scale, highlight_scale, image_dpi )
+		fragment = ctx.fragment_cache.get( key )
+		if fragment is not None and ctx.log_level >= LOG_DETAIL :
+			mprint( f'Using cached XML page description for page {page_number:d}', colour=CGREEN )
+
+	parsed = None
+	if fragment is None :
+		parsed = parse_page( sn, page_number, page_id, data )
+	return key, fragment, parsed, time.perf_counter( ) - start
+
+def convert_page( sn, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi, data=None, prepared=None ) :
+	"""
+	generate the encoded <page> section of a single page, or fetch it from the
+	page fragment cache if the page has been converted before with the same options
+
+	ZipFile		sn				squidnote ZIp archive handle
+	int			page_number		position of the page in the document
+	string		page_id			name of the protobuf page file
+	string		pdf_id			name of the background PDF (or None)
+	bytes		data			content of the page file if already read (optional)
+	tuple		prepared		prepare_page() result if already prepared (optional)
+
+	bytes		fragment		encoded <page> section
+	"""
+	ctx = context( )
+
+	start = time.perf_counter( )
+	if ctx.metrics is not None :
+		before = { name : ctx.metrics.counters.get( name, 0 ) for name in ( 'strokes', 'points', 'items_image' ) }
+
+	if data is None :
+		data = read_member( sn, 'data/pages/' + page_id + '.page' )
+	if prepared is None :
+		# time spent preparing the page is counted from start
+		key, fragment, parsed, _ = prepare_page( sn, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi, data )
+		prepare_seconds = 0.0
+	else :
+		key, fragment, parsed, prepare_seconds = prepared
+
+	cached = fragment is not None
+	if not cached :
+		page_doc = XoppStream( )
+		generate_page_xml( sn, page_doc, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi, data, parsed )
+		fragment = page_doc.take( )
+		if key is not None :
+			ctx.fragment_cache.put( key, fragment )
+
+	if ctx.metrics is not None :
+		seconds = prepare_seconds + time.perf_counter( ) - start
+		ctx.metrics.add_time( 'page', seconds )
+		ctx.metrics.count( 'pages' )
+		ctx.metrics.count( 'xml_bytes', len( fragment ) )
+		ctx.metrics.add_page( {
+			'page':			page_number,
+			'page_id':		page_id,
+			'seconds':		seconds,
+			'cached':		cached,
+			'page_bytes':	len( data ),
+			'xml_bytes':	len( fragment ),
+			'strokes':		ctx.metrics.counters.get( 'strokes', 0 ) - before['strokes'],
+			'points':		ctx.metrics.counters.get( 'points', 0 ) - before['points'],
+			'images':		ctx.metrics.counters.get( 'items_image', 0 ) - before['items_image'],
+		} )
+	return fragment
+
+########################################
+# per process state of page conversion workers, see init_page_worker()
+worker_archive = None
+worker_options = None
+
+def init_page_worker( sn_file, worker_log_level, stroke_scale, highlight_scale, image_dpi, deflate_level, image_cache_mb, image_threads, cache_settings, metrics_settings, decode_deltas, tolerance, embedded=False ) :
+	"""
+	initialise a page conversion worker process: import libraries (in case
+	the process was spawned rather than forked) and open its own handle
+	on the squidnote archive
+	"""
+	global worker_archive, worker_options
+
+	import_libraries( exit_on_error=not embedded )
+	import_lazily( CONVERSION_LIBS, exit_on_error=not embedded )
+	# a forked worker starts off with a copy of the context of the conversion that started it
+	ctx = ConversionContext( )
+	conversion_context.set( ctx )
+	ctx.embedded = embedded
+	ctx.log_level = worker_log_level
+	ctx.fast_deltas = decode_deltas
+	ctx.simplify_tolerance = tolerance
+	init_metrics( metrics_settings )
+	worker_archive = open_archive( sn_file )
+	init_image_caches( image_cache_mb )
+	start_image_threads( *image_threads )
+	init_disk_caches( cache_settings )
+	worker_options = ( stroke_scale, highlight_scale, image_dpi, deflate_level )
+
+def convert_page_job( page_number, page_id, pdf_id ) :
+	"""
+	convert a single page in a worker process
+
+	bytes | DeflatedFragment	fragment		encoded (and optionally deflated) <page> section
+	[(int,int)]					cache_counts	cache (hits,misses) while converting the page
+	dict						point_counts	simplify_counts of the page
+	dict						page_metrics	metrics report of the page (None if metrics are disabled)
+	"""
+	ctx = context( )
+
+	stroke_scale, highlight_scale, image_dpi, deflate_level = worker_options
+	before = [ ( cache.hits, cache.misses ) for cache in all_caches( ) ]
+	add_simplify_counts( {}, reset=True )
+	fragment = convert_page( worker_archive, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi )
+	if deflate_level is not None :
+		with timed( 'deflate' ) :
+			fragment = deflate_fragment( fragment, deflate_level )
+	cache_counts = [ ( cache.hits - h, cache.misses - m ) for cache, ( h, m ) in zip( all_caches( ), before ) ]
+	page_metrics = None
+	if ctx.metrics is not None :
+		# start afresh for the next page, the parent process adds up the reports
+		page_metrics = ctx.metrics.report( )
+		init_metrics( ctx.metrics.pages is not None )
+	return fragment, cache_counts, dict( ctx.simplify_counts ), page_metrics
+
+def generate_pages_in_pool( sn, xopp_doc, page_numbers, page_and_pdf_ids, stroke_scale, highlight_scale, image_dpi, jobs ) :
+	"""
+	convert pages in a pool of worker processes and write the resulting
+	fragments in page order, so the output is identical to a serial run;
+	at most 2*jobs pages are in flight at any time to bound memory use
+
+	ZipFile		sn					squidnote ZIp archive handle (workers reopen sn.filename)
+	XoppStream	xopp_doc			stream the page fragments are written to
+	[int]		page_numbers		positions of the pages in the document
+	[tuple]		page_and_pdf_ids	(page_id,pdf_id) tuples in page order
+	int			jobs				number of worker processes
+	"""
+	ctx = context( )
+
+	mprint( f'Converting {len(page_and_pdf_ids)} pages using {jobs} worker processes' )
+	def write_result( page_number, future ) :
+		fragment, cache_counts, point_counts, page_metrics = future.result( )
+		xopp_doc.write_fragment( fragment )
+		report_progress( 'page', page=page_number, pages=len( page_and_pdf_ids ) )
+		add_simplify_counts( point_counts )
+		# accumulate the workers' cache statistics and metrics
+		for cache, ( hits, misses ) in zip( all_caches( ), cache_counts ) :
+			cache.hits += hits
+			cache.misses += misses
+		if page_metrics is not None :
+			ctx.metrics.merge( page_metrics )
+
+	image_cache_mb = ctx.decoded_image_cache.budget // 2**20
+	# workers cannot report to the progress callback, so they stay quiet when there is one
+	initargs = ( sn.filename, LOG_QUIET if ctx.progress is not None else ctx.log_level, stroke_scale, highlight_scale, image_dpi, xopp_doc.deflate_level, image_cache_mb, ctx.image_thread_options,
+		None if ctx.fragment_cache is None else ( ctx.fragment_cache.directory, ctx.fragment_cache.budget // 2**20 ),
+		None if ctx.metrics is None else ctx.metrics.pages is not None, ctx.fast_deltas, ctx.simplify_tolerance, ctx.embedded )
+	with futures.ProcessPoolExecutor( max_workers=jobs, mp_context=ctx.process_context, initializer=init_page_worker, initargs=initargs ) as pool :
+		pending = collections.deque( )
+		for page_number, (page_id, pdf_id) in zip( page_numbers, page_and_pdf_ids ) :
+			pending.append( ( page_number, pool.submit( convert_page_job, page_number, page_id, pdf_id ) ) )
+			if len( pending ) >= 2 * jobs :
+				write_result( *pending.popleft( ) )
+		while pending :
+			write_result( *pending.popleft( ) )
+
+########################################
+class PipelineAborted( Exception ) :
+	"""
+	raised in a pipeline stage to give up when another stage has failed
+	"""
+
+class PipelineQueue :
+	"""
+	bounded FIFO queue connecting two stages of the page pipeline (see
+	generate_pages_in_pipeline()); its depth, sampled on each put, and the time
+	the stages on either side stall on it are recorded in the metrics as the
+	pipeline_<name>_items / _depth counters (average depth = depth / items) and
+	the stall_<name>_empty (consumer starved) / _full (producer blocked) timers
+
+	string		name		name of the queue
+	int			depth		maximum number of items in the queue
+	Event		failed		set when a stage has failed, so the others stop waiting
+	"""
+	def __init__( self, name, depth, failed ) :
+		self.name = name
+		self.queue = queue.Queue( maxsize=depth )
+		self.failed = failed
+
+	def put( self, item ) :
+		ctx = context( )
+
+		if ctx.metrics is not None :
+			ctx.metrics.count( f'pipeline_{self.name}_items' )
+			ctx.metrics.count( f'pipeline_{self.name}_depth', self.queue.qsize( ) )
+		try :
+			self.queue.put_nowait( item )
+			return
+		except queue.Full :
+			pass
+		with timed( f'stall_{self.name}_full' ) :
+			while not self.failed.is_set( ) :
+				try :
+					self.queue.put( item, timeout=0.1 )
+					return
+				except queue.Full :
+					pass
+		raise PipelineAborted( )
+
+	def get( self ) :
+		try :
+			return self.queue.get_nowait( )
+		except queue.Empty :
+			pass
+		with timed( f'stall_{self.name}_empty' ) :
+			while not self.failed.is_set( ) :
+				try :
+					return self.queue.get( timeout=0.1 )
+				except queue.Empty :
+					pass
+		raise PipelineAborted( )
+
+def generate_pages_in_pipeline( sn, xopp_doc, page_numbers, page_and_pdf_ids, stroke_scale, highlight_scale, image_dpi, depth ) :
+	"""
+	convert pages in a pipeline of stages running concurrently, each on its own
+	thread and handling one page at a time in page order, so the output is
+	identical to a plain serial run:
+		read		page files are read (and inflated) from the ZIp archive
+		parse		pages are looked up in the fragment cache, else parsed
+		serialise	<page> sections are generated (in the calling thread)
+		write		fragments are written (and compressed, see GzipMemberWriter)
+	the stages are connected by PipelineQueues of the given depth, which bound
+	the number of pages in flight; an error in any stage stops all of them and
+	is raised here
+
+	ZipFile		sn					squidnote ZIp archive handle
+	XoppStream	xopp_doc			stream the page fragments are written to
+	[int]		page_numbers		positions of the pages in the document
+	[tuple]		page_and_pdf_ids	(page_id,pdf_id) tuples in page order
+	int			depth				maximum number of pages waiting between two stages
+	"""
+	failed = threading.Event( )
+	errors = []
+	read_queue = PipelineQueue( 'read', depth, failed )
+	parse_queue = PipelineQueue( 'parse', depth, failed )
+	serialise_queue = PipelineQueue( 'serialise', depth, failed )
+
+	# pages are passed on as tuples, None marks the end
+	def read( ) :
+		for page_number, (page_id, pdf_id) in zip( page_numbers, page_and_pdf_ids ) :
+			with timed( 'page_read' ) :
+				data = read_member( sn, 'data/pages/' + page_id + '.page' )
+			read_queue.put( ( page_number, page_id, pdf_id, data ) )
+		read_queue.put( None )
+
+	def parse( ) :
+		while ( page := read_queue.get( ) ) is not None :
+			parse_queue.put( page + ( prepare_page( sn, *page[:3], stroke_scale, highlight_scale, image_dpi, page[3] ), ) )
+		parse_queue.put( None )
+
+	def write( ) :
+		while ( page := serialise_queue.get( ) ) is not None :
+			xopp_doc.write_fragment( page[1] )
+			report_progress( 'page', page=page[0], pages=len( page_and_pdf_ids ) )
+
+	def run_stage( stage ) :
+		try :
+			stage( )
+		except PipelineAborted :
+			pass
+		except BaseException as e :
+			errors.append( e )
+			failed.set( )
+
+	# each stage runs in (a copy of) the context of the conversion
+	threads = [ threading.Thread( target=contextvars.copy_context( ).run, args=( run_stage, stage ), name=f'pipeline-{stage.__name__}' )
+		for stage in ( read, parse, write ) ]
+	for thread in threads :
+		thread.start( )
+	try :
+		while ( page := parse_queue.get( ) ) is not None :
+			page_number, page_id, pdf_id, data, prepared = page
+			serialise_queue.put( ( page_number, convert_page( sn, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi, data, prepared ) ) )
+		serialise_queue.put( None )
+	except PipelineAborted :
+		pass
+	except BaseException :
+		failed.set( )
+		raise
+	finally :
+		for thread in threads :
+			thread.join( )
+	if errors :
+		raise errors[0]
+
+########################################
+def generate_xournal_xml_doc( sn, xopp_doc, xopp_file, dry_run, stroke_scale, highlight_scale, image_dpi, jobs=1, pipeline_depth=2, pages=None ) :
 	"""
 	- extract page and PDF IDs from squidnote sqlite3 database
 	- extract and save all PDF background files frm squidnote ZIp archive
@@ -233,255 +2435,876 @@ def generate_xournal_xml_doc( sn, xopp_doc, xopp_file, dry_run, stroke_scale, hi
 		and generate corresponding XML components
 		
 	ZipFile		sn			squidnote ZIp archive handle
-	StringIO	xopp_doc	buffer for collecting XML bits
+	XoppStream	xopp_doc	stream for collecting and writing XML bits
 	string		xopp_file	xopp document filename (used for naming background PDFs
 	bool		dry_run		do not write any files when set
+	int			jobs		number of worker processes used for page conversion
+	int			pipeline_depth	pages queued between pipeline stages (serial conversion), 0 to convert pages one by one
+	tuple		pages		select_pages() result of the pages to convert, None for all pages
+
+	int			pages		number of pages converted
 	"""
-	# extract page and pdf background IDs from sqlite3 database
-	page_and_pdf_ids = get_page_and_pdf_ids(sn)
+	# extract page and pdf background IDs from sqlite3 database, unless already selected
+	page_numbers, page_and_pdf_ids = select_pages( sn, None ) if pages is None else pages
+	add_simplify_counts( {}, reset=True )
+	# batch and daemon workers convert many documents, do not let the memos grow with all their colours
+	ctx = context( )
+	ctx.colour_hex.clear( )
+	ctx.stroke_headers.clear( )
+	# the caches outlive the document in batch and daemon workers, report its own hits and misses
+	before = [ ( cache.hits, cache.misses ) for cache in all_caches( ) ]
+	report_progress( 'start', pages=len( page_and_pdf_ids ) )
 
 	# extract all PDFs from squidnote ZIP archive to separate files
 	# only keep pdf_ids at index 1 in each tuple
 	pdf_ids = list( set( [ a[1] for a in page_and_pdf_ids ] ) )
-	# cycle over all PDF file entries
 	if not dry_run :
-		for pdf_id in pdf_ids :
-			if pdf_id :
-				try :
-					src = "data/docs/" + pdf_id
-					dest = xopp_file + '.' + pdf_id + '.pdf'
-					sn.getinfo(src).filename = dest
-					sn.extract(src)
-					mprint( f'Extracted background PDF from "data/docs" to "{dest}"', colour=CGREEN )
-				except :
-					mprint( f'Failed to extract background PDF from "data/docs" to "{dest}"', colour=CRED )
-				
+		extract_background_pdfs( sn, pdf_ids, xopp_file )
+
 	# generate XML header
 	mprint( 'Starting XML page description generation' )
-	xopp_doc.write( '<?xml version="1.0" standalone="no"?>' )
-	xopp_doc.write( '<xournal creator="Xournal++ 1.1.1" fileversion="4">' )
-	xopp_doc.write( '<title>Xournal++ document - see https ://github.com/xournalpp/xournalpp</title>' )
+	xopp_doc.write( b'<?xml version="1.0" standalone="no"?>' )
+	xopp_doc.write( b'<xournal creator="Xournal++ 1.1.1" fileversion="4">' )
+	xopp_doc.write( b'<title>Xournal++ document - see https ://github.com/xournalpp/xournalpp</title>' )
+	xopp_doc.flush( )
+
+	if jobs > 1 :
+		generate_pages_in_pool( sn, xopp_doc, page_numbers, page_and_pdf_ids, stroke_scale, highlight_scale, image_dpi, jobs )
+	elif pipeline_depth > 0 :
+		generate_pages_in_pipeline( sn, xopp_doc, page_numbers, page_and_pdf_ids, stroke_scale, highlight_scale, image_dpi, pipeline_depth )
+	else :
+		# cycle over all pages as listed in the squidnote database (retrieved above)
+		for page_number, (page_id, pdf_id) in zip( page_numbers, page_and_pdf_ids ) :
+			xopp_doc.write_fragment( convert_page( sn, page_number, page_id, pdf_id, stroke_scale, highlight_scale, image_dpi ) )
+			report_progress( 'page', page=page_number, pages=len( page_and_pdf_ids ) )
+
+	xopp_doc.write( b'</xournal>' )
+	xopp_doc.flush( )
+	mprint( 'Completed XML generation for document', colour=CGREEN )
 
-	# cycle over all pages as listed in the squidnote database (retrieved above)
-	for page_number, (page_id, pdf_id) in enumerate( page_and_pdf_ids ) :
+	for cache, since in zip( all_caches( ), before ) :
+		cache.report( since )
+	if ctx.simplify_tolerance > 0 :
+		# pages taken from the fragment cache are not included
+		mprint( f'Stroke simplification dropped {ctx.simplify_counts["points_dropped"]} of {ctx.simplify_counts["points"]} points'
+			f' and {ctx.simplify_counts["bytes_dropped"]} bytes of XML' )
 
-		# generate <page> section of the XML file
-		mprint( f'Generating XML page description for page {page_number:d}' )
+	return len( page_and_pdf_ids )
 
-		# extract from ZIP archive and parse page file for current page
-		ret_val, page = parse_page_file( sn, page_id )
-		mprint( f'Parsed {ret_val} objects for page {page_number}', colour=CGREEN )
+########################################
+def convert_file( sn_file, args ) :
+	"""
+	convert a single squidnote document to a Xournal++ document (and, optionally,
+	an uncompressed XML file) stored next to it, or to a series of documents of
+	at most args.split_every pages each
 
-		# check that our protocol buffer specification is correct and we are not missing any fields
-#		check_for_unknown_fields( page )
+	string		sn_file		squidnote document filename, also used as output base name
+	Namespace	args		conversion options (parsed command line arguments)
 
-		# generate page background section of XML file
-		match page.background.type :
-			case SNP.SN_BT_BLANK :
-				w = 28.34645669 * page.background.width
-				h = 28.34645669 * page.background.height
-				r,g,b,a = split_colour_channels( page.background.colour )
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-				xopp_doc.write( f'<background type="solid" color="#{r:02x}{g:02x}{b:02x}{a:02x}" style="plain"/>' )
-			case SNP.SN_BT_UNDEFINED :
-				mprint( f'Page background type {page.background.type} (SN_BT_UNDEFINED) replaced by blank background', colour=CYELLOW )
-				w = 28.34645669 * page.background.width
-				h = 28.34645669 * page.background.height
-				r,g,b,a = split_colour_channels( page.background.colour )
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-				xopp_doc.write( f'<background type="solid" color="#{r:02x}{g:02x}{b:02x}{a:02x}" style="plain"/>' )
-			case SNP.SN_BT_RULEDPAPER :
-				mprint( f'Page background type {page.background.type} (SN_BT_RULEDPAPER) replaced by blank background', colour=CYELLOW )
-				w = 28.34645669 * page.background.width
-				h = 28.34645669 * page.background.height
-				r,g,b,a = split_colour_channels( page.background.colour )
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-				xopp_doc.write( f'<background type="solid" color="#{r:02x}{g:02x}{b:02x}{a:02x}" style="plain"/>' )
-			case SNP.SN_BT_QUADPAPER :
-				mprint( f'Page background type {page.background.type} (SN_BT_QUADPAPER) replaced by blank background', colour=CYELLOW )
-				w = 28.34645669 * page.background.width
-				h = 28.34645669 * page.background.height
-				r,g,b,a = split_colour_channels( page.background.colour )
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-				xopp_doc.write( f'<background type="solid" color="#{r:02x}{g:02x}{b:02x}{a:02x}" style="plain"/>' )
-			case SNP.SN_BT_PDF :
-				w = 28.34645669 * page.background.width
-				h = 28.34645669 * page.background.height
-				r,g,b,a = split_colour_channels( page.background.colour )
-				pn = page.background.pdf.page_number + 1
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-# it seems xournal wants the filename specified in each <page> entry...
-#				if pn == 1 :
-				xopp_doc.write( f'<background type="pdf" domain="attach" filename="{pdf_id}.pdf" pageno="{pn}"/>' )
-#				else :
-#					xopp_doc.write( f'<background type="pdf" pageno="{pn}"/>' )
-			case SNP.SN_BT_PAPYR :
-				mprint( f'Page background type {page.background.type} (SN_BT_PAPYR) replaced by blank background', colour=CYELLOW )
-				w = 28.34645669 * page.background.width
-				h = 28.34645669 * page.background.height
-				r,g,b,a = split_colour_channels( page.background.colour )
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-				xopp_doc.write( f'<background type="solid" color="#{r:02x}{g:02x}{b:02x}{a:02x}" style="plain"/>' )
-			case _ :
-				mprint( f'Unhandled unknown page background type {page.background.type} replaced by A4 background' , colour=CYELLOW)
-				w = 28.34645669 * 21.0
-				h = 28.34645669 * 29.7
-				r,g,b,a = ( 0xff, 0xff, 0xff, 0xff )
-
-				xopp_doc.write( f'<page width="{w:.3f}" height="{h:.3f}">' )
-				xopp_doc.write( f'<background type="solid" color="#{r:02x}{g:02x}{b:02x}{a:02x}" style="plain"/>' )
-
-		# generate <layer> section(s) of the XMl file
-		for il, lr in enumerate( page.layer ) :
-			xopp_doc.write( '<layer>' )
-			for ii, im in enumerate( lr.item ) :
-				match im.type :
-					case SNP.SN_Item_Type.SN_IT_STROKE :
-						match im.stroke.type :
-							case SNP.SN_Stroke_Type.SN_ST_NORMAL :
-								r,g,b,a = split_colour_channels( im.stroke.colour )
-								xopp_doc.write( f'<stroke tool="pen" ts="0" fn="" color="#{r:02x}{g:02x}{b:02x}{a:02x}"' )
-								w = stroke_scale * 2.834645669 * im.stroke.weight
-								xopp_doc.write( f' width="{w:.3f}' )
-								for pt in im.stroke.delta :
-									w = stroke_scale * 2.834645669 * pt.weight
-									xopp_doc.write( f' {w:.3f}' )
-								xopp_doc.write( '">' )
-								ref_x = 28.34645669 * im.stroke.start.x
-								ref_y = 28.34645669 * im.stroke.start.y
-								xopp_doc.write( f'{ref_x:.3f} {ref_y:.3f}' )
-								for pt in im.stroke.delta :
-									x = ref_x + 28.34645669 * pt.dx
-									y = ref_y + 28.34645669 * pt.dy
-									xopp_doc.write( f' {x:.3f} {y:.3f}' )
-								xopp_doc.write( '</stroke>\n' )
-							case SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT :
-								r,g,b,a = split_colour_channels( im.stroke.colour )
-								xopp_doc.write( f'<stroke tool="highlighter" ts="0" fn="" color="#{r:02x}{g:02x}{b:02x}{a:02x}"' )
-								w = highlight_scale * 28.34645669 * im.stroke.weight
-								xopp_doc.write( f' width="{w:.3f}' )
-								for pt in im.stroke.delta :
-									w = highlight_scale * 28.34645669 * pt.weight
-									xopp_doc.write( f' {w:.3f}' )
-								xopp_doc.write( '">' )
-								ref_x = 28.34645669 * im.stroke.start.x
-								ref_y = 28.34645669 * im.stroke.start.y
-								xopp_doc.write( f'{ref_x:.3f} {ref_y:.3f}' )
-								for pt in im.stroke.delta :
-									x = ref_x + 28.34645669 * pt.dx
-									y = ref_y + 28.34645669 * pt.dy
-									xopp_doc.write( f' {x:.3f} {y:.3f}' )
-								xopp_doc.write( '</stroke>\n' )
-							case SNP.SN_Stroke_Type.SN_ST_UNDEFINED :
-								mprint( f'Unhandled stroke type {im.stroke.type} (SN_ST_UNDEFINED)', colour=CYELLOW )
-							case SNP.SN_Stroke_Type.SN_ST_LINE :
-								mprint( f'Unhandled stroke type {im.stroke.type} (SN_ST_LINE)', colour=CYELLOW )
-							case SNP.SN_Stroke_Type.SN_ST_SMOOTH :
-								mprint( f'Unhandled stroke type {im.stroke.type} (SN_ST_SMOOTH)', colour=CYELLOW )
-							case _  :
-								mprint( f'Unhandled unknown stroke type {im.stroke.type}' )
-					case SNP.SN_Item_Type.SN_IT_UNDEFINED :
-						mprint( f'Unhandled item type {im.type} (SN_IT_UNDEFINED) at position {il}', colour=CYELLOW )
-					case SNP.SN_Item_Type.SN_IT_SHAPE :
-						mprint( f'Unhandled item type {im.type} (SN_IT_SHAPE) at position {il}', colour=CYELLOW )
-					case SNP.SN_Item_Type.SN_IT_TEXT :
-						mprint( f'Unhandled item type {im.type} (SN_IT_TEXT) at position {il}', colour=CYELLOW )
-					case SNP.SN_Item_Type.SN_IT_IMAGE :
-						cl = im.image.crop_bounds.left
-						cr = im.image.crop_bounds.right
-						ct = im.image.crop_bounds.top
-						cb = im.image.crop_bounds.bottom
-
-						l = 28.34645669 * im.image.bounds.left
-						r = 28.34645669 * im.image.bounds.right
-						t = 28.34645669 * im.image.bounds.top
-						b = 28.34645669 * im.image.bounds.bottom
-
-						xopp_doc.write( f'<image left="{l:.3f}" top="{t:.3f}" right="{r:.3f}" bottom="{b:.3f}">\n' )
-
-						name = 'data/imgs/' + im.image.image_hash 
-						with sn.open( name, "r" ) as fd :
-							img = fd.read()
-							fd.close()
-
-						npimg = np.asarray( bytearray(img), dtype=np.uint8)
-						# use IMREAD_UNCHANGED instead of IMREAD_COLOR to ignore EXIF orientation (as does squidnote)
-						cvimg = cv2.imdecode(npimg, cv2.IMREAD_UNCHANGED)
-
-						cvimg = cvimg[ct:cb, cl:cr]
-						if im.image.flip_x :
-							cvimg = cv2.flip( cvimg, 0 )
-						if im.image.flip_y :
-							cvimg = cv2.flip( cvimg, 1 )
-						match im.image.rotation :
-							case 90 :
-								cvimg = cv2.rotate( cvimg, cv2.ROTATE_90_CLOCKWISE )
-							case 180 :
-								cvimg = cv2.rotate( cvimg, cv2.ROTATE_180 )
-							case 270 :
-								cvimg = cv2.rotate( cvimg, cv2.ROTATE_90_COUNTERCLOCKWISE )
-							case _ :
-								mprint( f'Image rotation angle {im.image.rotation} is not supported', colour=CYELLOW )
-						# image_dpi
-						current_x_dpi = 72.0 * (cr-cl) / (r-l)
-						current_y_dpi = 72.0 * (cb-ct)/(b-t)
-						x_scale = min( 1.0, image_dpi / current_x_dpi )
-						y_scale = min( 1.0, image_dpi / current_y_dpi )
-
-#						print( x_scale, y_scale )
-
-						cvimg = cv2.resize( cvimg, None, fx=x_scale, fy=y_scale )
-#						cvimg = cv2.resize( cvimg, None, fx=0.1, fy=0.1 )
-						enc_img = cv2.imencode('.png', cvimg)
-						b64_string = base64.encodebytes( enc_img[1]).decode('utf-8' )
-
-						xopp_doc.write( b64_string )
-						xopp_doc.write( '</image>\n' )
-						mprint( f'Inserted image from file {name}' )
-
-					case _ :
-						mprint( f'Unhandled unknown item type {im.type} at position {il}', colour=CYELLOW )
+	dict		summary		number of pages and bytes of XML / output written (and names of the parts)
+	"""
+	ctx = context( )
 
-			xopp_doc.write( '</layer>\n' )
-			mprint( f'Completed page {page_number} / layer {il}', colour=CGREEN )
+	import_lazily( CONVERSION_LIBS )
+	mprint( f'Input file:  "{sn_file}"', colour=CGREEN )
 
-		xopp_doc.write( '</page>\n' )
-		mprint( f'Completed XML generation for page {page_number}', colour=CGREEN )
+	# open squidnote document archive as ZipFile object
+	sn = open_archive( sn_file )
+	mprint( f'Opened squidnote document archive "{sn_file}"{"" if sn.mapping is not None else " (not memory-mapped)"}' )
+
+	with sn :
+		page_numbers, page_and_pdf_ids = select_pages( sn, args.pages )
+		if not page_numbers and args.pages is not None :
+			raise ValueError( 'none of the selected pages are in the document' )
+
+		# one part unless splitting, each with the background PDFs of its pages only;
+		# a notebook without pages gives a single document without pages
+		step = args.split_every or max( len( page_numbers ), 1 )
+		parts = [ ( page_numbers[k : k + step], page_and_pdf_ids[k : k + step] ) for k in range( 0, len( page_numbers ), step ) ] or [ ( [], [] ) ]
+		totals = { 'pages': 0, 'xml_bytes': 0, 'output_bytes': 0 }
+		point_counts = {}
+		outputs = []
+		for part, pages in enumerate( parts ) :
+			xopp_file = output_file_name( sn_file, args, part )
+			mprint( f'Output file: "{xopp_file}"' )
+			xopp_xml_file = xopp_file[:-len( '.xopp' )] + '.xml.xopp'
+			mprint( f'XML file:    "{xopp_xml_file}"' )
+
+			with contextlib.ExitStack( ) as files :
+				sinks = []
+				if not args.dry_run :
+					# gzip compressed Xournal++ document, with -j pages are deflated by the
+					# worker processes and concatenated, else in blocks by compression threads
+					# outputs are written under temporary names, and only replace earlier ones on success
+					sinks.append( files.enter_context( GzipMemberWriter( files.enter_context( ReplacedOnSuccess( xopp_file ) ), args.compress_level, args.compress_threads ) ) )
+					mprint( f'Opened Xournal++ file "{xopp_file}"' )
+					if args.xml :
+						# uncompressed XML Xournal++ document
+						sinks.append( files.enter_context( open( files.enter_context( ReplacedOnSuccess( xopp_xml_file ) ), 'wb' ) ) )
+						mprint( f'Opened Xournal++ XML file "{xopp_xml_file}"' )
+
+				# create stream for writing the XML doc page by page (to nowhere on a dry run)
+				xopp_doc = XoppStream( *sinks )
+				mprint( f'Created XML stream with {len(sinks)} output file(s)' )
+
+				# call to generate XML components
+				totals['pages'] += generate_xournal_xml_doc(sn, xopp_doc, xopp_file, args.dry_run, args.stroke_scale, args.highlight_scale, args.image_dpi, args.jobs, args.pipeline_depth, pages)
+				mprint( f'Wrote {xopp_doc.size} bytes of XML', colour=CGREEN )
+
+			totals['xml_bytes'] += xopp_doc.size
+			totals['output_bytes'] += 0 if args.dry_run else os.path.getsize( xopp_file )
+			# the simplification counts are reset for each part
+			point_counts = { name : point_counts.get( name, 0 ) + n for name, n in ctx.simplify_counts.items( ) }
+			outputs.append( xopp_file )
+
+	add_simplify_counts( point_counts, reset=True )
+	if ctx.fragment_cache is not None :
+		ctx.fragment_cache.evict( )
+
+	mprint( f'Closed Xournal++ file(s) and squidnote document archive "{sn_file}"' )
+
+	summary = conversion_summary( totals['pages'], totals['xml_bytes'], totals['output_bytes'] )
+	if args.split_every :
+		summary['outputs'] = outputs
+	return summary
+
+def output_file_name( sn_file, args, part=0 ) :
+	"""
+	name of the Xournal++ document converted from a squidnote document, or of
+	the given part (counted from 0) of it when splitting it (--split-every)
 
-	xopp_doc.write( '</xournal>' )
-	mprint( 'Completed XML generation for document', colour=CGREEN )
+	string		sn_file		squidnote document filename
+	Namespace	args		conversion options
+	int			part		number of the part
+
+	string		xopp_file	Xournal++ document filename
+	"""
+	return sn_file + ( f'.part{part + 1:03d}' if args.split_every else '' ) + '.xopp'
+
+def conversion_summary( pages, xml_bytes, output_bytes=None ) :
+	"""
+	int			pages			number of pages converted
+	int			xml_bytes		bytes of XML written
+	int			output_bytes	size of the output file (None if unknown)
+
+	dict		summary			the above (if known), and stroke simplification counts if simplifying
+	"""
+	ctx = context( )
+
+	summary = {
+		'pages':		pages,
+		'xml_bytes':	xml_bytes,
+	}
+	if output_bytes is not None :
+		summary['output_bytes'] = output_bytes
+	if ctx.simplify_tolerance > 0 :
+		summary.update( { 'points': ctx.simplify_counts['points'], 'points_dropped': ctx.simplify_counts['points_dropped'],
+			'xml_bytes_dropped': ctx.simplify_counts['bytes_dropped'] } )
+	return summary
 
 ########################################
-def main( ) :
+def convert( source, sink, options=None, progress=None ) :
 	"""
-	This is the "main" function
+	convert a squidnote document to a Xournal++ document in-process, e.g. in a web
+	service: nothing is printed and no global state is used, each call has its own
+	options, caches, image threads and metrics (see ConversionContext), so any
+	number of conversions can run at once in threads of the same process, which
+	import the libraries only once; errors are raised (e.g. zipfile.BadZipFile,
+	KeyError for missing archive members, ImportError for missing libraries);
+	with options.jobs > 1 the worker processes import the __main__ module afresh,
+	which must therefore guard its entry point with 'if __name__ == "__main__" :'
+
+	str | bytes | file	source		squidnote document: file name, content or seekable binary file object
+	file				sink		writable binary file object the (gzip compressed) Xournal++ document
+									is written to, left open
+	dict | Namespace	options		options by the long names of the command line options (e.g. image_dpi,
+									simplify, compress_level, no_cache), plus log_level and xopp_file,
+									see conversion_options()
+	function			progress	called with a dict for each progress event and message, see report_progress()
+
+	dict				summary		number of pages and bytes of XML written (and metrics report if options.metrics)
 	"""
-	global quiet
+	if 'conversion_context' not in globals( ) :
+		import_libraries( exit_on_error=False )
+	import_lazily( CONVERSION_LIBS, exit_on_error=False )
+	args = conversion_options( options )
+	if args.simplify < 0 :
+		raise ValueError( 'the simplification tolerance must not be negative' )
+	if args.split_every :
+		raise ValueError( 'a conversion to a stream cannot be split, see convert_file()' )
+	if isinstance( args.pages, str ) :
+		args.pages = parse_page_ranges( args.pages )
+
+	ctx = ConversionContext( )
+	ctx.embedded = True
+	ctx.log_level = args.log_level
+	ctx.fast_deltas = not args.no_fast_decode
+	ctx.simplify_tolerance = args.simplify
+	if progress is not None :
+		# events come from several threads, the callback gets them one at a time
+		lock = threading.Lock( )
+		def report( event ) :
+			with lock :
+				progress( event )
+		ctx.progress = report
+	else :
+		ctx.progress = lambda event : None
+	token = conversion_context.set( ctx )
+	try :
+		init_image_caches( args.image_cache_mb )
+		start_image_threads( args.image_threads, args.images_in_flight )
+		init_disk_caches( fragment_cache_settings( args ) )
+		init_metrics( metrics_settings( args ) )
+
+		# worker processes reopen the archive by name; they are not forked from this
+		# process, as a fork while other threads hold locks may leave those locked for good
+		jobs = args.jobs if isinstance( source, ( str, os.PathLike ) ) else 1
+		if jobs > 1 :
+			ctx.process_context = multiprocessing.get_context( 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods( ) else 'spawn' )
+		with timed( 'total' ), open_archive( source ) as sn :
+			selected = select_pages( sn, args.pages )
+			if not selected[0] and args.pages is not None :
+				raise ValueError( 'none of the selected pages are in the document' )
+			with GzipMemberWriter( sink, args.compress_level, args.compress_threads ) as writer :
+				xopp_doc = XoppStream( writer )
+				pages = generate_xournal_xml_doc( sn, xopp_doc, args.xopp_file, args.xopp_file is None,
+					args.stroke_scale, args.highlight_scale, args.image_dpi, jobs, args.pipeline_depth, selected )
+		if ctx.fragment_cache is not None :
+			ctx.fragment_cache.evict( )
+
+		summary = conversion_summary( pages, xopp_doc.size )
+		if ctx.metrics is not None :
+			summary['metrics'] = ctx.metrics.report( )
+			summary['metrics']['caches'] = { cache.name : { 'hits': cache.hits, 'misses': cache.misses } for cache in all_caches( ) }
+		report_progress( 'done', summary=summary )
+		return summary
+	finally :
+		ctx.close( )
+		conversion_context.reset( token )
 
-	# programmatically import all libraries listed at the top
+########################################
+def find_batch_files( patterns ) :
+	"""
+	expand directories (searched recursively for *.snb files) and glob patterns
+
+	[str]		patterns	directories, file names or glob patterns
+
+	[str]		files		sorted list of squidnote document filenames
+	"""
+	files = set( )
+	for pattern in patterns :
+		if os.path.isdir( pattern ) :
+			files.update( glob.glob( os.path.join( glob.escape( pattern ), '**', '*.snb' ), recursive=True ) )
+		else :
+			files.update( f for f in glob.glob( pattern, recursive=True ) if os.path.isfile( f ) )
+	return sorted( files )
+
+def init_batch_worker( worker_log_level, args ) :
+	"""
+	initialise a batch conversion worker process; libraries, caches and image
+	threads are set up once and reused for all files converted by the process
+	"""
 	import_libraries()
+	# a forked worker starts off with a copy of the context of the conversion that started it
+	ctx = ConversionContext( )
+	conversion_context.set( ctx )
+	ctx.log_level = worker_log_level
+	ctx.fast_deltas = not args.no_fast_decode
+	ctx.simplify_tolerance = args.simplify
+	init_image_caches( args.image_cache_mb )
+	start_image_threads( args.image_threads, args.images_in_flight )
+	init_disk_caches( fragment_cache_settings( args ) )
+
+def convert_file_job( sn_file, args ) :
+	"""
+	convert a single file of a batch, never raising: errors are reported in the result
 
-	# process command line arguments
+	dict		result		input / output names, status, duration and convert_file() summary
+						(and metrics report if enabled)
+	"""
+	ctx = context( )
+
+	result = { 'input': sn_file, 'output': output_file_name( sn_file, args ), 'status': 'ok' }
+	init_metrics( metrics_settings( args ) )
+	start = time.perf_counter( )
+	try :
+		with timed( 'total' ) :
+			result.update( convert_file( sn_file, args ) )
+	except Exception as e :
+		result['status'] = 'error'
+		result['error'] = f'{type(e).__name__}: {e}'
+		mprint( f'Failed to convert "{sn_file}": {result["error"]}', colour=CRED )
+	result['duration'] = time.perf_counter( ) - start
+	if ctx.metrics is not None :
+		result['metrics'] = ctx.metrics.report( )
+	return result
+
+def convert_batch( files, args ) :
+	"""
+	convert a batch of files in a pool of worker processes, each file in isolation:
+	a file that fails to convert, or even crashes its worker process, is reported
+	as such without aborting the rest of the batch
+
+	[str]		files		squidnote document filenames
+	Namespace	args		conversion options; args.jobs is the number of worker processes
+
+	[dict]		results		convert_file_job() results in the order of files
+	"""
+	ctx = context( )
+
+	# files are converted in parallel, pages of a file serially (and compressed
+	# serially too, unless there is a single worker process)
+	file_args = argparse.Namespace( **vars( args ) )
+	file_args.jobs = 1
+	if args.jobs > 1 :
+		file_args.compress_threads = 1
+
+	results = {}
+	crashed = []
+	with futures.ProcessPoolExecutor( max_workers=max( 1, args.jobs ), initializer=init_batch_worker, initargs=( ctx.log_level, file_args ) ) as pool :
+		pending = { pool.submit( convert_file_job, f, file_args ) : f for f in files }
+		for future in futures.as_completed( pending ) :
+			sn_file = pending[future]
+			try :
+				results[sn_file] = future.result( )
+				mprint( f'Converted "{sn_file}": {results[sn_file]["status"]}', colour=CGREEN if results[sn_file]['status'] == 'ok' else CRED )
+			except futures.process.BrokenProcessPool :
+				crashed.append( sn_file )
+
+	# a crashed worker breaks the whole pool, so retry affected files one at a time
+	for sn_file in crashed :
+		with futures.ProcessPoolExecutor( max_workers=1, initializer=init_batch_worker, initargs=( ctx.log_level, file_args ) ) as pool :
+			try :
+				results[sn_file] = pool.submit( convert_file_job, sn_file, file_args ).result( )
+			except futures.process.BrokenProcessPool :
+				results[sn_file] = { 'input': sn_file, 'output': output_file_name( sn_file, args ), 'status': 'crashed',
+					'error': 'worker process terminated abruptly', 'duration': 0.0 }
+				mprint( f'Worker process crashed converting "{sn_file}"', colour=CRED )
+
+	return [ results[f] for f in files ]
+
+########################################
+def init_daemon_worker( worker_log_level, args ) :
+	"""
+	initialise a daemon worker process as a batch worker, importing all libraries
+	up front: the process is kept for many jobs, so cv2 and numpy are loaded once
+	"""
+	init_batch_worker( worker_log_level, args )
+	import_lazily( CONVERSION_LIBS + IMAGE_LIBS + DAEMON_LIBS )
+	# interrupts (e.g. Ctrl-C, sent to the whole process group) are handled by the daemon process
+	signal.signal( signal.SIGINT, signal.SIG_IGN )
+
+class ConversionDaemon :
+	"""
+	resident conversion service (-W / -U): documents dropped into an inbox
+	directory, or named by clients of a Unix socket, are converted by a pool of
+	worker processes that is kept between jobs, so libraries stay loaded and the
+	image caches of each worker (as well as the page fragment cache) stay warm
+
+	inbox files are only converted once their size and modification time have
+	not changed for the settle time and they are complete ZIp archives, and again
+	whenever they change; files whose output is newer are considered converted
+
+	Namespace	args		conversion options; args.jobs is the number of concurrent jobs
+	"""
+	def __init__( self, args ) :
+		self.file_args = argparse.Namespace( **vars( args ) )
+		self.file_args.jobs = 1
+		if args.jobs > 1 :
+			self.file_args.compress_threads = 1
+		self.jobs = max( 1, args.jobs )
+		self.summary = args.summary
+		self.lock = threading.Lock( )
+		self.stop = threading.Event( )
+		self.pool = None
+		self.active = set( )	# files queued or being converted
+		self.seen = {}			# file -> (size,mtime) and time first seen as such, while settling
+		self.done = {}			# file -> (size,mtime) when last converted
+
+	def start_pool( self ) :
+		self.pool = futures.ProcessPoolExecutor( max_workers=self.jobs, initializer=init_daemon_worker, initargs=( context( ).log_level, self.file_args ) )
+
+	def submit( self, sn_file, source, retry=True ) :
+		"""
+		queue the conversion of a file
+
+		string		sn_file		squidnote document filename
+		string		source		how the job came in ('watch' or 'socket')
+
+		Future		future		of the job result, see convert_file_job() and finish()
+		"""
+		job = futures.Future( )
+		queued = time.perf_counter( )
+		with self.lock :
+			self.active.add( sn_file )
+			pool = self.pool
+		mprint( f'Queued "{sn_file}" ({source})' )
+
+		def done( future ) :
+			try :
+				result = future.result( )
+			except futures.process.BrokenProcessPool :
+				# a worker crashed (maybe converting another file), start afresh and retry once
+				with self.lock :
+					if self.pool is pool :
+						self.start_pool( )
+				if retry and not self.stop.is_set( ) :
+					with self.lock :
+						self.active.discard( sn_file )
+					retried = self.submit( sn_file, source, retry=False )
+					retried.add_done_callback( lambda f : job.set_result( f.result( ) ) )
+					return
+				result = { 'input': sn_file, 'output': output_file_name( sn_file, self.file_args ), 'status': 'crashed',
+					'error': 'worker process terminated abruptly', 'duration': 0.0 }
+			except futures.CancelledError :
+				result = { 'input': sn_file, 'output': output_file_name( sn_file, self.file_args ), 'status': 'cancelled', 'duration': 0.0 }
+			job.set_result( self.finish( result, source, time.perf_counter( ) - queued ) )
+
+		try :
+			pool.submit( convert_file_job, sn_file, self.file_args ).add_done_callback( done )
+		except RuntimeError :
+			# the pool was shut down or broken in the meantime
+			done_future = futures.Future( )
+			done_future.set_exception( futures.process.BrokenProcessPool( ) )
+			done( done_future )
+		return job
+
+	def finish( self, result, source, latency ) :
+		"""
+		report a completed job, with its latency from being queued to being done
+		"""
+		result['source'] = source
+		result['latency'] = latency
+		result['queued'] = max( 0.0, latency - result['duration'] )
+		with self.lock :
+			self.active.discard( result['input'] )
+			try :
+				st = os.stat( result['input'] )
+				self.done[result['input']] = ( st.st_size, st.st_mtime_ns )
+			except OSError :
+				pass
+			if self.summary :
+				# one JSON record per line and job
+				with open( self.summary, 'a' ) as f :
+					f.write( json.dumps( result ) + '\n' )
+		mprint( f'Converted "{result["input"]}": {result["status"]} in {latency:.2f}s ({result["queued"]:.2f}s queued)',
+			colour=CGREEN if result['status'] == 'ok' else CRED )
+		return result
+
+	def scan( self, inbox, settle ) :
+		"""
+		queue the inbox files that have settled since they were added or changed
+		"""
+		now = time.monotonic( )
+		for sn_file in find_batch_files( [ inbox ] ) :
+			try :
+				st = os.stat( sn_file )
+			except OSError :
+				continue
+			signature = ( st.st_size, st.st_mtime_ns )
+			with self.lock :
+				if sn_file in self.active or self.done.get( sn_file ) == signature :
+					continue
+			xopp_file = output_file_name( sn_file, self.file_args )
+			if sn_file not in self.seen and os.path.exists( xopp_file ) and os.path.getmtime( xopp_file ) > st.st_mtime :
+				# converted before (e.g. before the daemon started)
+				self.done[sn_file] = signature
+			elif self.seen.get( sn_file, ( None, ) )[0] != signature :
+				self.seen[sn_file] = ( signature, now )
+			elif now - self.seen[sn_file][1] >= settle and zipfile.is_zipfile( sn_file ) :
+				del self.seen[sn_file]
+				self.submit( sn_file, 'watch' )
+
+	def serve( self, socket_path ) :
+		"""
+		accept jobs on a Unix socket: each line a client sends names a document (relative
+		to the working directory of the daemon), answered by a line with its JSON job result;
+		the socket is only accessible to the user running the daemon, who can have it convert
+		(and write next to) any file it can read; clients connecting before the server is
+		started (serve_forever) wait in the listen backlog
+		"""
+		daemon = self
+
+		class Handler( socketserver.StreamRequestHandler ) :
+			def handle( self ) :
+				for line in self.rfile :
+					sn_file = os.path.abspath( line.decode( ).strip( ) )
+					if not os.path.isfile( sn_file ) :
+						result = { 'input': sn_file, 'status': 'error', 'error': 'no such file' }
+					else :
+						result = daemon.submit( sn_file, 'socket' ).result( )
+					self.wfile.write( ( json.dumps( result ) + '\n' ).encode( ) )
+
+		if os.path.lexists( socket_path ) :
+			# only replace a socket left over by an earlier daemon, never a file or a live socket
+			if not stat.S_ISSOCK( os.lstat( socket_path ).st_mode ) :
+				raise FileExistsError( f'"{socket_path}" exists and is not a socket' )
+			with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as probe :
+				try :
+					probe.connect( socket_path )
+				except ConnectionRefusedError :
+					os.unlink( socket_path )
+				else :
+					raise FileExistsError( f'another daemon is listening on "{socket_path}"' )
+		server = socketserver.ThreadingUnixStreamServer( socket_path, Handler, bind_and_activate=False )
+		try :
+			# restrict the socket before it starts listening
+			server.server_bind( )
+			os.chmod( socket_path, 0o600 )
+			server.server_activate( )
+		except BaseException :
+			server.server_close( )
+			raise
+		server.daemon_threads = True
+		return server
+
+	def run( self, inbox=None, socket_path=None, settle=2.0 ) :
+		"""
+		serve until interrupted (SIGINT / SIGTERM); jobs in progress are completed first
+		"""
+		import_lazily( CONVERSION_LIBS + DAEMON_LIBS )
+		signal.signal( signal.SIGTERM, lambda signum, frame : self.stop.set( ) )
+		# bind the socket first, so that a refused socket starts no workers, but accept
+		# connections only once there is a pool to submit their jobs to
+		server = self.serve( socket_path ) if socket_path else None
+		try :
+			self.start_pool( )
+		except BaseException :
+			if server is not None :
+				server.server_close( )
+				os.unlink( socket_path )
+			raise
+		if server is not None :
+			threading.Thread( target=server.serve_forever, name='socket', daemon=True ).start( )
+			mprint( f'Listening on "{socket_path}"', colour=CGREEN )
+		if inbox :
+			mprint( f'Watching "{inbox}" with {self.jobs} concurrent job(s)', colour=CGREEN )
+		try :
+			while not self.stop.wait( min( 1.0, settle / 2 ) ) :
+				if inbox :
+					self.scan( inbox, settle )
+		except KeyboardInterrupt :
+			self.stop.set( )
+		mprint( 'Stopping, waiting for jobs in progress' )
+		if server is not None :
+			server.shutdown( )
+			server.server_close( )
+			os.unlink( socket_path )
+		self.pool.shutdown( )
+
+########################################
+# cost model of the --stats estimates, fitted to conversions (compression level 9,
+# one core) of a set of reference documents: good enough to rank documents by
+# cost, the seconds will have to be scaled to the machine at hand
+STATS_COST_MODEL = {
+	'xml_bytes_per_page':			200,
+	'xml_bytes_per_stroke':			110,
+	'xml_bytes_per_point':			22,
+	'png_bytes_per_pixel':			2.0,		# rendered image pixel, before base64 encoding
+	'deflated_per_stroke_byte':		0.4,
+	'deflated_per_image_byte':		0.75,
+	'seconds_per_document':			0.1,
+	'seconds_per_point':			1.4e-6,
+	'seconds_per_decoded_pixel':	25e-9,
+	'seconds_per_rendered_pixel':	60e-9,
+	'seconds_per_xml_byte':			0.1e-6,		# deflate
+}
+
+def read_image_header( sn, name ) :
+	"""
+	get the format and size of an embedded image (see image_header()) reading as
+	little of it as possible: JPEG start of frame segments are usually found in
+	the first few kB, unless preceded by large (EXIF) segments
+
+	ZipFile		sn			squidnote ZIp archive handle
+	string		name		name of the image in the archive
+
+	tuple		header		( format, width, height, channels ), None if not recognised
+	"""
+	view = member_view( sn, sn.getinfo( name ) )
+	if view is not None :
+		# only the pages of the mapping the header is found in are read
+		try :
+			return image_header( view )
+		except struct.error :
+			return None
+	with sn.open( name, 'r' ) as fd :
+		data = fd.read( 65536 )
+		while True :
+			try :
+				header = image_header( data )
+			except struct.error :
+				header = None
+			more = fd.read( len( data ) ) if header is None else b''
+			if not more :
+				return header
+			data += more
+
+def page_stats( sn, page_number, page_id, pdf_id, image_dpi, images ) :
+	"""
+	count the layers, items, strokes, points and images of a page without
+	generating any XML; the page is parsed by protobuf (in C), whose repeated
+	fields know their lengths, so no Python object is created per point
+
+	ZipFile		sn				squidnote ZIp archive handle
+	int			page_number		position of the page in the document
+	string		page_id			name of the protobuf page file
+	string		pdf_id			name of the background PDF (or None)
+	int			image_dpi		resolution images are rendered at
+	dict		images			image_hash -> header, and the rendered image keys; updated
+
+	dict		stats			counts of the page
+	"""
+	data = read_member( sn, 'data/pages/' + page_id + '.page' )
+	( ret_val, page ) = parse_page_file( sn, page_id, data )
+	names = { v : k[6:].lower( ) for k, v in SNP.SN_Item_Type.items( ) }
+	stats = {
+		'page':				page_number,
+		'page_id':			page_id,
+		'pdf_id':			pdf_id,
+		'page_bytes':		len( data ),
+		'layers':			len( page.layer ),
+		'items':			{},
+		'strokes':			0,
+		'points':			0,
+		'images':			0,
+		'image_pixels':		0,
+		'decoded_pixels':	0,
+		'rendered_pixels':	0,
+		'placed_pixels':	0,
+	}
+	for lr in page.layer :
+		for im in lr.item :
+			name = names.get( im.type, 'unknown' )
+			stats['items'][name] = stats['items'].get( name, 0 ) + 1
+			match im.type :
+				case SNP.SN_Item_Type.SN_IT_STROKE if im.stroke.type in ( SNP.SN_Stroke_Type.SN_ST_NORMAL, SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT ) :
+					stats['strokes'] += 1
+					stats['points'] += len( im.stroke.delta ) + 1
+				case SNP.SN_Item_Type.SN_IT_IMAGE :
+					stats['images'] += 1
+					image_hash = im.image.image_hash
+					if image_hash not in images :
+						try :
+							images[image_hash] = read_image_header( sn, 'data/imgs/' + image_hash )
+						except KeyError :
+							images[image_hash] = None
+					header = images[image_hash]
+					if header is None :
+						continue
+					stats['image_pixels'] += header[1] * header[2]
+					try :
+						( crop, x_scale, y_scale ) = image_scales( im.image, image_dpi )
+					except ZeroDivisionError :
+						continue
+					# images are decoded and rendered once (as with the image caches), but embedded at each placement
+					reduction = jpeg_reduction( x_scale, y_scale ) if header[0] == 'jpeg' else 1
+					if ( image_hash, reduction ) not in images :
+						images[( image_hash, reduction )] = True
+						stats['decoded_pixels'] += header[1] * header[2] // reduction**2
+					pixels = int( abs( crop[1] - crop[0] ) * x_scale * abs( crop[3] - crop[2] ) * y_scale )
+					stats['placed_pixels'] += pixels
+					key = ( image_hash, crop, im.image.flip_x, im.image.flip_y, im.image.rotation, x_scale, y_scale )
+					if key not in images :
+						images[key] = True
+						stats['rendered_pixels'] += pixels
+	return stats
+
+def estimate_cost( stats ) :
+	"""
+	estimate the size of the XML and of the .xopp file, and the conversion time,
+	from the counts of a page or document (see STATS_COST_MODEL)
+	"""
+	m = STATS_COST_MODEL
+	stroke_bytes = m['xml_bytes_per_page'] * stats['pages'] + m['xml_bytes_per_stroke'] * stats['strokes'] + m['xml_bytes_per_point'] * stats['points']
+	# base64 encoding takes 4 characters (and a newline every 76) for 3 bytes
+	image_bytes = m['png_bytes_per_pixel'] * stats['placed_pixels'] * 4 / 3 * 77 / 76
+	return {
+		'xml_bytes':	int( stroke_bytes + image_bytes ),
+		'output_bytes':	int( m['deflated_per_stroke_byte'] * stroke_bytes + m['deflated_per_image_byte'] * image_bytes ),
+		'seconds':		round( m['seconds_per_document'] + m['seconds_per_point'] * stats['points'] + m['seconds_per_decoded_pixel'] * stats['decoded_pixels']
+							+ m['seconds_per_rendered_pixel'] * stats['rendered_pixels'] + m['seconds_per_xml_byte'] * ( stroke_bytes + image_bytes ), 3 ),
+	}
+
+def document_stats( sn_file, image_dpi, pages=True, ranges=None ) :
+	"""
+	inventory of a squidnote document (--stats): counts per page and in total,
+	sizes of the embedded images and background PDFs, and estimated cost
+
+	string		sn_file		squidnote document filename
+	int			image_dpi	resolution images are rendered at
+	bool		pages		include the per-page counts
+	[(int,int)]	ranges		pages to include, see parse_page_ranges(), None for all
+
+	dict		stats		inventory, see the code for the fields
+	"""
+	import_lazily( CONVERSION_LIBS )
+	start = time.perf_counter( )
+	with open_archive( sn_file ) as sn :
+		page_numbers, page_and_pdf_ids = select_pages( sn, ranges )
+		images = {}
+		page_list = [ page_stats( sn, page_number, page_id, pdf_id, image_dpi, images ) for page_number, (page_id, pdf_id) in zip( page_numbers, page_and_pdf_ids ) ]
+		pdfs = {}
+		for pdf_id in sorted( set( pdf_id for (page_id, pdf_id) in page_and_pdf_ids if pdf_id ) ) :
+			try :
+				pdfs[pdf_id] = sn.getinfo( 'data/docs/' + pdf_id ).file_size
+			except KeyError :
+				pdfs[pdf_id] = None
+		image_sizes = { info.filename[10:] : info.file_size for info in sn.infolist( ) if info.filename.startswith( 'data/imgs/' ) }
+
+	totals = { 'pages': len( page_list ) }
+	for name in ( 'page_bytes', 'layers', 'strokes', 'points', 'images', 'image_pixels', 'decoded_pixels', 'rendered_pixels', 'placed_pixels' ) :
+		totals[name] = sum( p[name] for p in page_list )
+	totals['items'] = {}
+	for p in page_list :
+		for name, n in p['items'].items( ) :
+			totals['items'][name] = totals['items'].get( name, 0 ) + n
+		p['estimate'] = estimate_cost( dict( p, pages=1 ) )
+	headers = { h : v for h, v in images.items( ) if isinstance( h, str ) }
+	stats = {
+		'input':			sn_file,
+		'file_bytes':		os.path.getsize( sn_file ),
+		'totals':			totals,
+		'embedded_images':	{
+			'count':	len( headers ),
+			'bytes':	sum( image_sizes.get( h, 0 ) for h in headers ),
+			'pixels':	sum( v[1] * v[2] for v in headers.values( ) if v is not None ),
+			'unknown':	sum( 1 for v in headers.values( ) if v is None ),
+		},
+		'pdf_backgrounds':	pdfs,
+		'estimate':			estimate_cost( totals ),
+		'scan_seconds':		round( time.perf_counter( ) - start, 3 ),
+	}
+	if pages :
+		stats['pages'] = page_list
+	return stats
+
+def write_stats( files, args ) :
+	"""
+	write the inventory of documents as JSON (to stdout for -), most expensive first
+	"""
+	results = []
+	for sn_file in files :
+		try :
+			results.append( document_stats( sn_file, args.image_dpi, ranges=args.pages ) )
+			mprint( f'Scanned "{sn_file}"', colour=CGREEN )
+		except Exception as e :
+			results.append( { 'input': sn_file, 'error': f'{type(e).__name__}: {e}' } )
+			mprint( f'Failed to scan "{sn_file}": {results[-1]["error"]}', colour=CRED )
+	results.sort( key=lambda r : -r['estimate']['seconds'] if 'estimate' in r else 0 )
+	report = { 'cost_model': STATS_COST_MODEL, 'files': results }
+	if args.stats == '-' :
+		json.dump( report, sys.stdout, indent=1 )
+		print( )
+	else :
+		with open( args.stats, 'w' ) as f :
+			json.dump( report, f, indent=1 )
+		mprint( f'Wrote inventory "{args.stats}"' )
+	return results
+
+########################################
+def metrics_settings( args ) :
+	"""
+	metrics settings for init_metrics()
+	"""
+	return None if args.metrics is None else args.page_metrics
+
+def write_metrics_report( filename, report ) :
+	"""
+	write a metrics report as JSON
+	"""
+	with open( filename, 'w' ) as f :
+		json.dump( report, f, indent=1 )
+	mprint( f'Wrote metrics report "{filename}"' )
+
+def fragment_cache_settings( args ) :
+	"""
+	page fragment cache and PDF store settings for init_disk_caches(), none on dry runs
+	"""
+	if args.no_cache or args.dry_run :
+		return None
+	return ( args.cache_dir, args.cache_size_mb )
+
+def build_parser( ) :
+	"""
+	ArgumentParser		parser		parser of the command line options
+	"""
 	parser = argparse.ArgumentParser(
 		description='Convert Squid Note files to Xournal++ format',
 		epilog='Please submit buf reports on GitHub (link to be provided)'
 		)
 
-	parser.add_argument( "-f", "--filename",		action='store',			help='Input/output file base name', 	required=True )
+	inputs = parser.add_mutually_exclusive_group( )
+	inputs.add_argument( "-f", "--filename",		action='store',			help='Input/output file base name' )
+	inputs.add_argument( "-b", "--batch",			action='store',			help='Convert all *.snb files in directories / matching glob patterns', nargs='+', metavar='PATH' )
 	parser.add_argument( "-s", "--stroke-scale",	action='store',			help='Scale stroke width [1.0]', 		default=1.0, type=float )
 	parser.add_argument( "-l", "--highlight-scale",	action='store',			help='Scale highlight width [1.0]',		default=1.0, type=float )
 	parser.add_argument( "-d", "--image-dpi",		action='store',			help='DPI for embedded images [150]',	default=150, type=int )
+	parser.add_argument( "-T", "--simplify",		action='store',			help='Drop stroke points closer than TOLERANCE (in pt) to the simplified stroke, 0 to keep all [0]',	default=0.0, type=float, metavar='TOLERANCE' )
+	parser.add_argument( "-p", "--pages",			action='store',			help='Convert only these pages (counted from 1), e.g. 10-25,40 or 100- [all]',	type=parse_page_ranges, metavar='RANGES' )
+	parser.add_argument( "-k", "--split-every",		action='store',			help='Write a series of Xournal++ files (*.part001.xopp, ...) of N pages each, 0 for a single file [0]',	default=0, type=int, metavar='N' )
+	parser.add_argument( "-c", "--image-cache-mb",	action='store',			help='Memory budget of each image cache in MB [256]',	default=256, type=int )
+	parser.add_argument( "-t", "--image-threads",	action='store',			help='Number of image rendering threads, 0 to disable [min(4,#cpus)]',	default=min( 4, os.cpu_count( ) or 1 ), type=int )
+	parser.add_argument( "-i", "--images-in-flight",	action='store',		help='Maximum number of images queued for rendering [16]',	default=16, type=int )
+	parser.add_argument( "-z", "--compress-level",	action='store',			help='Compression level of the .xopp file, 0 (none) to 9 (best) [9]',	default=9, type=int, choices=range( 10 ), metavar='LEVEL' )
+	parser.add_argument( "-Z", "--compress-threads",	action='store',		help='Number of compression threads [min(4,#cpus)]',	default=min( 4, os.cpu_count( ) or 1 ), type=int )
+	parser.add_argument( "-j", "--jobs",			action='store',			help='Number of page (batch: file) conversion processes [1]',	default=1, type=int )
+	parser.add_argument( "-D", "--pipeline-depth",	action='store',			help='Number of pages queued between the read, parse, serialise and write stages, 0 to convert pages one by one [2]',	default=2, type=int )
+	parser.add_argument( "-C", "--cache-dir",		action='store',			help=f'Page fragment cache directory, holding the background PDF store in pdfs/ [{default_cache_dir()}]',	default=default_cache_dir( ) )
+	parser.add_argument( "-m", "--cache-size-mb",	action='store',			help='Maximum size of the page fragment cache (and of the background PDF store) in MB [1024]',	default=1024, type=int )
+	parser.add_argument( "-N", "--no-cache",		action='store_true',	help='Do not use the page fragment cache and the background PDF store: extract background PDFs as plain copies rather than as read-only (0444) hardlinks into the shared store, which share one inode: a chmod or edit of one such PDF affects every notebook sharing it [false]' )
 	parser.add_argument( "-x", "--xml",				action='store_true',	help='Generate XML file [false]' )
 	parser.add_argument( "-n", "--dry-run",			action='store_true',	help='Do not write any files [false]' )
+	parser.add_argument( "-W", "--watch",			action='store',			help='Daemon: convert *.snb files dropped into (or updated in) this directory', metavar='DIR' )
+	parser.add_argument( "-U", "--socket",			action='store',			help='Daemon: convert files named by clients of this Unix socket (created with mode 0600, replacing only a stale socket)', metavar='PATH' )
+	parser.add_argument( "-e", "--settle",			action='store',			help='Daemon: seconds a file must stay unchanged before it is converted [2.0]',	default=2.0, type=float )
+	parser.add_argument( "-u", "--skip-up-to-date",	action='store_true',	help='Batch: skip files whose output is newer than the input [false]' )
+	parser.add_argument( "-S", "--summary",			action='store',			help='Batch: write JSON summary to this file (daemon: append one JSON line per job)' )
 	parser.add_argument( "-v", "--version",			action='store_true',	help='About' )
+	parser.add_argument( "-F", "--no-fast-decode",	action='store_true',	help='Read stroke points through protobuf messages instead of decoding them directly [false]' )
+	parser.add_argument( "-I", "--stats",			action='store',			help='Do not convert, write an inventory with cost estimates of the input file(s) as JSON to this file [stdout]',	nargs='?', const='-', metavar='FILE' )
+	parser.add_argument( "-M", "--metrics",			action='store',			help='Write stage timings and counters to this JSON file' )
+	parser.add_argument( "-P", "--page-metrics",	action='store_true',	help='Include per-page records in the metrics file [false]' )
+	parser.add_argument( "-V", "--verbose",			action='store_true',	help='Report progress per page, layer and item [false]' )
 	parser.add_argument( "-q", "--quiet",			action='store_true',	help='Disable progress reporting [false]' )
 
+	return parser
+
+# options of convert() that are not command line options, see conversion_options()
+API_OPTIONS = {
+	'log_level':	LOG_INFO,		# level of the messages passed to the progress callback
+	'xopp_file':	None,			# name background PDFs are extracted next to (as for -f), None to not extract them
+}
+
+def conversion_options( options=None ) :
+	"""
+	options of convert(): the defaults of the command line options and of
+	API_OPTIONS, updated with the given ones; unknown options are an error
+
+	dict | Namespace	options		options to change (keyed by the long names of the command line options)
+
+	Namespace			args		all options
+	"""
+	defaults = vars( build_parser( ).parse_args( [] ) )
+	defaults.update( API_OPTIONS )
+	options = vars( options ) if isinstance( options, argparse.Namespace ) else dict( options or {} )
+	unknown = set( options ) - set( defaults )
+	if unknown :
+		raise TypeError( f'unknown conversion options: {", ".join( sorted( unknown ) )}' )
+	defaults.update( options )
+	return argparse.Namespace( **defaults )
+
+########################################
+def main( ) :
+	"""
+	This is the "main" function
+	"""
+	# programmatically import all libraries listed at the top
+	import_libraries()
+	ctx = context( )
+
+	# process command line arguments
+	parser = build_parser( )
 	args = parser.parse_args()
 
 	if args.version :
@@ -492,50 +3315,78 @@ def main( ) :
 		print( __doc__ )
 		exit()
 
-	quiet = args.quiet
+	if args.filename is None and args.batch is None and args.watch is None and args.socket is None :
+		parser.error( 'one of the arguments -f/--filename -b/--batch -W/--watch -U/--socket is required' )
+
+	ctx.log_level = LOG_QUIET if args.quiet else LOG_DETAIL if args.verbose else LOG_INFO
+	ctx.fast_deltas = not args.no_fast_decode
+	if args.simplify < 0 :
+		parser.error( 'the simplification tolerance must not be negative' )
+	ctx.simplify_tolerance = args.simplify
+	if args.split_every < 0 :
+		parser.error( 'the number of pages per file must not be negative' )
+
+	if args.stats is not None :
+		if args.filename is None and args.batch is None :
+			parser.error( 'the argument -I/--stats requires -f/--filename or -b/--batch' )
+		results = write_stats( find_batch_files( args.batch ) if args.batch is not None else [ args.filename ], args )
+		exit( 1 if any( 'error' in r for r in results ) else 0 )
+
 	if args.dry_run :
 		mprint( f'This is a dry run, no files will be written', colour=CYELLOW )
-	sn_file = args.filename
-	mprint( f'Input file:  "{sn_file}"', colour=CGREEN )
-	xopp_file = args.filename + '.xopp' 
-	mprint( f'Output file: "{xopp_file}"' )
-	xopp_xml_file = args.filename + '.xml.xopp' 
-	mprint( f'XML file:    "{xopp_xml_file}"' )
-
-	# create buffer for building XML doc in
-	xopp_doc = io.StringIO( )
-	mprint( 'Created io.StringIO buffer xopp_doc' )
 
-	# open squidnote document archive as ZipFile object
-	sn = zipfile.ZipFile( sn_file, 'r' )
-	mprint( f'Opened squidnote document archive "{sn_file}"' )
-
-	# call to generate XML components
-	generate_xournal_xml_doc(sn, xopp_doc, xopp_file, args.dry_run, args.stroke_scale, args.highlight_scale, args.image_dpi)
-
-	if not args.dry_run :
-		# save gzip compressed Xournal++ document
-		with gzip.open( xopp_file, 'wb' ) as f :
-			mprint( f'Opened Xournal++ file "{xopp_file}"' )
-			f.write( xopp_doc.getvalue( ).encode( ) )
-			mprint( f'Wrote Xournal++ file', colour=CGREEN )
-			f.close( )
-			mprint( f'Closed Xournal++ file' )
-
-		if args.xml :
-			# save uncompressed XML Xournal++ document
-			with open( xopp_xml_file, 'wb' ) as f :
-				mprint( f'Opened Xournal++ XML file "{xopp_xml_file}"' )
-				f.write( xopp_doc.getvalue( ).encode( ) )
-				mprint( f'Wrote Xournal++ XML file', colour=CGREEN )
-				f.close( )
-				mprint( f'Closed Xournal++ file' )
-
-	# close open StrinIO and ZipFile
-	xopp_doc.close( )
-	mprint( 'Closed io.StringIO buffer xopp_doc' )
-	sn.close()
-	mprint( f'Closed squidnote document archive "{sn_file}"' )
+	if args.watch is not None or args.socket is not None :
+		try :
+			ConversionDaemon( args ).run( args.watch, args.socket, args.settle )
+		except FileExistsError as e :
+			mprint( f'Cannot listen on the socket: {e}', colour=CRED )
+			exit( 1 )
+		exit( 0 )
+
+	if args.batch is not None :
+		files = find_batch_files( args.batch )
+		mprint( f'Found {len(files)} squidnote documents', colour=CGREEN )
+		skipped = []
+		if args.skip_up_to_date :
+			skipped = [ f for f in files if os.path.exists( output_file_name( f, args ) ) and os.path.getmtime( output_file_name( f, args ) ) > os.path.getmtime( f ) ]
+			files = [ f for f in files if f not in skipped ]
+			mprint( f'Skipping {len(skipped)} up to date documents' )
+
+		results = convert_batch( files, args )
+		if args.metrics :
+			# totals over all files, and the metrics of each file
+			init_metrics( args.page_metrics )
+			for r in results :
+				if 'metrics' in r :
+					ctx.metrics.merge( r['metrics'] )
+			report = ctx.metrics.report( )
+			report['files'] = { r['input'] : r.pop( 'metrics' ) for r in results if 'metrics' in r }
+			write_metrics_report( args.metrics, report )
+		results += [ { 'input': f, 'output': output_file_name( f, args ), 'status': 'skipped', 'duration': 0.0 } for f in skipped ]
+		results.sort( key=lambda r : r['input'] )
+
+		failed = sum( 1 for r in results if r['status'] not in ( 'ok', 'skipped' ) )
+		mprint( f'Converted {len(files)-failed} documents, {failed} failed, {len(skipped)} skipped', colour=CRED if failed else CGREEN )
+		if args.summary :
+			with open( args.summary, 'w' ) as f :
+				json.dump( { 'files': results }, f, indent=1 )
+			mprint( f'Wrote batch summary "{args.summary}"' )
+		exit( 1 if failed else 0 )
+
+	init_image_caches( args.image_cache_mb )
+	start_image_threads( args.image_threads, args.images_in_flight )
+	init_disk_caches( fragment_cache_settings( args ) )
+	init_metrics( metrics_settings( args ) )
+
+	with timed( 'total' ) :
+		convert_file( args.filename, args )
+
+	ctx.close( )
+
+	if ctx.metrics is not None :
+		report = ctx.metrics.report( )
+		report['caches'] = { cache.name : { 'hits': cache.hits, 'misses': cache.misses } for cache in all_caches( ) }
+		write_metrics_report( args.metrics, report )
 
 	# we are done
 	mprint( f'Finished', colour=CGREEN )
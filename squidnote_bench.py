@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+"""
+Benchmark squidnote2xopp end to end and stage by stage
+   Run "squidnote_bench -h" for usage information
+Each stage of each document is run in a fresh process, so that its peak memory
+(maximum resident set size) can be measured; without input files, synthetic
+documents are generated with squidnote_synth. Results can be saved as JSON and
+compared against an earlier run to catch performance regressions.
+"""
+
+import sys
+import os
+import argparse
+import json
+import resource
+import subprocess
+import tempfile
+import time
+
+import squidnote2xopp as sx
+
+########################################
+# synthetic documents: squidnote_synth.write_archive() arguments
+PRESETS = {
+	'strokes':	dict( pages=20, layers=2, strokes=200, points=100 ),
+	'images':	dict( pages=12, strokes=10, points=20, images=4, image_width=4000, image_height=3000, images_per_page=2 ),
+	'mixed':	dict( pages=30, layers=2, strokes=100, points=60, images=3, image_width=1600, image_height=1200, pdfs=2 ),
+}
+
+STAGES = [ 'db', 'parse', 'strokes', 'images', 'gzip', 'end-to-end' ]
+
+########################################
+def stroke_items( pages ) :
+	"""
+	indices of the pen / highlighter stroke items of each layer of each page
+	"""
+	return [ [ [ ii for ii, im in enumerate( lr.item ) if im.type == sx.SNP.SN_Item_Type.SN_IT_STROKE
+				and im.stroke.type in ( sx.SNP.SN_Stroke_Type.SN_ST_NORMAL, sx.SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT ) ]
+			for lr in page.layer ] for page in pages ]
+
+def stroke_layers( pages ) :
+	"""
+	pen / highlighter strokes of each layer of each page, as passed to render_strokes()
+	"""
+	return [ [ [ lr.item[ii].stroke for ii in layer_items ] for lr, layer_items in zip( page.layer, page_items ) ]
+		for page, page_items in zip( pages, stroke_items( pages ) ) ]
+
+def image_items( pages ) :
+	return [ im.image for page in pages for lr in page.layer for im in lr.item if im.type == sx.SNP.SN_Item_Type.SN_IT_IMAGE ]
+
+def run_stage( stage, sn_file, repeat ) :
+	"""
+	run one stage on a document, repeat times after an untimed setup
+
+	string		stage		name of the stage, one of STAGES
+	string		sn_file		squidnote document
+	int			repeat		number of timed runs
+
+	dict		result		best time in seconds, amount of work done (units) and peak memory
+	"""
+	sx.import_libraries( )
+	sx.import_lazily( sx.CONVERSION_LIBS + sx.IMAGE_LIBS )
+	sx.context( ).log_level = sx.LOG_QUIET
+	sx.init_image_caches( 256 )
+	sx.start_image_threads( 0, 0 )
+	sx.init_disk_caches( None )
+
+	sn = sx.open_archive( sn_file )
+	ids = sx.get_page_and_pdf_ids( sn )
+	data = [ sn.read( 'data/pages/' + page_id + '.page' ) for ( page_id, pdf_id ) in ids ]
+	pages = [ sx.parse_page_file( sn, page_id, d )[1] for ( page_id, pdf_id ), d in zip( ids, data ) ]
+
+	match stage :
+		case 'db' :
+			run = lambda : sx.read_note_metadata( sn )
+			units = { 'pages': len( ids ) }
+		case 'parse' :
+			run = lambda : [ sx.parse_page_file( sn, page_id, d ) for ( page_id, pdf_id ), d in zip( ids, data ) ]
+			units = { 'pages': len( ids ), 'MB': sum( map( len, data ) ) / 2**20 }
+		case 'strokes' :
+			# decode the delta points of each page and serialise the strokes of each layer, as generate_page_xml() does
+			layers = stroke_layers( pages )
+			items = stroke_items( pages )
+			def run( ) :
+				for d, page_items, page_layers in zip( data, items, layers ) :
+					decoded_layers, deltas = sx.decode_page_deltas( d )
+					for il, ( layer_items, strokes ) in enumerate( zip( page_items, page_layers ) ) :
+						decoded = sx.layer_deltas( decoded_layers[il], layer_items, deltas ) if strokes else None
+						sx.render_strokes( strokes, 1.0, 1.0, decoded )
+			layers_flat = [ strokes for page_layers in layers for strokes in page_layers ]
+			units = { 'strokes': sum( map( len, layers_flat ) ), 'points': sum( len( s.delta ) + 1 for strokes in layers_flat for s in strokes ) }
+		case 'images' :
+			images = image_items( pages )
+			def run( ) :
+				# start cold, but let repeated placements within a run hit the caches
+				sx.init_image_caches( 256 )
+				sx.context( ).image_reducible.clear( )
+				return [ sx.render_image( sn, image, 150 ) for image in images ]
+			units = { 'images': len( images ) }
+		case 'gzip' :
+			xml = b''.join( sx.convert_page( sn, i, page_id, pdf_id, 1.0, 1.0, 150 ) for i, ( page_id, pdf_id ) in enumerate( ids ) )
+			def run( ) :
+				with sx.GzipMemberWriter( os.devnull, 9, min( 4, os.cpu_count( ) or 1 ) ) as f :
+					f.write( xml )
+			units = { 'MB': len( xml ) / 2**20 }
+		case 'end-to-end' :
+			tmp = tempfile.mkdtemp( )
+			linked = os.path.join( tmp, os.path.basename( sn_file ) )
+			os.symlink( os.path.abspath( sn_file ), linked )
+			args = sx.conversion_options( dict( dry_run=False, xml=False, jobs=1, pipeline_depth=2, compress_level=9, compress_threads=min( 4, os.cpu_count( ) or 1 ), stroke_scale=1.0, highlight_scale=1.0, image_dpi=150 ) )
+			def run( ) :
+				sx.init_image_caches( 256 )
+				sx.context( ).image_reducible.clear( )
+				return sx.convert_file( linked, args )
+			units = { 'pages': len( ids ), 'MB': os.path.getsize( sn_file ) / 2**20 }
+		case _ :
+			raise ValueError( f'unknown stage {stage}' )
+
+	times = []
+	for i in range( repeat ) :
+		start = time.perf_counter( )
+		run( )
+		times.append( time.perf_counter( ) - start )
+	sn.close( )
+	if stage == 'end-to-end' :
+		sx.shutil.rmtree( tmp )
+
+	return {
+		'seconds':		min( times ),
+		'units':		units,
+		'peak_rss_mb':	peak_rss_mb( ),
+	}
+
+def peak_rss_mb( ) :
+	"""
+	peak resident set size of this process; ru_maxrss is inherited from the
+	parent across fork and exec, so prefer VmHWM where available (Linux)
+	"""
+	try :
+		with open( '/proc/self/status' ) as f :
+			for line in f :
+				if line.startswith( 'VmHWM:' ) :
+					return int( line.split( )[1] ) / 1024
+	except OSError :
+		pass
+	return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024
+
+def measure( stage, sn_file, repeat ) :
+	"""
+	run a stage in a fresh process (see run_stage())
+	"""
+	out = subprocess.run( [ sys.executable, os.path.abspath( __file__ ), '--run-stage', stage, '--repeat', str( repeat ), sn_file ],
+		check=True, capture_output=True, text=True )
+	return json.loads( out.stdout )
+
+########################################
+def compare( results, baseline, tolerance ) :
+	"""
+	report stages that got slower than in the baseline by more than the tolerance
+
+	[dict]		results		current results
+	[dict]		baseline	earlier results
+	float		tolerance	allowed relative slow down
+
+	int			count		number of regressions
+	"""
+	old = { ( r['document'], r['stage'] ) : r for r in baseline }
+	count = 0
+	for r in results :
+		b = old.get( ( r['document'], r['stage'] ) )
+		if b is not None and r['seconds'] > b['seconds'] * ( 1 + tolerance ) :
+			count += 1
+			print( f'REGRESSION {r["document"]} {r["stage"]}: {b["seconds"]:.3f}s -> {r["seconds"]:.3f}s', file=sys.stderr )
+	return count
+
+def main( ) :
+	"""
+	This is the "main" function
+	"""
+	parser = argparse.ArgumentParser( description='Benchmark squidnote2xopp' )
+	parser.add_argument( "filenames",					action='store',			help='Squid Note files [synthetic documents]',	nargs='*' )
+	parser.add_argument( "-p", "--presets",				action='store',			help=f'Synthetic documents to generate [{" ".join( PRESETS )}]',	nargs='+', choices=PRESETS, default=list( PRESETS ) )
+	parser.add_argument( "-s", "--stages",				action='store',			help=f'Stages to run [{" ".join( STAGES )}]',	nargs='+', choices=STAGES, default=STAGES )
+	parser.add_argument( "-r", "--repeat",				action='store',			help='Number of timed runs, the best one counts [3]',	default=3, type=int )
+	parser.add_argument( "-w", "--workdir",				action='store',			help='Directory for synthetic documents (kept, and reused if present) [temporary]' )
+	parser.add_argument( "-o", "--output",				action='store',			help='Write results to JSON file' )
+	parser.add_argument( "-B", "--baseline",			action='store',			help='Compare with results in JSON file, exit with status 1 on regressions' )
+	parser.add_argument( "-T", "--tolerance",			action='store',			help='Allowed slow down relative to the baseline [0.15]',	default=0.15, type=float )
+	parser.add_argument( "--run-stage",					action='store',			help=argparse.SUPPRESS )
+	args = parser.parse_args( )
+
+	if args.run_stage :
+		print( json.dumps( run_stage( args.run_stage, args.filenames[0], args.repeat ) ) )
+		return
+
+	with tempfile.TemporaryDirectory( ) as tmp :
+		files = args.filenames
+		if not files :
+			import squidnote_synth
+			workdir = args.workdir or tmp
+			os.makedirs( workdir, exist_ok=True )
+			for preset in args.presets :
+				filename = os.path.join( workdir, preset + '.snb' )
+				if not os.path.exists( filename ) :
+					print( f'Generating {preset} document "{filename}"', file=sys.stderr )
+					squidnote_synth.write_archive( filename, **PRESETS[preset] )
+				files.append( filename )
+
+		results = []
+		print( f'{"document":<16} {"stage":<12} {"seconds":>9} {"peak MB":>8}  throughput' )
+		for sn_file in files :
+			for stage in args.stages :
+				r = measure( stage, sn_file, args.repeat )
+				r.update( document=os.path.basename( sn_file ), stage=stage )
+				r['throughput'] = { f'{unit}/s': n / r['seconds'] for unit, n in r['units'].items( ) }
+				results.append( r )
+				print( f'{r["document"]:<16} {stage:<12} {r["seconds"]:>9.4f} {r["peak_rss_mb"]:>8.1f}  ' +
+					', '.join( f'{v:.4g} {k}' for k, v in r['throughput'].items( ) ), flush=True )
+
+	if args.output :
+		with open( args.output, 'w' ) as f :
+			json.dump( { 'python': sys.version.split( )[0], 'results': results }, f, indent=1 )
+
+	if args.baseline :
+		with open( args.baseline ) as f :
+			baseline = json.load( f )['results']
+		exit( 1 if compare( results, baseline, args.tolerance ) else 0 )
+
+########################################
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+"""
+Generate synthetic SquidNote documents for testing and benchmarking squidnote2xopp
+   Run "squidnote_synth -h" for usage information
+The generated archives have the layout of real SquidNote documents: a note.db
+sqlite3 database with a page table, protobuf page files in data/pages, embedded
+images in data/imgs and background PDFs in data/docs; all content is random but
+reproducible for a given seed
+"""
+
+import sys
+import os
+import argparse
+import sqlite3
+import tempfile
+import zipfile
+
+try :
+	import numpy as np
+	import cv2
+	import squidnote_page_pb2 as SNP
+except ImportError as e :
+	print( f'\n\t{e}\n\tUse pip or the package manager of your operating system to install the missing library\n', file=sys.stderr )
+	exit( 1 )
+
+########################################
+def make_image( rng, width, height, photo ) :
+	"""
+	generate an encoded image
+
+	Generator	rng			random number generator
+	int			width		image width in pixels
+	int			height		image height in pixels
+	bool		photo		smooth 3-channel JPEG if set, else noisy 4-channel PNG (like a screenshot with alpha)
+
+	bytes		data		encoded image
+	"""
+	if photo :
+		y, x = np.mgrid[0:height, 0:width].astype( np.float32 )
+		phase = rng.uniform( 0, 2 * np.pi, 3 )
+		img = np.dstack( [ 127.5 + 127.5 * np.sin( x / ( 50 + 40 * c ) + y / ( 70 + 30 * c ) + phase[c] ) for c in range( 3 ) ] )
+		img = ( img + rng.normal( 0, 4, img.shape ) ).clip( 0, 255 ).astype( np.uint8 )
+		return cv2.imencode( '.jpg', img, [ cv2.IMWRITE_JPEG_QUALITY, 90 ] )[1].tobytes( )
+	else :
+		img = rng.integers( 0, 256, ( height, width, 4 ), dtype=np.uint8 )
+		return cv2.imencode( '.png', img )[1].tobytes( )
+
+def make_pdf( pages, width=595, height=842 ) :
+	"""
+	generate a minimal, valid PDF document with empty pages
+
+	int			pages		number of pages
+	int			width		page width in points
+	int			height		page height in points
+
+	bytes		data		PDF document
+	"""
+	objects = [
+		b'<< /Type /Catalog /Pages 2 0 R >>',
+		b'<< /Type /Pages /Kids [' + b' '.join( b'%d 0 R' % ( 3 + i ) for i in range( pages ) ) + b'] /Count %d >>' % pages,
+	] + [ b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] >>' % ( width, height ) ] * pages
+
+	pdf = bytearray( b'%PDF-1.4\n' )
+	offsets = []
+	for i, obj in enumerate( objects ) :
+		offsets.append( len( pdf ) )
+		pdf += b'%d 0 obj\n%s\nendobj\n' % ( i + 1, obj )
+	xref = len( pdf )
+	pdf += b'xref\n0 %d\n0000000000 65535 f \n' % ( len( objects ) + 1 )
+	pdf += b''.join( b'%010d 00000 n \n' % offset for offset in offsets )
+	pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % ( len( objects ) + 1, xref )
+	return bytes( pdf )
+
+def add_stroke( rng, layer, points, width, height ) :
+	"""
+	add a random walk pen (or, one in five, highlighter) stroke to a layer
+
+	Generator	rng			random number generator
+	SN_Layer	layer		layer to add the stroke to
+	int			points		number of delta points
+	float		width		page width in cm
+	float		height		page height in cm
+	"""
+	item = layer.item.add( )
+	item.type = SNP.SN_IT_STROKE
+	stroke = item.stroke
+	stroke.type = SNP.SN_ST_HIGHLIGHT if rng.random( ) < 0.2 else SNP.SN_ST_NORMAL
+	stroke.colour = int( rng.integers( 0, 2**32 ) )
+	stroke.weight = float( rng.uniform( 0.02, 0.1 ) )
+	stroke.start.x = float( rng.uniform( 0, width ) )
+	stroke.start.y = float( rng.uniform( 0, height ) )
+
+	# smooth pen movement: small steps in a slowly changing direction, varying pressure
+	angle = np.cumsum( rng.normal( 0, 0.3, points ) ) + rng.uniform( 0, 2 * np.pi )
+	step = rng.uniform( 0.005, 0.05, points )
+	dx = ( step * np.cos( angle ) ).tolist( )
+	dy = ( step * np.sin( angle ) ).tolist( )
+	weight = rng.uniform( 0.5, 1.5, points ).tolist( )
+	for i in range( points ) :
+		stroke.delta.add( dx=dx[i], dy=dy[i], weight=weight[i] )
+
+def add_image( rng, layer, image_hash, image_width, image_height, width, height ) :
+	"""
+	add a placement of an embedded image, with random crop, flips and right angle rotation, to a layer
+	"""
+	item = layer.item.add( )
+	item.type = SNP.SN_IT_IMAGE
+	image = item.image
+	image.image_hash = image_hash
+	image.crop_bounds.left = int( rng.integers( 0, image_width // 4 ) )
+	image.crop_bounds.top = int( rng.integers( 0, image_height // 4 ) )
+	image.crop_bounds.right = int( image_width - rng.integers( 0, image_width // 4 ) )
+	image.crop_bounds.bottom = int( image_height - rng.integers( 0, image_height // 4 ) )
+	image.flip_x = bool( rng.random( ) < 0.25 )
+	image.flip_y = bool( rng.random( ) < 0.25 )
+	image.rotation = int( rng.choice( [ 0, 0, 90, 180, 270 ] ) )
+
+	w = float( rng.uniform( 3, width / 2 ) )
+	h = w * image_height / image_width
+	image.bounds.left = float( rng.uniform( 0, width - w ) )
+	image.bounds.top = float( rng.uniform( 0, max( height - h, 0 ) ) )
+	image.bounds.right = image.bounds.left + w
+	image.bounds.bottom = image.bounds.top + h
+
+def make_page( rng, background, layers, strokes, points, image_hashes, image_width, image_height, pdf_page ) :
+	"""
+	generate a page
+
+	Generator	rng				random number generator
+	int			background		SN_Background_Type of the page
+	int			layers			number of layers
+	int			strokes			number of strokes per layer
+	int			points			number of delta points per stroke
+	[str]		image_hashes	images to place on the first layer
+	int			image_width		image width in pixels
+	int			image_height	image height in pixels
+	int			pdf_page		background PDF page number
+
+	SN_Page		page			page description
+	"""
+	page = SNP.SN_Page( )
+	page.background.type = background
+	page.background.width = 21.0
+	page.background.height = 29.7
+	page.background.colour = 0xffffffff
+	if background == SNP.SN_BT_RULEDPAPER :
+		page.background.ruled.line_spacing = 0.8
+		page.background.ruled.margin = 3.0
+		page.background.ruled.show_margin = True
+	elif background == SNP.SN_BT_PDF :
+		page.background.pdf.page_number = pdf_page
+
+	for il in range( layers ) :
+		layer = page.layer.add( )
+		for i in range( strokes ) :
+			add_stroke( rng, layer, points, page.background.width, page.background.height )
+		if il == 0 :
+			for image_hash in image_hashes :
+				add_image( rng, layer, image_hash, image_width, image_height, page.background.width, page.background.height )
+	return page
+
+########################################
+def write_archive( filename, pages=10, layers=1, strokes=100, points=50, images=0, image_width=1600, image_height=1200, images_per_page=1, pdfs=0, pdf_pages=4, seed=0 ) :
+	"""
+	write a synthetic SquidNote document; pages cycle through ruled, quad, blank
+	and (if pdfs>0) PDF backgrounds, images alternate between JPEG photos and PNGs
+	and are placed images_per_page at a time in turn, so images are reused if
+	there are more placements than images
+
+	string		filename		output file name
+	int			pages			number of pages
+	int			layers			number of layers per page
+	int			strokes			number of strokes per layer
+	int			points			number of delta points per stroke
+	int			images			number of distinct embedded images
+	int			image_width		image width in pixels
+	int			image_height	image height in pixels
+	int			images_per_page	number of image placements per page
+	int			pdfs			number of distinct background PDFs
+	int			pdf_pages		number of pages of each background PDF
+	int			seed			random seed
+
+	dict		summary			number of pages, strokes, points, image placements and archive size
+	"""
+	rng = np.random.default_rng( seed )
+	image_hashes = [ f'{seed:04x}{k:028x}' for k in range( images ) ]
+	pdf_ids = [ f'{seed:04x}-pdf-{k:04d}' for k in range( pdfs ) ]
+	backgrounds = [ SNP.SN_BT_RULEDPAPER, SNP.SN_BT_QUADPAPER, SNP.SN_BT_BLANK ] + ( [ SNP.SN_BT_PDF ] if pdfs else [] )
+	placements = 0
+
+	with zipfile.ZipFile( filename, 'w', zipfile.ZIP_DEFLATED ) as sn, tempfile.TemporaryDirectory( ) as tmp :
+		db_file = os.path.join( tmp, 'note.db' )
+		db = sqlite3.connect( db_file )
+		db.execute( 'CREATE TABLE page (id TEXT PRIMARY KEY, documentId TEXT, pageNum INTEGER, modified INTEGER)' )
+
+		for p in range( pages ) :
+			background = backgrounds[ p % len( backgrounds ) ]
+			pdf_id = pdf_ids[ p // len( backgrounds ) % pdfs ] if background == SNP.SN_BT_PDF else None
+			placed = [ image_hashes[ ( p * images_per_page + k ) % images ] for k in range( images_per_page ) ] if images else []
+			placements += len( placed )
+			page = make_page( rng, background, layers, strokes, points, placed, image_width, image_height, p % pdf_pages )
+			page_id = f'{seed:04x}-page-{p:06d}'
+			sn.writestr( f'data/pages/{page_id}.page', page.SerializeToString( ) )
+			db.execute( 'INSERT INTO page VALUES (?, ?, ?, ?)', ( page_id, pdf_id, p, p ) )
+
+		db.commit( )
+		db.close( )
+		sn.write( db_file, 'note.db' )
+
+		# images and PDFs are already compressed
+		for k, image_hash in enumerate( image_hashes ) :
+			sn.writestr( 'data/imgs/' + image_hash, make_image( rng, image_width, image_height, k % 2 == 0 ), compress_type=zipfile.ZIP_STORED )
+		for pdf_id in pdf_ids :
+			sn.writestr( 'data/docs/' + pdf_id, make_pdf( pdf_pages ), compress_type=zipfile.ZIP_STORED )
+
+	return {
+		'pages':		pages,
+		'strokes':		pages * layers * strokes,
+		'points':		pages * layers * strokes * points,
+		'images':		placements,
+		'bytes':		os.path.getsize( filename ),
+	}
+
+########################################
+def main( ) :
+	"""
+	This is the "main" function
+	"""
+	parser = argparse.ArgumentParser( description='Generate a synthetic Squid Note file' )
+	parser.add_argument( "filename",					action='store',			help='Output file name' )
+	parser.add_argument( "-p", "--pages",				action='store',			help='Number of pages [10]',					default=10, type=int )
+	parser.add_argument( "-L", "--layers",				action='store',			help='Number of layers per page [1]',			default=1, type=int )
+	parser.add_argument( "-s", "--strokes",				action='store',			help='Number of strokes per layer [100]',		default=100, type=int )
+	parser.add_argument( "-P", "--points",				action='store',			help='Number of points per stroke [50]',		default=50, type=int )
+	parser.add_argument( "-i", "--images",				action='store',			help='Number of distinct images [0]',			default=0, type=int )
+	parser.add_argument( "-I", "--images-per-page",		action='store',			help='Number of image placements per page [1]',	default=1, type=int )
+	parser.add_argument( "-W", "--image-width",			action='store',			help='Image width in pixels [1600]',			default=1600, type=int )
+	parser.add_argument( "-H", "--image-height",		action='store',			help='Image height in pixels [1200]',			default=1200, type=int )
+	parser.add_argument( "-d", "--pdfs",				action='store',			help='Number of background PDFs [0]',			default=0, type=int )
+	parser.add_argument( "-D", "--pdf-pages",			action='store',			help='Number of pages per background PDF [4]',	default=4, type=int )
+	parser.add_argument( "-S", "--seed",				action='store',			help='Random seed [0]',							default=0, type=int )
+	args = parser.parse_args( )
+
+	summary = write_archive( args.filename, args.pages, args.layers, args.strokes, args.points,
+		args.images, args.image_width, args.image_height, args.images_per_page, args.pdfs, args.pdf_pages, args.seed )
+	print( f'Wrote "{args.filename}": ' + ', '.join( f'{v} {k}' for k, v in summary.items( ) ), file=sys.stderr )
+
+########################################
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,15 @@
+"""
+make squidnote2xopp importable from the tests and import the libraries it
+injects into its globals (see import_libraries())
+"""
+
+import os
+import sys
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import squidnote2xopp as sx
+
+sx.import_libraries( )
+sx.import_lazily( sx.CONVERSION_LIBS + sx.NUMPY_LIBS + sx.IMAGE_LIBS )
+sx.context( ).log_level = sx.LOG_QUIET
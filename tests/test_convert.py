@@ -0,0 +1,38 @@
+"""
+whole conversions of small synthetic documents (see squidnote_synth)
+"""
+
+import gzip
+import io
+
+import pytest
+
+import squidnote2xopp as sx
+import squidnote_synth
+
+EMPTY_DOCUMENT = ( b'<?xml version="1.0" standalone="no"?><xournal creator="Xournal++ 1.1.1" fileversion="4">'
+	b'<title>Xournal++ document - see https ://github.com/xournalpp/xournalpp</title></xournal>' )
+
+@pytest.fixture
+def empty_notebook( tmp_path ) :
+	sn_file = str( tmp_path / 'empty.snb' )
+	squidnote_synth.write_archive( sn_file, pages=0 )
+	return sn_file
+
+def test_convert_notebook_without_pages( empty_notebook ) :
+	out = io.BytesIO( )
+	summary = sx.convert( empty_notebook, out, { 'no_cache': True, 'log_level': sx.LOG_QUIET } )
+	assert summary['pages'] == 0
+	assert gzip.decompress( out.getvalue( ) ) == EMPTY_DOCUMENT
+
+@pytest.mark.parametrize( 'options', [ {}, { 'pipeline_depth': 0 }, { 'split_every': 2 } ], ids=[ 'pipeline', 'serial', 'split' ] )
+def test_convert_file_notebook_without_pages( empty_notebook, options ) :
+	args = sx.conversion_options( dict( options, no_cache=True ) )
+	summary = sx.convert_file( empty_notebook, args )
+	assert summary['pages'] == 0
+	with gzip.open( sx.output_file_name( empty_notebook, args ) ) as f :
+		assert f.read( ) == EMPTY_DOCUMENT
+
+def test_empty_page_selection_is_an_error( empty_notebook ) :
+	with pytest.raises( ValueError ) :
+		sx.convert( empty_notebook, io.BytesIO( ), { 'no_cache': True, 'log_level': sx.LOG_QUIET, 'pages': '1-' } )
@@ -0,0 +1,178 @@
+"""
+decode_page_deltas() / layer_deltas() must give bitwise the same delta points
+as parsing the page with protobuf and reading the SN_DP messages
+"""
+
+import struct
+
+import numpy as np
+import pytest
+
+import squidnote2xopp as sx
+
+########################################
+# protobuf wire format, written by hand to get encodings protobuf itself does not produce
+def varint( n ) :
+	out = bytearray( )
+	while n > 0x7f :
+		out.append( n & 0x7f | 0x80 )
+		n >>= 7
+	out.append( n )
+	return bytes( out )
+
+def f32( number, value ) :
+	return varint( number << 3 | 5 ) + struct.pack( '<f', value )
+
+def message( number, *fields ) :
+	payload = b''.join( fields )
+	return varint( number << 3 | 2 ) + varint( len( payload ) ) + payload
+
+def dp( *fields ) :
+	"""
+	SN_DP as the delta field of SN_Stroke, fields given as f32( 1|2|3, value )
+	"""
+	return message( 4, *fields )
+
+def stroke_item( *fields ) :
+	"""
+	SN_Item holding an SN_Stroke made of the given fields
+	"""
+	return message( 1, varint( 1 << 3 ) + varint( sx.SNP.SN_Item_Type.SN_IT_STROKE ), message( 1000, *fields ) )
+
+def page( *layers ) :
+	"""
+	SN_Page of the given layers, each a list of SN_Item fields
+	"""
+	return message( 1, f32( 4, 21.0 ), f32( 5, 29.7 ) ) + b''.join( message( 3, *items ) for items in layers )
+
+def start( x=1.0, y=2.0 ) :
+	return message( 3, f32( 1, x ), f32( 2, y ) )
+
+########################################
+def reference( data ) :
+	"""
+	delta points of each stroke item of each layer, read through protobuf
+
+	[dict]		layers		for each layer, item index -> (count,ndarray) of the stroke items
+	"""
+	page = sx.SNP.SN_Page( )
+	page.ParseFromString( data )
+	return [ { ii : ( len( im.stroke.delta ), np.array( [ ( d.dx, d.dy, d.weight ) for d in im.stroke.delta ], dtype=np.float64 ).reshape( -1, 3 ) )
+		for ii, im in enumerate( lr.item ) if im.WhichOneof( 'item' ) == 'stroke' } for lr in page.layer ]
+
+def check( data ) :
+	"""
+	compare decode_page_deltas() with protobuf, bit for bit (NaN payloads and -0 included)
+	"""
+	expected = reference( data )
+	layers, deltas = sx.decode_page_deltas( data )
+	assert len( layers ) == len( expected )
+	for strokes, expected_strokes in zip( layers, expected ) :
+		assert sorted( strokes ) == sorted( expected_strokes )
+		items = sorted( strokes )
+		if not items :
+			continue
+		if deltas is None :
+			assert all( count == 0 for count, _ in expected_strokes.values( ) )
+			continue
+		counts, points = sx.layer_deltas( strokes, items, deltas )
+		assert counts.tolist( ) == [ expected_strokes[ii][0] for ii in items ]
+		expected_points = np.concatenate( [ expected_strokes[ii][1] for ii in items ] )
+		assert points.dtype == np.float64
+		assert np.array_equal( points.view( np.uint64 ), expected_points.view( np.uint64 ) )
+
+@pytest.fixture( params=[ bytes, memoryview ], ids=[ 'bytes', 'memoryview' ] )
+def as_input( request ) :
+	return request.param
+
+########################################
+def random_page( rng, layers=3, strokes=20, specials=False ) :
+	"""
+	page serialised by protobuf, with zero fields (omitted) and optionally -0, NaN and inf
+	"""
+	page = sx.SNP.SN_Page( )
+	page.background.width = 21.0
+	for il in range( layers ) :
+		layer = page.layer.add( )
+		for k in range( strokes ) :
+			item = layer.item.add( )
+			if k % 7 == 3 :
+				item.type = sx.SNP.SN_Item_Type.SN_IT_IMAGE
+				item.image.image_hash = 'abc'
+				continue
+			item.type = sx.SNP.SN_Item_Type.SN_IT_STROKE
+			item.stroke.start.x = rng.random( )
+			item.stroke.weight = 0.5
+			values = rng.normal( size=( int( rng.integers( 0, 40 ) ), 3 ) ).astype( np.float32 )
+			values[ rng.random( values.shape ) < 0.2 ] = 0.0
+			if specials :
+				choices = np.array( [ -0.0, np.nan, np.inf, -np.inf ], dtype=np.float32 )
+				mask = rng.random( values.shape ) < 0.1
+				values[mask] = rng.choice( choices, size=int( mask.sum( ) ) )
+			for dx, dy, w in values.tolist( ) :
+				d = item.stroke.delta.add( )
+				( d.dx, d.dy, d.weight ) = ( dx, dy, w )
+	return page.SerializeToString( )
+
+def test_random_pages( as_input ) :
+	rng = np.random.default_rng( 1 )
+	for k in range( 5 ) :
+		check( as_input( random_page( rng, specials=k % 2 == 1 ) ) )
+
+def test_empty_page_and_strokes( as_input ) :
+	check( as_input( page( ) ) )
+	check( as_input( page( [], [ stroke_item( start( ) ) ] ) ) )
+
+def test_omitted_zero_fields( as_input ) :
+	data = page( [ stroke_item( start( ),
+		dp( f32( 1, 1.5 ), f32( 2, -2.5 ), f32( 3, 0.25 ) ),
+		dp( f32( 2, 3.0 ) ),
+		dp( ),
+		dp( f32( 1, 4.0 ), f32( 3, 1.0 ) ),
+		dp( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 3, 3.0 ) ) ) ] )
+	check( as_input( data ) )
+
+def test_negative_zero_nan_and_inf( as_input ) :
+	nan = struct.unpack( '<f', b'\x01\x00\xc0\x7f' )[0]
+	data = page( [ stroke_item( start( ),
+		dp( f32( 1, -0.0 ), f32( 2, float( 'nan' ) ), f32( 3, float( 'inf' ) ) ),
+		dp( f32( 1, float( '-inf' ) ), f32( 2, nan ), f32( 3, -0.0 ) ),
+		dp( f32( 1, -0.0 ) ) ) ] )
+	check( as_input( data ) )
+
+def test_reordered_and_duplicate_fields( as_input ) :
+	data = page( [ stroke_item(
+		dp( f32( 3, 0.5 ), f32( 1, 1.0 ), f32( 2, 2.0 ) ),
+		start( ),
+		dp( f32( 2, 7.0 ), f32( 1, 6.0 ) ),
+		# a repeated field overrides the earlier one
+		dp( f32( 1, 1.0 ), f32( 1, 9.0 ), f32( 3, 2.0 ) ),
+		dp( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 3, 3.0 ) ),
+		f32( 2, 0.75 ),
+		dp( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 3, 3.0 ) ) ) ] )
+	check( as_input( data ) )
+
+def test_unknown_stroke_and_item_fields_are_skipped( as_input ) :
+	data = page( [ stroke_item( start( ), varint( 99 << 3 ) + varint( 5 ), dp( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 3, 3.0 ) ), message( 98, b'xyz' ) ),
+		message( 1, varint( 1 << 3 ) + varint( 0 ), message( 1003, message( 2, b'img' ) ) ) ] )
+	check( as_input( data ) )
+
+########################################
+@pytest.mark.parametrize( 'fields', [
+	( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 4, 3.0 ) ),
+	( f32( 1, 1.0 ), varint( 4 << 3 ) + varint( 1 ) ),
+	( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 3, 3.0 ), f32( 4, 4.0 ) ),
+], ids=[ 'unknown float', 'unknown varint', 'extra float' ] )
+def test_unknown_delta_fields_fall_back_to_protobuf( as_input, fields ) :
+	data = as_input( page( [ stroke_item( start( ), dp( f32( 1, 1.0 ), f32( 2, 2.0 ), f32( 3, 3.0 ) ), dp( *fields ) ) ] ) )
+	with pytest.raises( ValueError ) :
+		sx.decode_page_deltas( data )
+	# parse_page() falls back to the SN_DP messages
+	ret_val, parsed, decoded = sx.parse_page( None, 0, 'p', data )
+	assert decoded is None
+	assert len( parsed.layer[0].item[0].stroke.delta ) == 2
+
+def test_repeated_stroke_field_falls_back_to_protobuf( as_input ) :
+	item = message( 1, message( 1000, start( ), dp( f32( 1, 1.0 ) ) ), message( 1000, dp( f32( 1, 2.0 ) ) ) )
+	with pytest.raises( ValueError ) :
+		sx.decode_page_deltas( as_input( page( [ item ] ) ) )
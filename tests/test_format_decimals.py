@@ -0,0 +1,41 @@
+"""
+format_decimals() must give byte for byte the fields of Python's ' %.3f' formatting
+"""
+
+import numpy as np
+import pytest
+
+import squidnote2xopp as sx
+
+########################################
+def check( values ) :
+	values = np.asarray( values, dtype=np.float64 )
+	fields = [ b' %.3f' % v for v in values.tolist( ) ]
+	text, ends = sx.format_decimals( values )
+	assert text == b''.join( fields )
+	assert ends.tolist( ) == np.cumsum( [ len( f ) for f in fields ] ).tolist( )
+
+def test_empty( ) :
+	check( [] )
+
+@pytest.mark.parametrize( 'scale', [ 1e-3, 1.0, 100.0, 1e6 ] )
+def test_random_values( scale ) :
+	rng = np.random.default_rng( 5 )
+	check( rng.normal( scale=scale, size=10000 ) )
+
+def test_near_ties( ) :
+	# x.xxx5 is not exactly representable, Python rounds the stored value correctly
+	rng = np.random.default_rng( 6 )
+	k = rng.integers( -10**7, 10**7, size=5000 )
+	ties = ( k + 0.5 ) / 1000.0
+	check( np.concatenate( ( ties, np.nextafter( ties, np.inf ), np.nextafter( ties, -np.inf ), [ 0.0005, 0.0015, 1.0005, 2.6745, -0.0005, -2.6745 ] ) ) )
+
+def test_negatives_and_zero( ) :
+	check( [ -0.0, 0.0, -0.0001, -0.0004999, -0.0005, -0.0006, -1.0, -999.9995, -1234.5678 ] )
+
+def test_large_magnitudes( ) :
+	check( [ 999999.9995, 1e9 + 0.123, -1e11 - 0.5, 123456789012.345, 999999999999.999 ] )
+
+def test_python_fallback( ) :
+	# values beyond the int64 range of the vectorised path, and non-finite values
+	check( [ 1.0, 1e12, -1e15, 1e20, 1.5e300, float( 'inf' ), float( '-inf' ), float( 'nan' ) ] )
@@ -0,0 +1,114 @@
+"""
+stroke simplification (-T): simplify_polylines() must keep the end points of each
+polyline and drop only points within the tolerance of the simplified polyline, and
+render_strokes() must keep each width with its point
+"""
+
+import re
+
+import numpy as np
+import pytest
+
+import squidnote2xopp as sx
+
+########################################
+def segment_distance( p, a, b ) :
+	"""
+	distance of point p to the line segment from a to b
+	"""
+	ab = b - a
+	ab2 = float( ab @ ab )
+	t = 0.0 if ab2 == 0 else min( max( float( ( p - a ) @ ab ) / ab2, 0.0 ), 1.0 )
+	return float( np.hypot( *( p - a - t * ab ) ) )
+
+def random_polylines( rng, lengths ) :
+	"""
+	noisy random walks, one per length, as simplify_polylines() takes them
+	"""
+	rows = np.array( lengths, dtype=np.intp )
+	first = np.cumsum( rows ) - rows
+	xy = np.cumsum( rng.normal( scale=[ 1.0, 0.3 ], size=( int( rows.sum( ) ), 2 ) ), axis=0 )
+	return xy, first, rows
+
+@pytest.mark.parametrize( 'tolerance', [ 0.05, 0.5, 5.0 ] )
+def test_dropped_points_within_tolerance( tolerance ) :
+	rng = np.random.default_rng( 2 )
+	xy, first, rows = random_polylines( rng, [ 1, 2, 3, 10, 200, 57, 2, 1000 ] )
+	keep = sx.simplify_polylines( xy, first, rows, tolerance )
+	assert keep.dtype == bool and keep.shape == ( len( xy ), )
+	for f, n in zip( first.tolist( ), rows.tolist( ) ) :
+		kept = f + np.flatnonzero( keep[f : f + n] )
+		# end points are kept
+		assert kept[0] == f and kept[-1] == f + n - 1
+		# each dropped point is within the tolerance of the simplified segment spanning it
+		for a, b in zip( kept[:-1], kept[1:] ) :
+			for p in range( a + 1, b ) :
+				assert segment_distance( xy[p], xy[a], xy[b] ) <= tolerance * ( 1 + 1e-9 )
+
+def test_collinear_points_are_dropped( ) :
+	xy = np.column_stack( ( np.arange( 10.0 ), 2 * np.arange( 10.0 ) ) )
+	keep = sx.simplify_polylines( xy, np.array( [0] ), np.array( [10] ), 0.01 )
+	assert np.flatnonzero( keep ).tolist( ) == [ 0, 9 ]
+
+def test_non_finite_points_are_kept( ) :
+	xy = np.column_stack( ( np.arange( 6.0 ), np.zeros( 6 ) ) )
+	xy[3, 1] = np.nan
+	keep = sx.simplify_polylines( xy, np.array( [0] ), np.array( [6] ), 1.0 )
+	assert keep[3]
+
+########################################
+def make_strokes( rng, lengths ) :
+	"""
+	pen and highlighter strokes with the given numbers of points (1 + delta points)
+	"""
+	strokes = []
+	for k, n in enumerate( lengths ) :
+		s = sx.SNP.SN_Stroke( )
+		s.type = sx.SNP.SN_Stroke_Type.SN_ST_HIGHLIGHT if k % 3 == 2 else sx.SNP.SN_Stroke_Type.SN_ST_NORMAL
+		s.colour = 0xff000000 + k
+		s.weight = 0.3
+		( s.start.x, s.start.y ) = rng.random( 2 ).tolist( )
+		for dx, dy, w in zip( np.cumsum( rng.normal( scale=0.05, size=n - 1 ) ).tolist( ), np.cumsum( rng.normal( scale=0.02, size=n - 1 ) ).tolist( ), rng.random( n - 1 ).tolist( ) ) :
+			d = s.delta.add( )
+			( d.dx, d.dy, d.weight ) = ( dx, dy, w )
+		strokes.append( s )
+	return strokes
+
+def points( element ) :
+	"""
+	(x,y,width) text of each point of a <stroke> element
+	"""
+	m = re.fullmatch( r'<stroke [^>]* width="([^"]*)">([^<]*)</stroke>\n', bytes( element ).decode( 'ascii' ) )
+	widths = m.group( 1 ).split( ' ' )
+	xy = m.group( 2 ).split( ' ' )
+	assert len( xy ) == 2 * len( widths )
+	return list( zip( xy[0::2], xy[1::2], widths ) )
+
+def render( strokes, tolerance, monkeypatch ) :
+	monkeypatch.setattr( sx.context( ), 'simplify_tolerance', tolerance )
+	return [ bytes( e ) for e in sx.render_strokes( strokes, 1.0, 1.0 ) ]
+
+def test_render_empty( monkeypatch ) :
+	assert render( [], 1.0, monkeypatch ) == []
+
+def test_render_short_strokes_unchanged( monkeypatch ) :
+	strokes = make_strokes( np.random.default_rng( 3 ), [ 1, 2, 1, 2, 2 ] )
+	assert render( strokes, 10.0, monkeypatch ) == render( strokes, 0.0, monkeypatch )
+
+@pytest.mark.parametrize( 'tolerance', [ 0.1, 1.0, 10.0 ] )
+def test_render_keeps_widths_with_points( tolerance, monkeypatch ) :
+	strokes = make_strokes( np.random.default_rng( 4 ), [ 1, 2, 3, 40, 300, 2, 17 ] )
+	full = render( strokes, 0.0, monkeypatch )
+	simplified = render( strokes, tolerance, monkeypatch )
+	assert len( simplified ) == len( full )
+	dropped = 0
+	for a, b in zip( full, simplified ) :
+		# the start tag is unchanged
+		assert a.split( b' width=' )[0] == b.split( b' width=' )[0]
+		all_points, kept = points( a ), points( b )
+		# end points are kept, and the kept (x,y,width) are a subsequence of all of them
+		assert kept[0] == all_points[0] and kept[-1] == all_points[-1]
+		it = iter( all_points )
+		assert all( p in it for p in kept )
+		dropped += len( all_points ) - len( kept )
+	assert dropped > 0
@@ -0,0 +1,75 @@
+"""
+transform_image() must give the image of the former crop / flip / rotate / resize
+chain: the same shape, and pixels within one grey level (identical when unscaled)
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+import squidnote2xopp as sx
+
+########################################
+def reference( cvimg, reduction, crop_bounds, flip_x, flip_y, rotation, x_scale, y_scale ) :
+	"""
+	the crop / flip / rotate / resize chain transform_image() replaced (right angles only)
+	"""
+	cv2 = sx.cv2
+	( cl, cr, ct, cb ) = crop_bounds
+	if reduction > 1 :
+		cvimg = cvimg[ct//reduction:-(-cb//reduction), cl//reduction:-(-cr//reduction)]
+	else :
+		cvimg = cvimg[ct:cb, cl:cr]
+	if flip_x :
+		cvimg = cv2.flip( cvimg, 0 )
+	if flip_y :
+		cvimg = cv2.flip( cvimg, 1 )
+	( w, h ) = ( cr-cl, cb-ct )
+	match rotation :
+		case 90 :
+			cvimg = cv2.rotate( cvimg, cv2.ROTATE_90_CLOCKWISE )
+			( w, h ) = ( h, w )
+		case 180 :
+			cvimg = cv2.rotate( cvimg, cv2.ROTATE_180 )
+		case 270 :
+			cvimg = cv2.rotate( cvimg, cv2.ROTATE_90_COUNTERCLOCKWISE )
+			( w, h ) = ( h, w )
+
+	if reduction > 1 :
+		return cv2.resize( cvimg, ( max( 1, round( w * x_scale ) ), max( 1, round( h * y_scale ) ) ) )
+	return cv2.resize( cvimg, None, fx=x_scale, fy=y_scale )
+
+def smooth_image( height, width, channels ) :
+	"""
+	gradients and a few soft blobs, as photos and scans mostly are
+	"""
+	y, x = np.mgrid[0:height, 0:width] / np.array( [ height, width ] ).reshape( 2, 1, 1 )
+	planes = [ 127.5 + 127.5 * np.sin( 2.0 * x + 3.0 * y + k ) * np.cos( 1.5 * x - 2.5 * y * k ) for k in range( channels ) ]
+	return np.clip( np.rint( np.dstack( planes ) ), 0, 255 ).astype( np.uint8 )
+
+ORIENTATIONS = list( itertools.product( [ 0, 90, 180, 270 ], [ False, True ], [ False, True ] ) )
+
+########################################
+@pytest.mark.parametrize( 'rotation, flip_x, flip_y', ORIENTATIONS )
+@pytest.mark.parametrize( 'scale', [ ( 1.0, 1.0 ), ( 0.5, 0.5 ), ( 0.37, 0.61 ), ( 1.6, 1.3 ) ], ids=[ 'unscaled', 'half', 'down', 'up' ] )
+def test_full_resolution( rotation, flip_x, flip_y, scale ) :
+	img = smooth_image( 90, 140, 3 )
+	args = ( 1, ( 7, 131, 5, 83 ), flip_x, flip_y, rotation, *scale )
+	expected = reference( img, *args )
+	got = sx.transform_image( img, *args )
+	assert got.shape == expected.shape
+	diff = np.abs( got.astype( np.int16 ) - expected.astype( np.int16 ) )
+	assert diff.max( ) <= ( 0 if scale == ( 1.0, 1.0 ) else 1 )
+
+@pytest.mark.parametrize( 'rotation, flip_x, flip_y', ORIENTATIONS )
+@pytest.mark.parametrize( 'reduction', [ 2, 4 ] )
+def test_reduced_decode( rotation, flip_x, flip_y, reduction ) :
+	# the image as decoded at 1/reduction of its full resolution, crop bounds at full resolution
+	img = smooth_image( 400 // reduction, 600 // reduction, 4 )
+	args = ( reduction, ( 24, 568, 16, 392 ), flip_x, flip_y, rotation, 0.3, 0.3 )
+	expected = reference( img, *args )
+	got = sx.transform_image( img, *args )
+	assert got.shape == expected.shape
+	diff = np.abs( got.astype( np.int16 ) - expected.astype( np.int16 ) )
+	assert diff.max( ) <= 1